@@ -124,6 +124,11 @@ atexit.register(logExit)
 #
 
 class MyAlignment:
+
+	#one of these is made for every blast hit, so skip the per-instance __dict__
+	__slots__ = ( 'qid', 'sid', 'identity', 'alignment', 'mismatches', 'gaps', 'qstart', 'qend',
+		      'sstart', 'send', 'evalue', 'score', 'strand', 'qlen', 'slen', 'real_id', 'divergence' )
+
 	def __init__(self, row):
 		self.qid	= row[0].strip()		# query id
 		self.sid	= row[1].strip()		# subject id
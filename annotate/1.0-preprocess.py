@@ -11,15 +11,16 @@ After QC, this script proceeds to look for cell barcodes and UMIs. Currently, ce
     only supported on the 5' end of the read; UMIs can be on either end, including support for
     double UMI protocols. (Note that it treats both ends equivalently, so it's not quite compatible
     with, eg, the Reddy lab's MAF protocol.) The script allows for filtering barcodes/UMIs against
-    either a known whitelist or a designed pattern, but does not currently check for UMI
-    error/splitting. (I plan to add it, but it's mostly moot in the context of a cell barcode.)
+    either a known whitelist or a designed pattern. When there are UMIs but no cell barcodes,
+    UMIs that look like sequencing errors of a more abundant UMI are merged into it
+    (directional method), and UMIs whose reads form more than one large cluster are split
+    into separate molecules.
 The script then uses vsearch to generate a consensus sequence for each UMI and, importantly, a set
     of meta-consensus sequences for the UMIs in each cell. In order to be conservative, this will
     sometimes (frequently) generate multiple copies of the same Ig transcript in the same cell. Use
     1.5-single_cell_statistics.py after annotation to clean things up a bit.
 
 TODO:
-   * Add dereplication and UMI collision detection when no cell barcodes are present
    * Allow UMI reuse under certain conditions?
    * Should there be a threshold (10:1? 100:1?) at which I ignore conflicting sample assignments
          from cell hashing and just go with the majority?
@@ -76,6 +77,14 @@ Options:
                                        rearrangments.tsv; all other values will be used as the name of
                                        a custom column in the cell_stats.tsv with the value
                                        corresponding to the number of detected UMIs.
+    --featureMismatch              Flag to allow a single mismatch when matching feature and hashing
+                                       oligos (ambiguous matches are still discarded).
+                                       [default: False]
+    --featureFormat tsv            How to save feature barcoding counts: 'tsv' for a table with one
+                                       column per feature, or 'mtx' for a sparse matrix (MatrixMarket
+                                       matrix.mtx plus barcodes.tsv and features.tsv, in the
+                                       directory output/tables/<project>_features), which is much
+                                       smaller for large panels. [default: tsv]
     --filterOptions options        A string of options to be passed to vsearch --fastx_filter for
                                        quality control Will be applied equally to R1 and R2 *before*
                                        merging, or to a single input file if no R2 is specified.
@@ -86,14 +95,32 @@ Options:
     --printQC file.log             A file in which to save a report on the quality of the final
                                        input sequences, after QC but before UMI processing,
                                        using vsearch --fastq_stats.
+    --stream                       Flag to connect the vsearch filtering, merging, and --printQC steps
+                                       with pipes instead of writing intermediate fastq files to
+                                       disk. If UMIs or cell barcodes are present, the merged reads
+                                       are also split into chunks for UMI processing directly from
+                                       the stream. [default: False]
     --logFile preprocess.log       Where to save the log file. [default: output/logs/preprocess.log]
     --minQ 20                      Minimum PHRED score for all bases in a UMI or cell barcode. Reads
                                        with *any* base in the UMI/barcode below this threshold will
                                        be discarded. [default: 20]
+    --noCorrect                    Flag to disable correction of cell barcodes and UMIs that are a
+                                       single mismatch away from exactly one barcode on the relevant
+                                       whitelist. Such reads will be discarded instead.
+                                       [default: False]
     --minReads 1                   Minimum number of reads per UMI. UMIs with fewer reads will be
                                        discarded. [default: 3]
     --minUMIs 1                    Minimum number of UMIs per metaconsenus/final sequence. In theory,
                                        a value >1 should help remove background contamination. [default: 1]
+    --umiDistance 1                Maximum number of mismatches between two UMIs for the less abundant
+                                       one to be merged into the other as a sequencing error.
+                                       Only used if there are no cell barcodes; use 0 to disable.
+                                       [default: 1]
+    --fastConsensus 0              UMIs with at most this many reads, all of the same length, get a
+                                       quality-weighted consensus computed directly instead of by
+                                       vsearch. Much faster for typical 10x data (eg 5), but the
+                                       consensus can differ from vsearch's where reads disagree.
+                                       By default, vsearch is always used. [default: 0]
     --umiOutput file.fa            File in which to save the UMI-processed sequences. Ignored if
                                        UMIs are not present. [default: byUMI.fa]
     --cellOutput file.fa           File in which to save the cell-processed sequences. Ignored if
@@ -106,7 +133,16 @@ Options:
     --cluster                      Flag to submit chunk jobs to cluster instead of running them
                                        locally. [default: False]
     --threads 1                    Number of threads to use. [default: 1]
+    --partitions 256               Number of hash partitions used to group reads by cell barcode
+                                       and UMI. Consensus jobs load one partition at a time, so peak
+                                       memory scales with (total reads / partitions). [default: 256]
+    --chunks 32                    Number of consensus jobs. Partitions (or cells) are packed into
+                                       chunks of roughly equal estimated cost, based on the number
+                                       and length of reads in each UMI or cell. [default: 32]
     -f                             Flag to force overwriting of old files. [default: False]
+    --resume                       Flag to resume an interrupted run, skipping work that was already
+                                       completed with the same inputs and options (as recorded in
+                                       the checkpoints folder of output/preprocess). [default: False]
     --keepWorkFiles                Flag to prevent deletion of intermediate files (useful for
                                        inspecting UMI clustering). [default: False]
 
@@ -160,16 +196,14 @@ All rights reserved.
 
 """
 
-import sys, os, shutil, gzip, csv
+import sys, os, shutil, gzip, csv, stat, threading, atexit
 from docopt import docopt
-import itertools
 import pickle
 from collections import defaultdict
 from Bio import SeqIO
 from multiprocessing import Pool
 import datetime
 from functools import partial
-import random, math
 try:
 	from SONAR.annotate import *
 except ImportError:
@@ -178,34 +212,181 @@ except ImportError:
 	from SONAR.annotate import *
 
 
-# a utility function to get us a slice of an iterator, as an iterator
-# when working with iterators maximum lazyness is preferred
-# from https://stackoverflow.com/a/44502827
-def iterator_slice(iterator, length):
-	iterator = iter(iterator)
-	while True:
-		res = tuple(itertools.islice(iterator, length))
-		if not res:
-			break
-		yield res
+def checkpoint(stage):
+	#markers for the completed units of each stage (see _checkpoint.py)
+	return Checkpoint( "%s/checkpoints/%s" % (prj_tree.preprocess, stage) )
+
+
+def makePartitions(stem, fresh=True):
+	#one directory per hash partition; find_umis writes its spill files to these
+	#    if we are (re)starting UMI finding from scratch, make sure nothing is left
+	#    over from a previous attempt
+	if fresh:
+		for old in glob.glob( "%s_[0-9][0-9][0-9][0-9]" % stem ):
+			shutil.rmtree(old)
+	for part in range(1, arguments['--partitions']+1):
+		os.makedirs( "%s_%04d" % (stem, part), exist_ok=True )
+
+
+def splitInputs(stage, streams, templates, fileformat, fingerprint):
+	#split the input into chunks in the background (see ChunkWriter), unless this
+	#    was already done in a previous attempt with the same input
+	#    returns the chunks (as either a list or a ChunkWriter), and whether they were reused
+	check = checkpoint(stage)
+	if arguments['--resume'] and check.done("chunks", fingerprint):
+		chunks = [ f for f in check.outputs("chunks") if re.match( os.path.basename(templates[0]).split("%")[0], os.path.basename(f) ) ]
+		print( "%s: Reusing %d chunks from a previous run..." % (datetime.datetime.now(), len(chunks)), file=sys.stderr )
+		return chunks, True
+	check.reset()
+	return ChunkWriter( streams, templates, fileformat, 50000 ), False
+
+
+def finishSplit(stage, chunks, fingerprint):
+	#once the chunker is finished, record its output right away, so that a later
+	#    --resume can reuse it even if some find_umis chunks fail
+	#    returns the list of chunk files
+	if isinstance(chunks, ChunkWriter):
+		chunks.wait()
+	#make sure the streaming QC steps (if any) also exited cleanly
+	finishPipeline()
+	if isinstance(chunks, ChunkWriter):
+		checkpoint(stage).record( "chunks", fingerprint, chunks.files )
+		chunks = [ chunks.templates[0] % i for i in range(1, chunks.count+1) ]
+	return chunks
+
+
+def runFindUmis(chunks, fileformat, stem, opts, stage, jobName, splitStage, splitPrint, pe=False, revcomp=False):
+	#call find_umis either on cluster or locally, skipping chunks that were finished by
+	#    a previous attempt (if resuming)
+	#    local workers start on each chunk as soon as it has been written
+	#    the split is recorded (see finishSplit) as soon as the chunker is done
+	check = checkpoint(stage)
+	if not arguments['--resume']:
+		check.reset()
+
+	def todo(chunkFiles):
+		for c in chunkFiles:
+			if not check.done( os.path.splitext(os.path.basename(c))[0], file_fingerprint(c) ):
+				yield c
 
+	if arguments['--cluster']:
+		chunks = finishSplit( splitStage, chunks, splitPrint )
+		todoList = list( todo(chunks) )
+		if len(todoList) > 0:
+			#job array indices are mapped to the chunks that still need to be done
+			with open("%s/%s.todo"%(prj_tree.preprocess, jobName), 'w') as handle:
+				handle.write( "".join( "%s\n" % c for c in todoList ) )
+			with open("%s/%s.sh"%(prj_tree.preprocess, jobName), 'w') as jobHandle:
+				jobHandle.write(f"#!/bin/bash\n#$ -N {jobName}\n#$-cwd\nCHUNK=`sed -n \"${{SGE_TASK_ID}}p\" {prj_tree.preprocess}/{jobName}.todo`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/find_umis.py $CHUNK {fileformat} {opts} --checkpoint {check.directory}\n\n")
+			subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%len(todoList), "%s/%s.sh"%(prj_tree.preprocess, jobName)])
+	else:
+		pool = Pool(arguments['--threads'], initializer=init_umi_worker, initargs=(arguments, fileformat, pe, revcomp, stem, arguments['--partitions'], check.directory))
+		jobs = [ (c, pool.apply_async(umi_worker, (c,))) for c in todo(chunks) ]
+		#the chunker has finished once all of its chunks have been handed out
+		chunks = finishSplit( splitStage, chunks, splitPrint )
+		for c, job in jobs:
+			#a chunk that fails is left undone, so it is reported below and redone with --resume
+			try:
+				job.get()
+			except Exception as err:
+				print( "%s: find_umis failed on %s: %s" % (datetime.datetime.now(), c, err), file=sys.stderr )
+				print( "%s: find_umis failed on %s: %s" % (datetime.datetime.now(), c, err), file=logFile )
+		pool.close()
+		pool.join()
 
-def callFinder(num, format, args, stem="chunk"):
-	cmd = f"{SCRIPT_FOLDER}/annotate/find_umis.py  {prj_tree.preprocess}/{stem}{num:04}.{format} {format} {args}"
-	os.system( cmd )
+	failed = list( todo(chunks) )
+	if len(failed) > 0:
+		sys.exit( "Error: %d chunk(s) failed during UMI identification (eg %s). Please check the logs and then restart with --resume." % (len(failed), failed[0]) )
+
+
+def schedulePartitions(stem):
+	#bin-pack the hash partitions into --chunks jobs of roughly equal estimated cost
+	#    and write out a list of partition directories for each
+	#    returns the memory estimate for each chunk
+	costs, nbytes = partition_stats(stem, arguments['--partitions'])
+	chunks = lpt_schedule(costs, arguments['--chunks'])
+	#partitions are loaded one at a time, so memory depends on the biggest one
+	memory = [ memory_estimate( max(nbytes[p] for p in parts) ) for cost, parts in chunks ]
+	chunks, memory = order_chunks(chunks, memory)
+
+	for num, (cost, parts) in enumerate(chunks, 1):
+		with open("%s_chunk%04d.list" % (stem, num), 'w') as handle:
+			handle.write( "".join( "%s_%04d\n" % (stem, p) for p in parts ) )
+
+	return memory
 
 
-def getUmiConsensus(num, minSize, workdir, isCell=False, feature=False, clustType="umi"):
-	if isCell:
-		clustType = "cell"
-	cmd = f"{SCRIPT_FOLDER}/annotate/cluster_umis.py {prj_tree.preprocess}/{clustType}_cons_in_{num:04}.pickle {minSize} {workdir}"
-	if isCell:
-		cmd += " --isCell"
-	elif feature:
-		cmd += " --isFeature"
+def scheduleFamilies(families, stem):
+	#bin-pack families (a dictionary of consensus groups) into --chunks packed files
+	#    (see _packed.py) of roughly equal estimated cost; returns the memory estimate
+	#    for each chunk
+	costs  = { key : family_cost( len(fam['seqs']), sum(len(s) for s in fam['seqs'])/len(fam['seqs']) ) for key, fam in families.items() }
+	chunks = lpt_schedule(costs, arguments['--chunks'])
+
+	memory = []
+	for num, (cost, keys) in enumerate(chunks, 1):
+		write_families( "%s_bin%04d.packed" % (stem, num), [ families[k] for k in keys ] )
+		memory.append( memory_estimate( os.path.getsize("%s_bin%04d.packed" % (stem, num)) ) )
+
+	#renumber so that memory tiers are contiguous and the slowest chunks go first
+	order = sorted( range(len(chunks)), key=lambda i: (memory[i], chunks[i][0]), reverse=True )
+	for num, i in enumerate(order, 1):
+		os.rename( "%s_bin%04d.packed" % (stem, i+1), "%s_chunk%04d.packed" % (stem, num) )
+
+	return [ memory[i] for i in order ]
+
+
+def getUmiConsensus(num, chunkFile, minSize, flags):
+	cmd = f"{SCRIPT_FOLDER}/annotate/cluster_umis.py {chunkFile % ('%04d'%num)} {minSize} {prj_tree.preprocess} {flags}"
 	os.system( cmd )
 
 
+def runConsensus(chunkFile, minSize, flags, memory, jobName, stage):
+	#run cluster_umis on each chunk, either on the cluster or locally, skipping
+	#    chunks that were finished by a previous attempt (if resuming)
+	#    `chunkFile` has a %s where the chunk number goes
+	#    `memory` has the estimated memory requirement of each chunk, in order
+	#    returns the output files
+	check = checkpoint(stage)
+	if not arguments['--resume']:
+		check.reset()
+	flags += f" --fastConsensus {arguments['--fastConsensus']} --checkpoint {check.directory}"
+
+	def finished(num):
+		return check.done( chunkFile % ('%04d'%num), chunk_fingerprint(chunkFile % ('%04d'%num)) )
+	todo = [ num for num in range(1, len(memory)+1) if not finished(num) ]
+
+	if arguments['--cluster']:
+		#h_vmem applies to a whole array job, so submit one array per memory tier
+		#    and map the array indices to the chunks still to be done
+		jobs = []
+		for mem in sorted(set(memory), reverse=True):
+			tier = [ num for num in todo if memory[num-1] == mem ]
+			if len(tier) == 0:
+				continue
+			with open("%s/%s_%dG.todo"%(prj_tree.preprocess, jobName, mem), 'w') as handle:
+				handle.write( "".join( "%d\n" % num for num in tier ) )
+			with open("%s/%s_%dG.sh"%(prj_tree.preprocess, jobName, mem), 'w') as jobHandle:
+				jobHandle.write(f"#!/bin/bash\n#$ -N {jobName}\n#$-l h_vmem={mem}G\n#$-cwd\nNUM=`sed -n \"${{SGE_TASK_ID}}p\" {prj_tree.preprocess}/{jobName}_{mem}G.todo`\nNUM=`printf \"%04d\" $NUM`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/cluster_umis.py {chunkFile % '$NUM'} {minSize} {prj_tree.preprocess} {flags}\n\n")
+			jobs.append( subprocess.Popen([qsub, '-sync', 'y', '-t', "1-%d"%len(tier), "%s/%s_%dG.sh"%(prj_tree.preprocess, jobName, mem)]) )
+		for j in jobs:
+			j.wait()
+	else:
+		#chunks are numbered slowest first, so hand them out one at a time in order
+		partial_cons = partial( getUmiConsensus, chunkFile=chunkFile, minSize=minSize, flags=flags )
+
+		pool = Pool(arguments['--threads'])
+		blob = pool.map( partial_cons, todo, chunksize=1 )
+		pool.close()
+		pool.join()
+
+	failed = [ num for num in range(1, len(memory)+1) if not finished(num) ]
+	if len(failed) > 0:
+		sys.exit( "Error: %d chunk(s) failed during consensus generation (eg %s). Please check the logs and then restart with --resume." % (len(failed), chunkFile % ('%04d'%failed[0])) )
+
+	return [ check.outputs( chunkFile % ('%04d'%num) )[0] for num in range(1, len(memory)+1) ]
+
+
 def processFeatures():
 
 	fileformat = "fastq"
@@ -223,81 +404,40 @@ def processFeatures():
 		fileformat		     = "fasta"
 
 
-	fInd = 0
-	with _open(arguments['--featureLibrary'][0]) as toSplit:
-		splitForID = SeqIO.parse( toSplit, format=fileformat )
-		for chunk in iterator_slice(splitForID, 50000):
-			fInd += 1
-			with open( "%s/features%04d.%s"%(prj_tree.preprocess, fInd, fileformat), 'w' ) as writeChunk:
-				SeqIO.write( chunk, writeChunk, fileformat )
-	#10x PE short read strategy
-	if len(arguments['--featureLibrary']) == 2:
-		ind2 = 0
-		with _open(arguments['--featureLibrary'][1]) as toSplit:
-			splitForID = SeqIO.parse( toSplit, format=fileformat )
-			for chunk in iterator_slice(splitForID, 50000):
-				ind2 += 1
-				with open( "%s/r2features%04d.%s"%(prj_tree.preprocess, fInd, fileformat), 'w' ) as writeChunk:
-					SeqIO.write( chunk, writeChunk, fileformat )
-
-
 	#construct the command for find_umis
-	featureOpts = ""
+	stem = f"{prj_tree.preprocess}/feature_cons_in"
+	featureOpts = f" --stem {stem} --partitions {arguments['--partitions']}"
 	for opt in ['--cell', '--umi', '--r2umi', '--cellWhiteList', '--cellPattern', '--umiWhiteList', '--umiPattern', '--umi2WhiteList', '--umi2Pattern', '--minQ' ]:
 		if arguments[opt] is not None:
 			featureOpts += " %s '%s'" % (opt, arguments[opt])
+	if arguments['--noCorrect']:
+		featureOpts += " --noCorrect"
 	if len(arguments['--featureLibrary']) == 2:
 		featureOpts += " --pe"
 	else:
 		featureOpts += " --revcomp"
 
-	#call find_umis either on cluster or locally
-	if arguments['--cluster']:
-		with open("%s/featuresjob.sh"%prj_tree.preprocess, 'w') as jobHandle:
-			jobHandle.write(f"#!/bin/bash\n#$ -N featureUMIs\n#$-cwd\nNUM=`printf \"%04d\" $SGE_TASK_ID`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/find_umis.py {prj_tree.preprocess}/features$NUM.{fileformat} {fileformat} {featureOpts}\n\n")
-		subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%fInd, "%s/featuresjob.sh"%prj_tree.preprocess])
-	else:
-		partial_finder = partial( callFinder, format=fileformat, args=featureOpts, stem="features" )
-		pool = Pool(arguments['--threads'])
-		pool.map( partial_finder, range(1,fInd+1) )
-		pool.close()
-		pool.join()
+	#split into chunks in the background
+	#    (for the 10x PE short read strategy, R2 is split in lockstep with R1)
+	splitStreams   = [ [ arguments['--featureLibrary'][0] ] ]
+	splitTemplates = [ "%s/features%%04d.%s"%(prj_tree.preprocess, fileformat) ]
+	if len(arguments['--featureLibrary']) == 2:
+		splitStreams.append( [ arguments['--featureLibrary'][1] ] )
+		splitTemplates.append( "%s/r2features%%04d.%s"%(prj_tree.preprocess, fileformat) )
+	splitPrint = combine_fingerprints( *arguments['--featureLibrary'], featureOpts )
+	chunks, reused = splitInputs( "feature_chunks", splitStreams, splitTemplates, fileformat, splitPrint )
 
-	#collect output of find_umis
-	feature_dict = {}
-	pickleFiles = glob.glob(f"{prj_tree.preprocess}/feature*.pickle")
-	for p in pickleFiles:
-		with open(p, 'rb') as pickle_in:
-			chunk_dict = pickle.load(pickle_in)
-			for (cb, mi) in chunk_dict:
-				if (cb, mi) not in feature_dict:
-					feature_dict[ (cb, mi) ] = chunk_dict[ (cb, mi) ].copy()
-				else:
-					feature_dict[ (cb, mi) ]['count'] += chunk_dict[ (cb, mi) ]['count']
-					feature_dict[ (cb, mi) ]['seqs']  += chunk_dict[ (cb, mi) ]['seqs']
-
-	#generate pickles to pass to consensus algorithm
-	dInd = 0
-	for chunk in iterator_slice(feature_dict.values(), 5000):
-		dInd += 1
-		with open( f"{prj_tree.preprocess}/feature_cons_in_{dInd:04}.pickle", 'wb') as pickle_out:
-			pickle.dump( chunk, pickle_out )
-
-	#delete feature_dict to save memory
-	feature_dict = None
-
-	#spawn subprocesses
-	if arguments['--cluster']:
-		with open("%s/featurecons.sh"%prj_tree.preprocess, 'w') as jobHandle:
-			jobHandle.write(f"#!/bin/bash\n#$ -N clusterFeatureUMIs\n#$-l h_vmem=32G\n#$-cwd\nNUM=`printf \"%04d\" $SGE_TASK_ID`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/cluster_umis.py {prj_tree.preprocess}/feature_cons_in_$NUM.pickle {arguments['--minReads']} {prj_tree.preprocess} --isFeature\n\n")
-		subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%dInd, "%s/featurecons.sh"%prj_tree.preprocess])
-	else:
-		partial_cons = partial( getUmiConsensus, minSize=arguments['--minReads'], workdir=prj_tree.preprocess, clustType="feature")
+	#anything left from an earlier attempt is stale if we had to split the input again
+	makePartitions(stem, fresh=not reused)
+	if not reused:
+		checkpoint("feature_find_umis").reset()
 
-		pool = Pool(arguments['--threads'])
-		blob = pool.map( partial_cons, range(1,dInd+1) )
-		pool.close()
-		pool.join()
+	runFindUmis( chunks, fileformat, stem, featureOpts, "feature_find_umis", "featureUMIs", "feature_chunks", splitPrint,
+		     pe=len(arguments['--featureLibrary'])==2, revcomp=len(arguments['--featureLibrary'])!=2 )
+
+	#generate consensus sequences, load-balanced across chunks of partitions
+	memory = schedulePartitions(stem)
+	consensusFiles = runConsensus( stem+"_chunk%s.list", arguments['--minReads'], "--isFeature", memory, "clusterFeatureUMIs", "feature_consensus" )
 
 	#read in feature barcode table
 	hashingSeqs = dict()
@@ -313,29 +453,33 @@ def processFeatures():
 			else:
 				featureSeqs[ row[0] ] = row[1]
 
+	#compile the oligos once so each sequence can be checked in a single pass
+	hashMatcher    = FeatureMatcher( hashingSeqs, mismatches=int(arguments['--featureMismatch']) )
+	featureMatcher = FeatureMatcher( featureSeqs, mismatches=int(arguments['--featureMismatch']) )
+
 	#collect output
 	cellHashes   = defaultdict( dict )
 	cellFeatures = defaultdict( dict )
-	for p in glob.glob(f"{prj_tree.preprocess}/feature_cons_out_*.pickle"):
+	for p in consensusFiles:
 		with open(p, 'rb') as pickle_in:
 			chunk_dict = pickle.load(pickle_in)
 			for c in chunk_dict['results']:
 				for s in chunk_dict['results'][c]['seqs']:
-					for hash in hashingSeqs:
-						if hash in str(s.seq):
-							if hashingSeqs[hash] in cellHashes[c]:
-								cellHashes[ c ][ hashingSeqs[hash] ] += 1
-							else:
-								cellHashes[ c ][ hashingSeqs[hash] ] = 1
-							break
-
-					for oligo in featureSeqs:
-						if oligo in str(s.seq):
-							if featureSeqs[oligo] in cellFeatures[c]:
-								cellFeatures[ c ][ featureSeqs[oligo] ] += 1
-							else:
-								cellFeatures[ c ][ featureSeqs[oligo] ] = 1
-							break
+					seq = str(s)
+
+					sample = hashMatcher.match(seq)
+					if sample is not None:
+						if sample in cellHashes[c]:
+							cellHashes[ c ][ sample ] += 1
+						else:
+							cellHashes[ c ][ sample ] = 1
+
+					feature = featureMatcher.match(seq)
+					if feature is not None:
+						if feature in cellFeatures[c]:
+							cellFeatures[ c ][ feature ] += 1
+						else:
+							cellFeatures[ c ][ feature ] = 1
 
 	if len(hashingSeqs) > 0:
 		with open( f"{prj_tree.tables}/{prj_name}_hashes.tsv", 'w' ) as handle:
@@ -348,7 +492,10 @@ def processFeatures():
 					sample = list(cellHashes[cell].keys())[0]
 				writer.writerow( [cell, sample] )
 
-	if len(featureSeqs) > 0:
+	if len(featureSeqs) > 0 and arguments['--featureFormat'] == "mtx":
+		write_feature_matrix( f"{prj_tree.tables}/{prj_name}_features", sorted(set(featureSeqs.values())),
+				      ( (cell, cellFeatures[cell]) for cell in sorted(cellFeatures.keys()) ) )
+	elif len(featureSeqs) > 0:
 		with open( f"{prj_tree.tables}/{prj_name}_features.tsv", 'w' ) as handle:
 			writer = csv.writer( handle, delimiter="\t", dialect='unix', quoting=csv.QUOTE_NONE)
 			writer.writerow( ["cell_id"] + sorted(featureSeqs.values()) )
@@ -358,6 +505,93 @@ def processFeatures():
 	print(str(datetime.datetime.now()) + " - Finished processing feature barcodes!")
 
 
+def teeStream(source, outFile, stats=None):
+	#copy the QCed reads to their destination (a file or a named pipe being read by
+	#    the chunker) and to vsearch --fastq_stats, if requested
+	with open(outFile, 'wb') as out:
+		for block in iter( lambda: source.read(1<<20), b"" ):
+			out.write(block)
+			if stats is not None:
+				stats.stdin.write(block)
+	if stats is not None:
+		stats.stdin.close()
+
+
+def makeFifo(path):
+	#named pipe for streamQC, replacing anything left at `path` by an earlier run
+	#    (the old files aren't cleaned up with --resume)
+	if os.path.lexists(path):
+		os.remove(path)
+	os.mkfifo(path)
+	fifos.append(path)
+	return path
+
+
+def removeFifos():
+	#named pipes are only good for one run, so don't leave them lying around
+	for path in fifos:
+		if os.path.lexists(path) and stat.S_ISFIFO( os.lstat(path).st_mode ):
+			os.remove(path)
+	fifos.clear()
+
+
+def streamQC(fileNum, inFile, toChunker):
+	#connect the vsearch filter -> merge -> stats steps through named pipes instead
+	#    of writing out (and then reading back) each intermediate fastq file
+	#    returns the path to the QCed reads, which will be a named pipe if they are
+	#    going straight to the chunker; the processes are added to `pipeline`
+	def fifo(name):
+		return makeFifo( "%s/%s" % (prj_tree.preprocess, name) )
+
+	r1 = inFile
+	r2 = arguments['--reverse'][fileNum] if len(arguments['--reverse']) > 0 else None
+
+	if arguments['--filterOptions'] != "None":
+		print("QCing %s" % inFile, file=sys.stderr)
+		filter_options = arguments['--filterOptions'].split(" ")
+		if r2 is None:
+			last = [vsearch, '-fastx_filter', r1, '--fastqout', '-'] + filter_options
+		else:
+			print("QCing %s" % r2, file=sys.stderr)
+			filtered = []
+			for read, name in [ (r1, "r1"), (r2, "r2") ]:
+				filtered.append( fifo("%s_f%d_filtered.fq"%(name,fileNum)) )
+				pipeline.append( subprocess.Popen([vsearch, '-fastx_filter', read, '--fastqout', filtered[-1]] + filter_options, stderr=logFile) )
+			r1, r2 = filtered
+
+	if r2 is not None:
+		merge_options = arguments['--mergeOptions'].split(" ")
+		last = [vsearch, '-fastq_mergepairs', r1, '-reverse', r2, '--fastqout', '-'] + merge_options
+
+	outFile = "%s/f%d_merged.fq"%(prj_tree.preprocess,fileNum) if r2 is not None else "%s/r1_f%d_filtered.fq"%(prj_tree.preprocess,fileNum)
+	if toChunker:
+		makeFifo(outFile)
+
+	stats = None
+	if arguments['--printQC'] is not None:
+		print( "Calculating FastQ stats...", file=sys.stderr)
+		stats = subprocess.Popen([vsearch, '-fastq_stats', '-', '--log', arguments['--printQC']], stdin=subprocess.PIPE, stderr=logFile)
+		pipeline.append( stats )
+
+	source = subprocess.Popen(last, stdout=subprocess.PIPE, stderr=logFile)
+	pipeline.append( source )
+	tee = threading.Thread( target=teeStream, args=(source.stdout, outFile, stats), daemon=True )
+	tee.start()
+	pipeline.append( tee )
+
+	return outFile
+
+
+def finishPipeline():
+	#wait for all of the streaming QC steps to finish
+	for step in pipeline:
+		if isinstance(step, threading.Thread):
+			step.join()
+		elif step.wait() != 0:
+			sys.exit( "Error: %s exited with an error; please see %s for details" % (" ".join(step.args), arguments['--logFile']) )
+	pipeline.clear()
+	removeFifos()
+
 
 def main():
 
@@ -366,7 +600,14 @@ def main():
 
 	processedFiles = []
 
-	for fileNum, inFile in enumerate(arguments['--input']):
+	#if a previous attempt already got as far as splitting the QCed reads into
+	#    chunks for UMI processing, there's no need to redo the QC
+	hasBarcodes = arguments['--cell'] is not None or arguments['--umi'] is not None or arguments['--r2umi'] is not None
+	splitPrint  = combine_fingerprints( *arguments['--input'], *arguments['--reverse'], arguments['--filterOptions'], arguments['--mergeOptions'], arguments['--partitions'],
+					    *[ "%s=%s" % (opt, arguments[opt]) for opt in ['--cell', '--umi', '--r2umi', '--cellWhiteList', '--cellPattern', '--umiWhiteList', '--umiPattern', '--umi2WhiteList', '--umi2Pattern', '--minQ', '--noCorrect'] ] )
+	skipQC      = hasBarcodes and arguments['--resume'] and checkpoint("chunks").done("chunks", splitPrint)
+
+	for fileNum, inFile in enumerate( [] if skipQC else arguments['--input'] ):
 
 		#gzip?
 		if re.search("gz$", inFile):
@@ -392,6 +633,21 @@ def main():
 
 		qc_input = inFile
 
+		#skip files that were already QCed by a previous attempt
+		qcPrint = combine_fingerprints( inFile, arguments['--reverse'][fileNum] if len(arguments['--reverse']) > 0 else None, arguments['--filterOptions'], arguments['--mergeOptions'] )
+		if arguments['--resume'] and checkpoint("qc").done( "f%d"%fileNum, qcPrint ):
+			processedFiles += checkpoint("qc").outputs( "f%d"%fileNum )
+			continue
+
+		#run all of the QC steps as a single pipeline, if requested
+		#    (if the output is going straight to the chunker, there is nothing to checkpoint)
+		if arguments['--stream'] and ( arguments['--filterOptions'] != "None" or len(arguments['--reverse']) > 0 ):
+			processedFiles.append( streamQC(fileNum, inFile, hasBarcodes) )
+			if not hasBarcodes:
+				finishPipeline()
+				checkpoint("qc").record( "f%d"%fileNum, qcPrint, [ processedFiles[-1] ] )
+			continue
+
 		#start by applying filters to R1, if appropriate
 		if arguments['--filterOptions'] != "None":
 			print("QCing %s" % inFile, file=sys.stderr)
@@ -443,12 +699,19 @@ def main():
 		#subprocess.call([vsearch, '-derep_fulllength', qc_input, '-sizeout', '-output', "%s/derep.fa"%prj_tree.preprocess], stderr=logFile)
 
 		processedFiles.append(qc_input)
+		checkpoint("qc").record( "f%d"%fileNum, qcPrint, [ qc_input ] )
 
 	#now start processing for umis as long as at least one is defined
-	if arguments['--cell'] is not None or arguments['--umi'] is not None or arguments['--r2umi'] is not None:
+	if hasBarcodes:
 
 		#split input into managable chunks
-		multiInd = 0
+		#    (if the QC was skipped because the split is being reused, there are no
+		#    QCed files to check, so go by the chunks that were recorded)
+		fileformat = "fastq"
+		if skipQC:
+			recorded = checkpoint("chunks").outputs("chunks")
+			if len(recorded) > 0:
+				fileformat = os.path.splitext(recorded[0])[1].lstrip(".")
 		for myFile in processedFiles:
 			#gzip?
 			if re.search("gz$", myFile):
@@ -457,6 +720,8 @@ def main():
 				_open = partial(open, mode='r')
 
 			fileformat = "fastq"
+			if stat.S_ISFIFO( os.stat(myFile).st_mode ):
+				continue #streamed from vsearch (see streamQC), so always fastq
 			try:
 				with _open(myFile) as checkInput:
 					parser = SeqIO.parse(checkInput, "fastq")
@@ -465,96 +730,65 @@ def main():
 				#fasta input
 				fileformat		     = "fasta"
 
-			with _open(myFile) as toSplit:
-				splitForID = SeqIO.parse( toSplit, format=fileformat )
-				for chunk in iterator_slice(splitForID, 50000):
-					multiInd += 1
-					with open( "%s/chunk%04d.%s"%(prj_tree.preprocess, multiInd, fileformat), 'w' ) as writeChunk:
-						SeqIO.write( chunk, writeChunk, fileformat )
+		#records are copied as-is (no parsing) in a background thread
+		chunks, reused = splitInputs( "chunks", [ processedFiles ], [ "%s/chunk%%04d.%s"%(prj_tree.preprocess, fileformat) ], fileformat, splitPrint )
+		if reused and len(chunks) > 0:
+			fileformat = os.path.splitext(chunks[0])[1].lstrip(".")
+
+		#reads are grouped into hash partitions by (cell, umi) as they are found,
+		#    so that each consensus job only needs to load its own partition
+		#    (anything left from an earlier attempt is stale if we had to split the input again)
+		hasUMIs = arguments['--umi'] is not None or arguments['--r2umi'] is not None
+		stem = "%s/%s_cons_in" % ( prj_tree.preprocess, "umi" if hasUMIs else "cell" )
+		makePartitions(stem, fresh=not reused)
+		if not reused:
+			checkpoint("find_umis").reset()
 
 		#construct the command for find_umis
-		umiOpts = ""
+		umiOpts = f" --stem {stem} --partitions {arguments['--partitions']}"
 		for opt in ['--cell', '--umi', '--r2umi', '--cellWhiteList', '--cellPattern', '--umiWhiteList', '--umiPattern', '--umi2WhiteList', '--umi2Pattern', '--minQ' ]:
 			if arguments[opt] is not None:
 				umiOpts += " %s '%s'" % (opt, arguments[opt])
+		if arguments['--noCorrect']:
+			umiOpts += " --noCorrect"
 
-		#call find_umis either on cluster or locally
-		if arguments['--cluster']:
-			with open("%s/umijob.sh"%prj_tree.preprocess, 'w') as jobHandle:
-				jobHandle.write(f"#!/bin/bash\n#$ -N findUMIs\n#$-cwd\nNUM=`printf \"%04d\" $SGE_TASK_ID`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/find_umis.py {prj_tree.preprocess}/chunk$NUM.{fileformat} {fileformat} {umiOpts}\n\n")
-			subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%multiInd, "%s/umijob.sh"%prj_tree.preprocess])
-		else:
-			partial_finder = partial( callFinder, format=fileformat, args=umiOpts )
-			pool = Pool(arguments['--threads'])
-			pool.map( partial_finder, range(1,multiInd+1) )
-			pool.close()
-			pool.join()
-
-		#collect output of find_umis
-		umi_dict = {}
-		pickleFiles = glob.glob(f"{prj_tree.preprocess}/chunk*.pickle")
-		random.shuffle( pickleFiles ) #try to keep the load balanced when we split up UMIs for clustering below
-		maxUmiReads = 0 #try to estimate memory requirements for clustering
-		for p in pickleFiles:
-			with open(p, 'rb') as pickle_in:
-				chunk_dict = pickle.load(pickle_in)
-				for (cb, mi) in chunk_dict:
-					if (cb, mi) not in umi_dict:
-						umi_dict[ (cb, mi) ] = chunk_dict[ (cb, mi) ].copy()
-					else:
-						umi_dict[ (cb, mi) ]['count'] += chunk_dict[ (cb, mi) ]['count']
-						umi_dict[ (cb, mi) ]['seqs']  += chunk_dict[ (cb, mi) ]['seqs']
-					if umi_dict[ (cb, mi) ]['count'] > maxUmiReads:
-						maxUmiReads = umi_dict[ (cb, mi) ]['count']
-
-		print("Total: %d sequences in %d UMIs" % ( sum([subdict['count'] for subdict in umi_dict.values()]), len(umi_dict)) )
+		runFindUmis( chunks, fileformat, stem, umiOpts, "find_umis", "findUMIs", "chunks", splitPrint )
+
+		memory = schedulePartitions(stem)
 
 		#if UMIs are present, generate UMI consensus
-		if arguments['--umi'] is not None or arguments['--r2umi'] is not None:
-			#print out some details that might be useful for QC
-			with open("%s/umi_stats.tsv"%prj_tree.logs, 'w') as handle:
-				for cb, mi in umi_dict:
-					handle.write("%s\t%s\t%s\n"%(cb,mi,umi_dict[(cb,mi)]['count']))
-
-			#generate pickles to pass to consensus algorithm
-			uInd = 0
-			for chunk in iterator_slice(umi_dict.values(), 5000):
-				uInd += 1
-				with open( f"{prj_tree.preprocess}/umi_cons_in_{uInd:04}.pickle", 'wb') as pickle_out:
-					pickle.dump( chunk, pickle_out )
-
-			#delete umi_dict to save memory
-			umi_dict = None
-
-			#try to estimate memory requirements
-			memNeeded = 1<<math.ceil( maxUmiReads / 150 ).bit_length()
-			if memNeeded < 8:
-				memNeeded = 8 #no need to go below default allocation
-
-			#spawn subprocesses
-			if arguments['--cluster']:
-				with open("%s/umicons.sh"%prj_tree.preprocess, 'w') as jobHandle:
-					jobHandle.write(f"#!/bin/bash\n#$ -N clusterUMIs\n#$-l h_vmem={memNeeded}G\n#$-cwd\nNUM=`printf \"%04d\" $SGE_TASK_ID`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/cluster_umis.py {prj_tree.preprocess}/umi_cons_in_$NUM.pickle {arguments['--minReads']} {prj_tree.preprocess} --isFeature\n\n")
-				subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%uInd, "%s/umicons.sh"%prj_tree.preprocess])
-			else:
-				partial_cons = partial( getUmiConsensus, minSize=arguments['--minReads'], workdir=prj_tree.preprocess, feature=True)
+		if hasUMIs:
 
-				pool = Pool(arguments['--threads'])
-				blob = pool.map( partial_cons, range(1,uInd+1) )
-				pool.close()
-				pool.join()
+			#generate consensus sequences, load-balanced across chunks of partitions
+			#    without cell barcodes, a UMI with more than one big cluster is most
+			#    likely a collision, so keep them all as separate molecules
+			umiFlags = "--isFeature" if arguments['--cell'] is not None else "--isFeature --splitCollisions"
+			consensusFiles = runConsensus( stem+"_chunk%s.list", arguments['--minReads'], umiFlags, memory, "clusterUMIs", "umi_consensus" )
 
 			#collect output
 			reps  = list()
 			cells = defaultdict( dict )
 			small = 0
 			multi = 0
+			collisions = 0
+			numReads = 0
+			numUMIs  = 0
+			allGroups = []
 
-			for p in glob.glob(f"{prj_tree.preprocess}/umi_cons_out_*.pickle"):
+			#print out some details that might be useful for QC
+			statHandle = open("%s/umi_stats.tsv"%prj_tree.logs, 'w')
+
+			for p in consensusFiles:
 				with open(p, 'rb') as pickle_in:
 					chunk_dict = pickle.load(pickle_in)
 					small += chunk_dict['small']
 					multi += chunk_dict['multi']
+					collisions += chunk_dict['collisions']
+					allGroups  += chunk_dict['groups']
+					for cb, mi, count in chunk_dict['groups']:
+						statHandle.write("%s\t%s\t%s\n"%(cb,mi,count))
+						numReads += count
+						numUMIs  += 1
 					for c in chunk_dict['results']:
 						if c in cells:
 							cells[c]['count'] += chunk_dict['results'][c]['count']
@@ -563,42 +797,37 @@ def main():
 							cells[c].update( chunk_dict['results'][c] )
 						reps  += chunk_dict['results'][c]['seqs']
 
+			statHandle.close()
+			print("Total: %d sequences in %d UMIs" % (numReads, numUMIs) )
+
+			#UMIs only: merge UMIs that are errors of a more abundant UMI
+			if arguments['--cell'] is None:
+				reps, merged = merge_error_umis( reps, allGroups, arguments['--umiDistance'] )
+				print( "UMIs merged into a more abundant UMI: %d\nUMIs split into multiple molecules: %d" % (merged, collisions), file=sys.stderr )
+				print( "UMIs merged into a more abundant UMI: %d\nUMIs split into multiple molecules: %d" % (merged, collisions), file=logFile )
+
 			print(datetime.datetime.now())
 			print( "UMIs saved: %d (in %d cells)\nUMIs with fewer than %d reads: %d\nUMIs with multiple clusters:%d\n\n" % (len(reps),len(cells), arguments['--minReads'],small,multi), file=sys.stderr )
 			print( "UMIs saved: %d (in %d cells)\nUMIs with fewer than %d reads: %d\nUMIs with multiple clusters:%d\n\n" % (len(reps),len(cells), arguments['--minReads'],small,multi), file=logFile )
 
 			#write output
 			with open( arguments['--umiOutput'], "w" ) as handle:
-				SeqIO.write( reps, handle, "fasta" )
+				write_reads( reps, handle )
 
 			#now do cell barcodes, if present
 			if arguments['--cell'] is not None:
 
-				#generate pickles to pass to consensus algorithm
-				cInd = 0
-				for chunk in iterator_slice(cells.values(), 5000):
-					cInd += 1
-					with open( f"{prj_tree.preprocess}/cell_cons_in_{cInd:04}.pickle", 'wb') as pickle_out:
-						pickle.dump( chunk, pickle_out )
-
-				#spawn subprocesses
-				if arguments['--cluster']:
-					with open("%s/cellcons.sh"%prj_tree.preprocess, 'w') as jobHandle:
-						jobHandle.write(f"#!/bin/bash\n#$ -N clusterCells\n#$-cwd\nNUM=`printf \"%04d\" $SGE_TASK_ID`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/cluster_umis.py {prj_tree.preprocess}/cell_cons_in_$NUM.pickle {arguments['--minUMIs']} {prj_tree.preprocess} --isCell\n\n")
-					subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%cInd, "%s/cellcons.sh"%prj_tree.preprocess])
-				else:
-					partial_cons = partial( getUmiConsensus, minSize=arguments['--minUMIs'], workdir=prj_tree.preprocess, isCell=True)
-
-					pool = Pool(arguments['--threads'])
-					blob = pool.map( partial_cons, range(1,cInd+1) )
-					pool.close()
-					pool.join()
+				#generate pickles to pass to consensus algorithm, balancing the estimated
+				#    cost of each chunk
+				cellStem = f"{prj_tree.preprocess}/cell_cons_in"
+				memory   = scheduleFamilies(cells, cellStem)
+				consensusFiles = runConsensus( cellStem+"_chunk%s.packed", arguments['--minUMIs'], "--isCell", memory, "clusterCells", "cell_consensus" )
 
 				#collect output
 				final_seqs  = list()
 				small = 0
 
-				for p in glob.glob(f"{prj_tree.preprocess}/cell_cons_out_*.pickle"):
+				for p in consensusFiles:
 					with open(p, 'rb') as pickle_in:
 						chunk_dict = pickle.load(pickle_in)
 						small += chunk_dict['small']
@@ -608,50 +837,36 @@ def main():
 				print("%s: %d sequences discarded because they contained fewer than %d UMIs..." % (datetime.datetime.now(), small, arguments['--minUMIs']) , file=sys.stderr)
 				print("%s: %d sequences discarded because they contained fewer than %d UMIs..." % (datetime.datetime.now(), small, arguments['--minUMIs']) , file=logFile)
 				with open( arguments['--cellOutput'], "w" ) as handle:
-					SeqIO.write( final_seqs, handle, "fasta" )
-
-			else:
-				#UMIs only, do dereplication and collision removal
-				pass
+					write_reads( final_seqs, handle )
 
 		else:
 			#no UMIs present, only cell barcodes
 			#in this case, minUMIs effectively replaces minReads
 
-			#generate pickles to pass to consensus algorithm
-			cInd = 0
-			for chunk in iterator_slice(umi_dict.values(), 5000):
-				cInd += 1
-				with open( f"{prj_tree.preprocess}/cell_cons_in_{cInd:04}.pickle", 'wb') as pickle_out:
-					pickle.dump( chunk, pickle_out )
-
-			#spawn subprocesses
-			if arguments['--cluster']:
-				with open("%s/cellcons.sh"%prj_tree.preprocess, 'w') as jobHandle:
-					jobHandle.write(f"#!/bin/bash\n#$ -N clusterCells\n#$-cwd\nNUM=`printf \"%04d\" $SGE_TASK_ID`\n\nmodule load Biopython/1.73-foss-2016b-Python-3.6.7\n\n{SCRIPT_FOLDER}/annotate/cluster_umis.py {prj_tree.preprocess}/cell_cons_in_$NUM.pickle {arguments['--minUMIs']} {prj_tree.preprocess} --isCell\n\n")
-				subprocess.call([qsub, '-sync', 'y', '-t', "1-%d"%cInd, "%s/cellcons.sh"%prj_tree.preprocess])
-			else:
-				partial_cons = partial( getUmiConsensus, minSize=arguments['--minUMIs'], workdir=prj_tree.preprocess, isCell=True)
-				pool = Pool(arguments['--threads'])
-				blob = pool.map( partial_cons, range(1,cInd+1) )
-				pool.close()
-				pool.join()
+			#generate consensus sequences, load-balanced across chunks of partitions
+			consensusFiles = runConsensus( stem+"_chunk%s.list", arguments['--minUMIs'], "--isCell", memory, "clusterCells", "cell_consensus" )
 
 			#collect output
 			final_seqs  = list()
 			small = 0
+			numReads = 0
+			numCells = 0
 
-			for p in glob.glob(f"{prj_tree.preprocess}/cell_cons_out_*.pickle"):
+			for p in consensusFiles:
 				with open(p, 'rb') as pickle_in:
 					chunk_dict = pickle.load(pickle_in)
 					small += chunk_dict['small']
+					numReads += sum( g[2] for g in chunk_dict['groups'] )
+					numCells += len( chunk_dict['groups'] )
 					for c in chunk_dict['results']:
 						final_seqs  += chunk_dict['results'][c]['seqs']
 
+			print("Total: %d sequences in %d cells" % (numReads, numCells) )
+
 			print("%s: %d sequences discarded because they contained fewer than %d reads..." % (datetime.datetime.now(), small, arguments['--minUMIs']), file=sys.stderr)
 			print("%s: %d sequences discarded because they contained fewer than %d reads..." % (datetime.datetime.now(), small, arguments['--minUMIs']), file=logFile)
 			with open( arguments['--cellOutput'], "w" ) as handle:
-				SeqIO.write( final_seqs, handle, "fasta" )
+				write_reads( final_seqs, handle )
 
 	else:
 		#anything special to do if there are no UMIs/barcodes at all?
@@ -705,10 +920,20 @@ if __name__ == '__main__':
 
 	arguments = docopt(__doc__)
 
+	pipeline = []
+	fifos    = []
+	atexit.register( removeFifos )
+
 	arguments['--minQ']     = int( arguments['--minQ'] )
 	arguments['--minReads'] = int( arguments['--minReads'] )
 	arguments['--minUMIs']	= int( arguments['--minUMIs'] )
 	arguments['--threads']  = int( arguments['--threads'] )
+	arguments['--partitions'] = int( arguments['--partitions'] )
+	arguments['--chunks']     = int( arguments['--chunks'] )
+	arguments['--umiDistance'] = int( arguments['--umiDistance'] )
+
+	if arguments['--featureFormat'] not in ["tsv", "mtx"]:
+		sys.exit("Error: --featureFormat must be either 'tsv' or 'mtx'")
 
 	if arguments['--cluster']:
 		if not clusterExists:
@@ -732,7 +957,7 @@ if __name__ == '__main__':
 	prj_name = fullpath2last_folder(prj_tree.home)
 
 	old_files = glob.glob("%s/*"%prj_tree.preprocess) + glob.glob("byUMI.fa") + glob.glob("byCell.fa")
-	if len(old_files) > 0:
+	if len(old_files) > 0 and not arguments['--resume']:
 		if arguments['-f']:
 			print("Cleaning up old files...",file=sys.stderr)
 			for f in old_files:
@@ -747,38 +972,12 @@ if __name__ == '__main__':
 	#log command line
 	logCmdLine(sys.argv)
 
-	iupac = { "A":"A", "C":"C", "G":"G", "T":"[UT]", "U":"[UT]", "M":"[AC]", "R":"[AG]", "W":"[AT]", "S":"[CG]", "Y":"[CT]", "K":"[GT]", "V":"[ACG]", "H":"[ACT]", "D":"[AGT]", "B":"[CGT]", "N":"[ACGTU]" }
-	cellWhiteList = []
-	umiWhiteList  = []
-	umi2WhiteList = []
-	if arguments['--cellWhiteList'] is not None:
-		if re.search("gz$", arguments['--cellWhiteList']):
-			_open = partial(gzip.open,mode='rt')
-		else:
-			_open = partial(open, mode='r')
-		with _open(arguments['--cellWhiteList']) as codes:
-#		with open(arguments['--cellWhiteList'], "r") as codes:
-			for bc in codes.readlines():
-				cellWhiteList.append(bc.strip())
-	elif arguments['--cellPattern'] is not None:
-		arguments['--cellPattern'] = re.sub("\w", lambda x: iupac[x.group().upper()], arguments['--cellPattern'])
-
-	if arguments['--umiWhiteList'] is not None:
-		with open(arguments['--umiWhiteList'], "r") as codes:
-			for bc in codes.readlines():
-				umiWhiteList.append(bc.strip())
-	elif arguments['--umiPattern'] is not None:
-		arguments['--umiPattern'] = re.sub("\w", lambda x: iupac[x.group().upper()], arguments['--umiPattern'])
-
-	if arguments['--umi2WhiteList'] is not None:
-		with open(arguments['--umi2WhiteList'], "r") as codes:
-			for bc in codes.readlines():
-				umi2WhiteList.append(bc.strip())
-	elif arguments['--umi2Pattern'] is not None:
-		arguments['--umi2Pattern'] = re.sub("\w", lambda x: iupac[x.group().upper()], arguments['--umi2Pattern'])
-
+	#whitelists and patterns are loaded by the find_umis workers (see _umis.py)
+	for whitelist in [ arguments['--cellWhiteList'], arguments['--umiWhiteList'], arguments['--umi2WhiteList'] ]:
+		if whitelist is not None and not os.path.isfile(whitelist):
+			sys.exit( "Can't find whitelist file %s" % whitelist )
 
 	#open the logfile
-	logFile = open( arguments['--logFile'], "w" )
+	logFile = open( arguments['--logFile'], "a" if arguments['--resume'] else "w" )
 
 	main()
@@ -27,11 +27,26 @@ Options:
 			                 multiple times. By default, uses all FASTA/FASTQ files (those
 			                 with extensions of .fa, .fas, .fst, .fasta, .fna, .fq, or
 			                 .fastq) in the root project directory.
-    --derep              Flag to dereplicate input sequences using vsearch prior to 
-                             processing for blast. The number of reads supporting each
-                             sequence will be saved and output as "duplicate_count."
-                             Results will also be available in 
-                             work/internal/derepAllRawSeqs.uc [default: False]
+    --derep              Flag to dereplicate input sequences prior to processing for
+                             blast. The number of reads supporting each sequence will
+                             be saved and output as "duplicate_count." The number of
+                             copies of each sequence in each input file will also be
+                             saved in work/internal/derep_sources.txt [default: False]
+    --derepBuffer <2000000>  Maximum number of unique sequences to hold in memory while
+                             dereplicating; beyond this, they are sorted and spilled to
+                             disk and merged at the end. Does not change the output:
+                             unique sequences are always numbered from most to least
+                             abundant, as with vsearch. [default: 2000000]
+    --cache DIR          Directory holding a cache of germline BLAST hits, which can be
+                             shared across runs and samples. Reads that have already
+                             been searched against the same germline libraries are
+                             answered from the cache instead of being sent to BLAST,
+                             and new results are added to it by 1.2 and 1.3.
+    --engine blast       How to find V (and, in 1.2, J) genes: `blast` searches every
+                             read with blastn; `kmer` first tries a built-in k-mer
+                             index of the germline library, which is much faster,
+                             and only sends reads to BLAST if it can't make a
+                             clear call. [default: blast]
     --cluster            Flag to indicate that blast jobs should be submitted to the
                              SGE cluster. Throws an error if presence of a cluster was
                              not indicated during setup. [default: False]
@@ -44,6 +59,10 @@ Options:
     -f                   Force new analysis and overwrite existing working directories.
                              [default: False]
     --qual		         CURRENTLY DEPRECATED! Use PHRED scores for QC. [default: False]
+    --stream             Flag to leave V gene blast to 1.2, which pipes each chunk through
+                             blastn and starts on the J genes as the V hits come
+                             back, instead of writing them all out first. Local runs
+                             only; implies --runJBlast. [default: False]
     --runJBlast          Flag to call 1.2 script when finished. Additional options to that
                              script (including the ability to automatically call 1.3 and
                              further scripts in Module 1) are listed below. This script
@@ -82,6 +101,11 @@ Changed definition of forcing a new analysis to avoid clobbering
 Added checks to pull cell/umi information through annotate module by CA Schramm 2019-03-01.
 Updated how Module 1 scripts chain together by CA Schramm 2019-04-01.
 Added species option by CAS 2020-02-06.
+Dereplicate in-process instead of writing the reads out for vsearch.
+Added a cache of germline hits shared across runs.
+Added option to stream V blast results into 1.2.
+Build and cache a BLAST database for custom libraries instead of using -subject.
+Added k-mer index engine, with BLAST as a fallback.
 
 Copyright (c) 2011-2020 Columbia University and Vaccine Research Center, National
 			 Institutes of Health, USA. All rights reserved.
@@ -105,41 +129,53 @@ except ImportError:
 
 
 
-def getSeqsWithFileName(inFile):
-	#helper function to add source file info to a seqID
-	#  to preserve info through derep
-	filetype = "fasta"
-	if re.search("\.(fq|fastq)$", inFile) is not None:
-		filetype = "fastq"
-	with open(inFile, "r") as handle:
-		for entry in SeqIO.parse(handle, filetype):
-			entry.id += ";file=%s"%inFile
-			yield entry
+def readInputs():
+	#yield each input read as (id, description, sequence, source file, duplicate count)
+	for eachFile in arguments['--fasta']:
+		for sequence in generate_read_fasta( eachFile ):
+			yield sequence.id, sequence.description, str(sequence.seq), eachFile, None
+
+
+def dereplicate():
+	#collapse identical sequences as they are read in, without writing them out
+	#    for vsearch, and keep track of which file(s) each one was found in
+	derep = Dereplicator( folder_tree.internal, arguments['--derepBuffer'] )
+	for eachFile in arguments['--fasta']:
+		for sequence in generate_read_fasta( eachFile ):
+			derep.add( sequence.id, str(sequence.seq), eachFile )
+
+	print( "Dereplicating %d reads..." % derep.reads )
+	with open( "%s/derep_sources.txt" % folder_tree.internal, "w" ) as handle:
+		sources = csv.writer(handle, delimiter=sep, dialect='unix', quoting=csv.QUOTE_NONE)
+		for seqID, sequence, count, files in derep:
+			for f, n in files.items():
+				sources.writerow( [ seqID, f, n ] )
+			#the first file it was seen in goes into the lookup table
+			yield seqID, "", sequence, next(iter(files)), count
 
 
 
+def kmerAssign(f_ind):
+	#take the reads the k-mer index is sure of out of a chunk before it goes to blast
+	return split_chunk( kmerIndex, "%s/%s_%03d.fasta" % (folder_tree.vgene, prj_name, f_ind),
+			    "%s/kmer_%03d.fasta" % (folder_tree.vgene, f_ind), "%s/kmer_%03d.txt" % (folder_tree.vgene, f_ind),
+			    hits=10, minBits=KMER_V_BITS )
+
+
 def main():
 
 	#if no input files were specified, glob up everything
 	if len(arguments['--fasta'])==0: arguments['--fasta'] = glob.glob("*.fa") + glob.glob("*.fas") + glob.glob("*.fst") + glob.glob("*.fasta") + glob.glob("*.fna") + glob.glob("*.fq") + glob.glob("*.fastq")
 
 	#dereplicate?
+	#    unique sequences go straight into the blast chunks
 	if arguments['--derep']:
-		with open( "%s/tempForDerep.fa"%folder_tree.internal, "w" ) as tempFile:
-			for myFile in arguments['--fasta']:
-				SeqIO.write( getSeqsWithFileName(myFile), tempFile, "fasta" )
-
-		subprocess.call( [ vsearch, "-derep_fulllength", "%s/tempForDerep.fa"%folder_tree.internal,
-				   "-output", "%s/temp_derep.fa"%folder_tree.internal,
-				   "-uc", "derepAllRawSeqs.uc",
-				   "-sizein", "-sizeout" ] )
-
-		arguments['--fasta'] = [ "%s/temp_derep.fa"%folder_tree.internal ]
-		os.remove( "%s/tempForDerep.fa"%folder_tree.internal )
-				
+		inputReads = dereplicate()
+	else:
+		inputReads = readInputs()
 
 	#initiate counters
-	total, total_good, f_ind = 0, 0, 1
+	total, total_good, cached, f_ind = 0, 0, 0, 1
 
 	
 	# open output files
@@ -147,6 +183,12 @@ def main():
 	id_handle = open("%s/lookup_%03d.txt"  % (folder_tree.internal, f_ind),	      'w')
 	id_map	  = csv.writer(id_handle, delimiter=sep, dialect='unix', quoting=csv.QUOTE_NONE)
 
+	#reads found in the hit cache go to a separate file, along with their hits,
+	#    instead of to blast
+	if hitCache is not None:
+		cachedFasta = open("%s/cached_%03d.fasta" % (folder_tree.vgene, f_ind), 'w')
+		cachedHits  = open("%s/cached_%03d.txt"   % (folder_tree.vgene, f_ind), 'w')
+
 
 	#if we decide to use quals for something, can add this block back in
 	'''
@@ -157,79 +199,100 @@ def main():
 
 
 	#iterate over input and split for blast
-	for eachFile in arguments['--fasta']:
-		for sequence in generate_read_fasta( eachFile ):
-
-			sourceFile = eachFile
-			fromDerep  = re.search(";file=([^;\s]+)", sequence.id)
-			if fromDerep:
-				sourceFile = fromDerep.group(1)
-
-			dup_count = "NA"
-			cell_name = "NA"
-			con_count = "NA"
-			checkSize = re.search(";size=(\d+)", sequence.id)
-			if checkSize:
-				dup_count = checkSize.group(1)
+	for seqID, description, sequence, sourceFile, derepCount in inputReads:
+
+		dup_count = "NA"
+		cell_name = "NA"
+		con_count = "NA"
+		checkSize = re.search(";size=(\d+)", seqID)
+		if derepCount is not None:
+			dup_count = str(derepCount)
+		elif checkSize:
+			dup_count = checkSize.group(1)
+		else:
+			#do these separately in case things are coming from older versions of 1.0
+			findCell  = re.search("cell_id=(\S+)", description)
+			if findCell:  cell_name = findCell.group(1)
+			findUMIs  = re.search("(?:duplicate_count|umi_count)=(\d+)", description)
+			if findUMIs:  dup_count = findUMIs.group(1)
+			findReads = re.search("(?:consensus_count|total_reads)=(\d+)", description)
+			if findReads: con_count = findReads.group(1)
+			
+		total += 1
+		id_map.writerow([ "%08d"%total, sourceFile, seqID, len(sequence), dup_count, con_count, cell_name])
+
+		if arguments['--minl'] <= len(sequence) <= arguments['--maxl']:
+			total_good += 1
+			hits = None if hitCache is None else hitCache.get(sequence, vLibrary)
+			if hits is None:
+				fasta.write(">%08d\n%s\n" % (total, sequence))
 			else:
-				#do these separately in case things are coming from older versions of 1.0
-				findCell  = re.search("cell_id=(\S+)", sequence.description)
-				if findCell:  cell_name = findCell.group(1)
-				findUMIs  = re.search("(?:duplicate_count|umi_count)=(\d+)", sequence.description)
-				if findUMIs:  dup_count = findUMIs.group(1)
-				findReads = re.search("(?:consensus_count|total_reads)=(\d+)", sequence.description)
-				if findReads: con_count = findReads.group(1)
-				
-			total += 1
-			id_map.writerow([ "%08d"%total, sourceFile, re.sub(";file=.+","",sequence.id), len(sequence.seq), dup_count, con_count, cell_name])
-
-			if arguments['--minl'] <= len(sequence.seq) <= arguments['--maxl']:
-				total_good += 1
-				fasta.write(">%08d\n%s\n" % (total, sequence.seq))
-
-				#uncomment to re-implement quals
+				cached += 1
+				cachedFasta.write(">%08d\n%s\n" % (total, sequence))
+				write_hits(cachedHits, "%08d"%total, hits['V'])
+
+			#uncomment to re-implement quals
+			'''
+			if arguments['--qual']:
+			if re.search("\.(fq|fastq)$", file_name) is None:
+				myqual = qual_generator.next()
+			qual.write(">%08d\n%s\n" % (total, " ".join(map(str, myqual.qual_list))))
+			'''
+
+			if total_good % arguments['--npf'] == 0: 
+				#close old output files, open new ones, and print progress message
+				fasta.close()
+				f_ind += 1
+				fasta = open("%s/%s_%03d.fasta" % (folder_tree.vgene, prj_name, f_ind), 'w')
+				print( "%d processed, %d good; starting file %s_%03d" %(total, total_good, prj_name, f_ind) )
+
+				id_handle.close()
+				id_handle = open("%s/lookup_%03d.txt"  % (folder_tree.internal, f_ind),	      'w')
+				id_map	  = csv.writer(id_handle, delimiter=sep, dialect='unix', quoting=csv.QUOTE_NONE)
+
+				if hitCache is not None:
+					cachedFasta.close()
+					cachedHits.close()
+					cachedFasta = open("%s/cached_%03d.fasta" % (folder_tree.vgene, f_ind), 'w')
+					cachedHits  = open("%s/cached_%03d.txt"   % (folder_tree.vgene, f_ind), 'w')
+
 				'''
 				if arguments['--qual']:
-				if re.search("\.(fq|fastq)$", file_name) is None:
-					myqual = qual_generator.next()
-				qual.write(">%08d\n%s\n" % (total, " ".join(map(str, myqual.qual_list))))
+				qual.close()
+				qual = open("%s/%s_%03d.qual"%(folder_tree.vgene, prj_name, f_ind), 'w')
 				'''
-
-				if total_good % arguments['--npf'] == 0: 
-					#close old output files, open new ones, and print progress message
-					fasta.close()
-					f_ind += 1
-					fasta = open("%s/%s_%03d.fasta" % (folder_tree.vgene, prj_name, f_ind), 'w')
-					print( "%d processed, %d good; starting file %s_%03d" %(total, total_good, prj_name, f_ind) )
-
-					id_handle.close()
-					id_handle = open("%s/lookup_%03d.txt"  % (folder_tree.internal, f_ind),	      'w')
-					id_map	  = csv.writer(id_handle, delimiter=sep, dialect='unix', quoting=csv.QUOTE_NONE)
-
-					'''
-					if arguments['--qual']:
-					qual.close()
-					qual = open("%s/%s_%03d.qual"%(folder_tree.vgene, prj_name, f_ind), 'w')
-					'''
-				
+			
 	print( "TOTAL: %d processed, %d good" %(total, total_good) )
 	
 	fasta.close()
 	id_handle.close()
+	if hitCache is not None:
+		cachedFasta.close()
+		cachedHits.close()
+		hitCache.close()
+		print( "%d reads found in the hit cache" % cached )
 	'''
 	if arguments['--qual']:
 		qual.close()
 	'''
 
+	#assign what we can without blast
+	kmer = 0
+	if kmerIndex is not None:
+		kmer_pool = Pool(arguments['--threads'])
+		kmer = sum( kmer_pool.map(kmerAssign, range(1,f_ind+1)) )
+		kmer_pool.close()
+		kmer_pool.join()
+		print( "%d reads assigned by the k-mer index" % kmer )
 
-	#clean up - but leave the uc file, in case we want to track replicates later
-	if arguments['--derep']:
-		os.remove( "%s/temp_derep.fa"%folder_tree.internal )
 
-		
 	#print log message
 	handle = open("%s/1-split.log" % folder_tree.logs, "w")
 	handle.write("total: %d; good: %d; percentile: %f\n" %(total, total_good, float(total_good)/total * 100))
+	if hitCache is not None:
+		handle.write("cached: %d; hit rate: %f\n" %(cached, float(cached)/max(total_good, 1) * 100))
+	if kmerIndex is not None:
+		handle.write("kmer: %d; assigned: %f\n" %(kmer, float(kmer)/max(total_good, 1) * 100))
 	handle.close()
 	
 
@@ -237,12 +300,13 @@ def main():
 	if arguments['--cluster']:
 
 		# write pbs files and auto submit shell script
+		db   = blast_database( arguments['--lib'], blast_cmd )
 		mode = "-db"
-		if not os.path.isfile(arguments['--lib'] + ".nhr"):
+		if not os.path.isfile(db + ".nhr"):
 			mode = "-subject"
-		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", CMD_BLAST % (blast_cmd, mode, arguments['--lib'], 
-									      "%s/%s_$NUM.fasta" % (folder_tree.vgene, prj_name),
-									      "%s/%s_$NUM.txt"	 % (folder_tree.vgene, prj_name), V_BLAST_WORD_SIZE) )
+		query   = "%s/%s_$NUM.fasta" % (folder_tree.vgene, prj_name)
+		output  = "%s/%s_$NUM.txt"   % (folder_tree.vgene, prj_name)
+		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", skip_empty_query( CMD_BLAST % (blast_cmd, mode, db, query, output, V_BLAST_WORD_SIZE), query, output ) )
 		pbs = open("%s/vblast.sh"%folder_tree.vgene, 'w')
 		pbs.write( PBS_STRING%("vBlast-%s"%prj_name, "2G", "2:00:00", "%s 2> %s/%s_$NUM.err"%(command, folder_tree.vgene, prj_name)) )
 		pbs.close()
@@ -253,7 +317,7 @@ def main():
 			check += " --after '%s/annotate/1.2-blast_J.py" % SCRIPT_FOLDER
 			for opt in [ '--jlib', '--dlib', '--clib', '--jmotif', '--nterm', '--file', 
 			             '--min1', '--min2', '--id', '--maxgaps', '--rearrangements',
-				     '--save', '--threads']: 
+				     '--save', '--threads', '--engine']: 
 				if arguments[opt] is not None:
 					check += " %s %s" % (opt, arguments[opt])
 			for flag in ['--cluster', '--noD', '--noC', '--runFinalize', 
@@ -267,6 +331,23 @@ def main():
 		monitor.close()
 		os.system( "%s %s/vmonitor.sh"%(qsub,folder_tree.vgene) )
 
+	elif arguments['--stream']:
+
+		#1.2 will run V blast chunk by chunk as it goes
+		cmd = "%s/annotate/1.2-blast_J.py --streamV" % SCRIPT_FOLDER
+		for opt in [ '--jlib', '--dlib', '--clib', '--jmotif', '--nterm', '--file', 
+		             '--min1', '--min2', '--id', '--maxgaps', '--rearrangements',
+			     '--save', '--threads', '--engine']: 
+			if arguments[opt] is not None:
+				cmd += " %s '%s'" % (opt, arguments[opt])
+		for flag in ['--noD', '--noC', '--runFinalize', 
+	                     '--noclean', '--noFallBack', '--runClustering', '--runCellStatistics']:
+			if arguments[flag]:
+				cmd += " %s" % flag
+
+		print( "Calling 1.2 with command line: %s" % cmd )
+		os.system( cmd )
+
 	else:
 
 		#run locally
@@ -280,7 +361,7 @@ def main():
 			cmd = "%s/annotate/1.2-blast_J.py" % SCRIPT_FOLDER
 			for opt in [ '--jlib', '--dlib', '--clib', '--jmotif', '--nterm', '--file', 
 			             '--min1', '--min2', '--id', '--maxgaps', '--rearrangements',
-				     '--save', '--threads']: 
+				     '--save', '--threads', '--engine']: 
 				if arguments[opt] is not None:
 					cmd += " %s '%s'" % (opt, arguments[opt])
 			for flag in ['--cluster', '--noD', '--noC', '--runFinalize', 
@@ -305,12 +386,18 @@ if __name__ == '__main__':
 	arguments['--npf']     = int(arguments['--npf'])
 	arguments['--minl']    = int(arguments['--minl'])
 	arguments['--maxl']    = int(arguments['--maxl'])
+	arguments['--derepBuffer'] = int(arguments['--derepBuffer'])
+
+	if arguments['--engine'] not in ("blast", "kmer"):
+		sys.exit( "Error: `--engine` must be one of: blast,kmer" )
 	
 	
 	if arguments['--cluster']:
 		arguments['--npf'] = 50000
 		if not clusterExists:
 			sys.exit("Cannot submit jobs to non-existent cluster! Please re-run setup.sh to add support for a cluster\n")
+		if arguments['--stream']:
+			sys.exit("Streaming blast is only available when running locally\n")
 
 	if arguments['--lib'] is not None:
 		arguments['--species'] = 'NA'
@@ -348,5 +435,19 @@ if __name__ == '__main__':
 	handle.write( "%s\n%s\n%s\n" % (arguments['--species'], arguments['--locus'], arguments['--lib']) )
 	handle.close()
 
+	#open hit cache and save its location for 1.2 and 1.3
+	hitCache, vLibrary = None, None
+	if arguments['--cache'] is not None:
+		arguments['--cache'] = os.path.abspath( arguments['--cache'] )
+		hitCache = HitCache( arguments['--cache'] )
+		vLibrary = library_checksum( [ arguments['--lib'] ], "segment=V", "word_size=%d" % V_BLAST_WORD_SIZE, "max_hits=10" )
+		with open( "%s/hit_cache.txt" % folder_tree.internal, "w" ) as handle:
+			handle.write( "%s\n%s\n" % (arguments['--cache'], vLibrary) )
+
+	#build the k-mer index once, to be shared by all the worker processes
+	kmerIndex = None
+	if arguments['--engine'] == "kmer":
+		kmerIndex = KmerIndex( arguments['--lib'], k=11 )
+
 	main()
 
@@ -24,10 +24,20 @@ Options:
     --cluster           Flag to indicate that blast jobs should be submitted to the
                             SGE cluster. Throws an error if presence of a cluster was
                             not indicated during setup. [default: False]
+    --engine blast      `blast` or `kmer`: with `kmer`, J genes are first looked up in a
+                            built-in k-mer index of the J library, and only reads
+                            it can't make a clear call on are sent to BLAST. D and
+                            constant region genes always use BLAST. [default: blast]
     --noD               Flag to indicate that blast jobs should be submitted for a
                             D gene library. [default: False]
     --noC               Flag to indicate that no blast jobs should be submitted for a
                             constant region  gene library. [default: False]
+    --streamV           Flag to indicate that V gene blast has not been run yet (set by
+                            1.1-blast_V.py --stream). Each chunk is piped through blastn,
+                            J queries are cut out as the V hits arrive, and J/D/C blast
+                            for that chunk starts as soon as it is done. With
+                            --runFinalize, each chunk is also parsed as soon as its
+                            searches finish. Local runs only. [default: False]
     --runFinalize       Flag to call 1.3 script when finished. Additional options to that
                             script (including the ability to automatically call 1.4 and
                             1.5) are listed below. This script will not check the validity
@@ -59,16 +69,22 @@ Edited to use Py3 and DocOpt by CAS 2018-08-22
 Updated how Module 1 scripts chain together by CA Schramm 2019-04-01.
 Added default constant region DBs for K and L by CAS 2020-01-02.
 Updated default database look ups to include `--species` from 1.1 by CAS 2020-02-06.
+Use the germline hit cache if one was set up by 1.1.
+Added option to run V blast as a stream, overlapping it with J/D/C blast.
+Schedule streamed chunks step by step, including parsing for 1.3.
+Run local J/D/C searches from one pool, longest first, and log their timings.
+Build and cache a BLAST database for custom libraries instead of using -subject.
+Added k-mer index engine for J genes, with BLAST as a fallback.
+Pick top V hits a block of reads at a time with select_top_hits().
 
 Copyright (c) 2011-2020 Columbia University and Vaccine Research Center, National
                                Institutes of Health, USA. All rights reserved.
 
 """
 
-import sys, os, time
+import sys, os, time, heapq
 from docopt import docopt
 from multiprocessing import Pool
-from functools import partial
 
 try:
 	from SONAR.annotate import *
@@ -78,6 +94,137 @@ except ImportError:
 	from SONAR.annotate import *
 
 
+def trimChunk(f_ind):
+	#cut the 3' end (after the V gene) out of each read in one chunk, to use as the J query
+	#returns counts, top hit rows and germline counts, so chunks can be done in separate processes
+	total, good, cached, kmer = 0, 0, 0, 0
+	tophits, germCounts = [], dict()
+
+	vFasta = "%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind)
+	vBlast = "%s/%s_%03d.txt" % (prj_tree.vgene, prj_name, f_ind)
+
+	if arguments['--streamV'] and os.path.getsize(vFasta) == 0:
+		#everything came from the hit cache
+		open(vBlast, "w").close()
+		rows = []
+	elif arguments['--streamV']:
+		#V blast hasn't been run yet: pipe the reads straight into blastn and take the hits as they come out
+		rows = blastStream( ( (entry.id, str(entry.seq)) for entry in SeqIO.parse(vFasta, "fasta") ), vlib, V_BLAST_WORD_SIZE, output=vBlast )
+	else:
+		rows = csv.reader(open(vBlast, "r"), delimiter=sep)
+
+	#add hits for reads that were found in the cache or by the k-mer index in 1.1
+	#    (blast reports queries in input order, and so do the others, so this keeps reads in order)
+	otherV = existing( "%s/cached_%03d.txt" % (prj_tree.vgene, f_ind), "%s/kmer_%03d.txt" % (prj_tree.vgene, f_ind) )
+	if len(otherV) > 0:
+		rows = heapq.merge( rows, *[ csv.reader(open(f, "r"), delimiter=sep) for f in otherV ], key=lambda row: row[0] if len(row) > 0 else "" )
+
+	hitCache = None
+	if cacheInfo is not None:
+		hitCache   = HitCache( cacheInfo['dir'] )
+		cachedHits = { gene : open("%s/cached%s_%03d.txt" % (prj_tree.jgene, suffix, f_ind), "w") for gene, suffix in [ ("J", ""), ("D", "_D"), ("C", "_C") ] }
+
+	#J queries the k-mer index can't call get their own file, since D/C blast still needs all of them
+	if kmerIndex is not None:
+		jBlastHandle = open("%s/%s_J_%03d.fasta" % (prj_tree.jgene, prj_name, f_ind), "w")
+		kmerHits     = open("%s/kmer_%03d.txt" % (prj_tree.jgene, f_ind), "w")
+
+	reads = chunk_reads( vFasta, "%s/cached_%03d.fasta" % (prj_tree.vgene, f_ind), "%s/kmer_%03d.fasta" % (prj_tree.vgene, f_ind) )
+	with open("%s/%s_%03d.fasta" %(prj_tree.jgene, prj_name, f_ind), "w") as fasta_handle:
+
+		# process each sequence as soon as its top V hit is known (V hits are picked a block of reads at a time)
+		for myV, others, aline, second_match in select_top_hits(rows):
+
+			tophits.append(aline)
+			if len(second_match) > 0:
+				tophits.append(second_match)
+			germCounts[myV.sid] = germCounts.get(myV.sid, 0) + 1
+
+			#skip past reads with no V hit
+			entry = next(reads, None)
+			total += 1
+			while entry is not None and entry.id != myV.qid:
+				entry = next(reads, None)
+				total += 1
+			if entry is None:
+				raise RuntimeError( "Chunk %03d: V hits for %s don't match any of the remaining reads; hits and reads must be in the same order" % (f_ind, myV.qid) )
+
+			if myV.strand == "plus":
+				entry.seq = entry.seq[ myV.qend : ]
+			else:
+				entry.seq = entry.seq[ : myV.qstart -1 ]
+				entry.seq = entry.reverse_complement().seq
+
+			if len(entry.seq) > 30: #can probably be 50...
+				hits = None if hitCache is None else hitCache.get(entry.seq, cacheInfo['J'])
+				if hits is None:
+					fasta_handle.write(">%s\n%s\n" % (entry.id,entry.seq))
+					if kmerIndex is not None:
+						jRows = kmerIndex.assign( entry.id, str(entry.seq).encode(), hits=3, minBits=KMER_J_BITS )
+						if jRows is None:
+							jBlastHandle.write(">%s\n%s\n" % (entry.id,entry.seq))
+						else:
+							kmer += 1
+							for row in jRows:
+								kmerHits.write( "\t".join(row) + "\n" )
+				else:
+					cached += 1
+					for gene, hitRows in hits.items():
+						write_hits(cachedHits[gene], entry.id, hitRows)
+				good += 1
+
+		total += sum( 1 for entry in reads )
+
+	if kmerIndex is not None:
+		jBlastHandle.close()
+		kmerHits.close()
+
+	if hitCache is not None:
+		for handle in cachedHits.values():
+			handle.close()
+		# save the new V results
+		hitCache.store( cacheInfo['V'], ( (entry.id, str(entry.seq)) for entry in SeqIO.parse(vFasta, "fasta") ), { "V" : vBlast } )
+		hitCache.close()
+
+	return total, good, cached, kmer, tophits, germCounts
+
+
+def jdcSearches():
+	#arguments to blastProcess for each of the searches run on the J queries
+	searches = [ ("J", dict( filebase="%s/%s%s_%%03d.fasta"%(prj_tree.jgene, prj_name, jQuery), db=arguments['--jlib'], outbase="%s/%s_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE, hits=3 )) ]
+	if not arguments['--noC']:
+		searches.append( ("C", dict( filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=arguments['--clib'], outbase="%s/%s_C_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE, hits=3, constant=True )) )
+	if not arguments['--noD']:
+		searches.append( ("D", dict( filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=arguments['--dlib'], outbase="%s/%s_D_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE )) )
+	return searches
+
+
+def timedSearch(gene, f_ind, kwargs):
+	#run one J/D/C search and report how long it took
+	start = time.time()
+	blastProcess( f_ind, **kwargs )
+	return gene, f_ind, time.time() - start
+
+
+def writeTimings(timings):
+	#save per-search timings, and summarize them by gene
+	with open("%s/1.2_timings.txt" % prj_tree.logs, "w") as handle:
+		handle.write( "gene\tchunk\tseconds\n" )
+		for gene, f_ind, seconds in sorted( timings, key=lambda t: (t[1], t[0]) ):
+			handle.write( "%s\t%03d\t%.1f\n" % (gene, f_ind, seconds) )
+	for gene in sorted( set( t[0] for t in timings ) ):
+		times = [ t[2] for t in timings if t[0] == gene ]
+		print( "%s searches: %d, total %.1fs, slowest %.1fs" % (gene, len(times), sum(times), max(times)) )
+
+
+def parseChunk(f_ind):
+	#same as 1.3, for when chunks are parsed as soon as their searches are done
+	cmd = "%s/annotate/parse_blast.py --jmotif '%s' --nterm %s --chunk %03d" % \
+						( SCRIPT_FOLDER, jmotif, arguments['--nterm'], f_ind )
+	if arguments['--noFallBack']: cmd += " --noFallBack"
+	os.system( cmd )
+
+
 def main():
 
 	if not glob.glob("%s/%s_*.fasta" % (prj_tree.vgene, prj_name)):
@@ -86,49 +233,52 @@ def main():
 	print( "curating 5'end and strand...." )
 
 	# cut nucleotide sequences from 5'end alignment to germline
-	total, good, f_ind = 0, 0, 1
+	total, good, cached, kmer, f_ind = 0, 0, 0, 0, 0
 	dict_germ_count	= dict()
 
 	topHandle = open("%s/%s_vgerm_tophit.txt" %(prj_tree.tables, prj_name), "w")
 	writer	  = csv.writer(topHandle, delimiter = sep, dialect='unix', quoting=csv.QUOTE_NONE)
 	writer.writerow(PARSED_BLAST_HEADER)
 
-	while os.path.isfile("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind)):
-
-		split_fasta = "%s/%s_%03d.fasta" %(prj_tree.jgene, prj_name, f_ind)
-		fasta_handle = open(split_fasta, "w")
-
-		# parse blast output
-		dict_germ_aln, dict_other_germs, dict_germ_count = get_top_hits( "%s/%s_%03d.txt" % (prj_tree.vgene, prj_name, f_ind), topHitWriter=writer, dict_germ_count=dict_germ_count )
-
-		# process each sequence
-		for entry in SeqIO.parse("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind), "fasta"):
-
-			total += 1
-			if entry.id in dict_germ_aln:
-				if dict_germ_aln[entry.id].strand == "plus":
-					entry.seq = entry.seq[ dict_germ_aln[entry.id].qend : ]
-				else:
-					entry.seq = entry.seq[ : dict_germ_aln[entry.id].qstart -1 ]
-					entry.seq = entry.reverse_complement().seq
+	while os.path.isfile("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind+1)):
+		f_ind += 1
 
-				if len(entry.seq) > 30: #can probably be 50...
-					fasta_handle.write(">%s\n%s\n" % (entry.id,entry.seq))
-					good += 1
+	if arguments['--streamV']:
+		#instead of finishing each stage for every chunk before starting the next,
+		#    start each step of each chunk as soon as the steps it needs are done
+		graph = TaskGraph()
+		for chunk in range(1,f_ind+1):
+			trim     = graph.add( "trim_%03d" % chunk, trimChunk, (chunk,) )
+			searches = [ graph.add( "%s_%03d" % (gene, chunk), timedSearch, (gene, chunk, kwargs), after=[trim] ) for gene, kwargs in jdcSearches() ]
+			if arguments['--runFinalize']:
+				graph.add( "parse_%03d" % chunk, parseChunk, (chunk,), after=searches )
+		done    = graph.run( arguments['--threads'], report=lambda name, result: print( "%s finished" % name ) )
+		results = [ done["trim_%03d" % chunk] for chunk in range(1,f_ind+1) ]
+		writeTimings( [ done["%s_%03d" % (gene, chunk)] for chunk in range(1,f_ind+1) for gene, kwargs in jdcSearches() ] )
+	else:
+		results = map(trimChunk, range(1,f_ind+1))
 
-		fasta_handle.close()
-		f_ind += 1
+	for chunkTotal, chunkGood, chunkCached, chunkKmer, tophits, germCounts in results:
+		writer.writerows(tophits)
+		for gene, count in germCounts.items():
+			dict_germ_count[gene] = dict_germ_count.get(gene, 0) + count
+		total  += chunkTotal
+		good   += chunkGood
+		cached += chunkCached
+		kmer   += chunkKmer
 
 		print( "%d done, %d good..." %(total, good) )
 
-
-	f_ind -= 1 #had to go 1 extra to break while loop, now reset to actual number of files
 	topHandle.close()
 
 
 	#print log message
 	handle = open("%s/1.2.log" % prj_tree.logs, "w")
 	handle.write("total: %d; good: %d\n" %(total, good))
+	if cacheInfo is not None:
+		handle.write("cached: %d; hit rate: %f\n" %(cached, float(cached)/max(good, 1) * 100))
+	if kmerIndex is not None:
+		handle.write("kmer: %d; assigned: %f\n" %(kmer, float(kmer)/max(good, 1) * 100))
 	handle.close()
 
 
@@ -148,12 +298,13 @@ def main():
 
 		# write pbs files and auto submit shell script
 		if not arguments['--noC']:
+			db   = blast_database( arguments['--clib'], blast_cmd )
 			mode = "-db"
-			if not os.path.isfile(arguments['--clib'] + ".nhr"):
+			if not os.path.isfile(db + ".nhr"):
 				mode = "-subject"
-			command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s -perc_identity 100" % ( "%03d", CMD_BLAST % (blast_cmd, mode, arguments['--clib'],
-									      "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name),
-									      "%s/%s_C_$NUM.txt"   % (prj_tree.jgene, prj_name), J_BLAST_WORD_SIZE) )
+			query   = "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name)
+			output  = "%s/%s_C_$NUM.txt" % (prj_tree.jgene, prj_name)
+			command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", skip_empty_query( CMD_BLAST % (blast_cmd, mode, db, query, output, J_BLAST_WORD_SIZE) + " -perc_identity 100", query, output ) )
 			pbs = open("%s/cblast.sh"%prj_tree.jgene, 'w')
 			pbs.write( PBS_STRING%("cBlast-%s"%prj_name, "2G", "1:00:00", "%s 2> %s/%s_C_$NUM.err"%(command, prj_tree.jgene, prj_name)) )
 			pbs.close()
@@ -166,12 +317,13 @@ def main():
 			os.system( "%s %s/cmonitor.sh"%(qsub,prj_tree.jgene) )
 
 		if not arguments['--noD']:
+			db   = blast_database( arguments['--dlib'], blast_cmd )
 			mode = "-db"
-			if not os.path.isfile(arguments['--dlib'] + ".nhr"):
+			if not os.path.isfile(db + ".nhr"):
 				mode = "-subject"
-			command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", CMD_BLAST % (blast_cmd, mode, arguments['--dlib'],
-									      "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name),
-									      "%s/%s_D_$NUM.txt"   % (prj_tree.jgene, prj_name), J_BLAST_WORD_SIZE) )
+			query   = "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name)
+			output  = "%s/%s_D_$NUM.txt" % (prj_tree.jgene, prj_name)
+			command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", skip_empty_query( CMD_BLAST % (blast_cmd, mode, db, query, output, J_BLAST_WORD_SIZE), query, output ) )
 			pbs = open("%s/dblast.sh"%prj_tree.jgene, 'w')
 			pbs.write( PBS_STRING%("dBlast-%s"%prj_name, "2G", "1:00:00", "%s 2> %s/%s_D_$NUM.err"%(command, prj_tree.jgene, prj_name)) )
 			pbs.close()
@@ -184,12 +336,13 @@ def main():
 			os.system( "%s %s/dmonitor.sh"%(qsub,prj_tree.jgene) )
 
 		#now basic J (do last so the holds work properly -at least for the first round)
+		db   = blast_database( arguments['--jlib'], blast_cmd )
 		mode = "-db"
-		if not os.path.isfile(arguments['--jlib'] + ".nhr"):
+		if not os.path.isfile(db + ".nhr"):
 			mode = "-subject"
-		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", CMD_BLAST % (blast_cmd, mode, arguments['--jlib'],
-									      "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name),
-									      "%s/%s_$NUM.txt"	 % (prj_tree.jgene, prj_name), J_BLAST_WORD_SIZE) )
+		query   = "%s/%s%s_$NUM.fasta" % (prj_tree.jgene, prj_name, jQuery)
+		output  = "%s/%s_$NUM.txt"   % (prj_tree.jgene, prj_name)
+		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", skip_empty_query( CMD_BLAST % (blast_cmd, mode, db, query, output, J_BLAST_WORD_SIZE), query, output ) )
 		pbs = open("%s/jblast.sh"%prj_tree.jgene, 'w')
 		pbs.write( PBS_STRING%("jBlast-%s"%prj_name, "2G", "2:00:00", "%s 2> %s/%s_$NUM.err"%(command, prj_tree.jgene, prj_name)) )
 		pbs.close()
@@ -215,26 +368,16 @@ def main():
 
 	else:
 
-		#run locally
-		partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=arguments['--jlib'], outbase="%s/%s_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE, hits=3)
-		blast_pool = Pool(arguments['--threads'])
-		blast_pool.map(partial_blast, range(1,f_ind+1))
-		blast_pool.close()
-		blast_pool.join()
-
-		if not arguments['--noC']:
-			partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=arguments['--clib'], outbase="%s/%s_C_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE, hits=3, constant=True)
-			blast_pool = Pool(arguments['--threads'])
-			blast_pool.map(partial_blast, range(1,f_ind+1))
-			blast_pool.close()
-			blast_pool.join()
-
-		if not arguments['--noD']:
-			partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=arguments['--dlib'], outbase="%s/%s_D_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE)
+		#run locally (already done chunk by chunk if streaming)
+		#all J/D/C searches go through one pool, biggest first, so the short ones fill in at the end
+		if not arguments['--streamV']:
+			searches = [ (gene, chunk, kwargs) for chunk in range(1,f_ind+1) for gene, kwargs in jdcSearches() ]
+			searches.sort( key=lambda s: search_cost( s[2]['filebase'] % s[1], s[2]['db'] ), reverse=True )
 			blast_pool = Pool(arguments['--threads'])
-			blast_pool.map(partial_blast, range(1,f_ind+1))
+			timings = blast_pool.starmap(timedSearch, searches, chunksize=1)
 			blast_pool.close()
 			blast_pool.join()
+			writeTimings(timings)
 
 		if arguments['--runFinalize']:
 			cmd = "%s/annotate/1.3-finalize_assignments.py" % SCRIPT_FOLDER
@@ -246,6 +389,8 @@ def main():
 		             	 '--runClustering', '--runCellStatistics']:
 				if arguments[flag]:
 					cmd += " %s" % flag
+			if arguments['--streamV']:
+				cmd += " --parsed"
 
 			print( "Calling 1.3 with command line: %s" % cmd )
 			os.system( cmd )
@@ -258,9 +403,14 @@ if __name__ == '__main__':
 	arguments = docopt(__doc__)
 	arguments['--threads'] = int(arguments['--threads'])
 
+	if arguments['--engine'] not in ("blast", "kmer"):
+		sys.exit( "Error: `--engine` must be one of: blast,kmer" )
+
 	if arguments['--cluster']:
 		if not clusterExists:
 			sys.exit("Cannot submit jobs to non-existent cluster! Please re-run setup.sh to add support for a cluster\n")
+		if arguments['--streamV']:
+			sys.exit("Streaming V blast is only available when running locally\n")
 
 	#load saved locus information
 	prj_tree	= ProjectFolders(os.getcwd())
@@ -320,5 +470,31 @@ if __name__ == '__main__':
 		handle.write("%s\n" % arguments['--clib'])
 		handle.close()
 
+	# find the germline hit cache, if 1.1 set one up, and save the J/D/C library checksum for 1.3
+	cacheInfo = None
+	if os.path.isfile( "%s/hit_cache.txt" % prj_tree.internal ):
+		with open( "%s/hit_cache.txt" % prj_tree.internal ) as handle:
+			cacheInfo = dict( dir=handle.readline().strip(), V=handle.readline().strip() )
+		#the number of hits reported differs between the cluster and local blast runs,
+		#    and k-mer calls aren't exactly the same as blast's
+		engine = [ "engine=kmer" ] if arguments['--engine'] == "kmer" else []
+		cacheInfo['J'] = library_checksum( [ arguments['--jlib'], None if arguments['--noD'] else arguments['--dlib'], None if arguments['--noC'] else arguments['--clib'] ],
+						   "segment=JDC", "word_size=%d" % J_BLAST_WORD_SIZE, "blast=cluster" if arguments['--cluster'] else "blast=local", *engine )
+		with open( "%s/hit_cache.txt" % prj_tree.internal, 'w' ) as handle:
+			handle.write( "%s\n%s\n%s\n" % (cacheInfo['dir'], cacheInfo['V'], cacheInfo['J']) )
+
+	#settings for parsing chunks here when streaming, matching the 1.3 defaults
+	jmotif = arguments['--jmotif']
+	if arguments['--streamV'] and arguments['--runFinalize']:
+		if jmotif is None:
+			jmotif = default_jmotif(species, locus)
+		if arguments['--nterm'] is None:
+			arguments['--nterm'] = "truncate"
+
+
+	#with the k-mer engine, only the J queries it can't call go to J blast
+	kmerIndex, jQuery = None, ""
+	if arguments['--engine'] == "kmer":
+		kmerIndex, jQuery = KmerIndex( arguments['--jlib'], k=7 ), "_J"
 
 	main()
@@ -35,6 +35,8 @@ Options:
                               SGE cluster. Throws an error if presence of a cluster was
                               not indicated during setup. [default: False]
     --threads <1>         Number of threads to use when running locally. [default: 1]
+    --parsed              Flag to indicate that parse_blast.py has already been run on every
+                              chunk (set by 1.2-blast_J.py --streamV). [default: False]
     --runClustering       Flag to call 1.4 script when finished. Additional options to that
                               script are listed below. This script will not check the validity
                               of options passed downstream, so user beware. [default: False]
@@ -72,6 +74,8 @@ Added species option and updated daisy chaining to 1.4/1.5 by CAS 2020-01-02.
 Added locus consistency checks by CAS 2020-01-02.
 Moved species option to 1.1 and added consistent handling.
 Added `complete_vdj` flag by CAS 2020-07-16.
+Added option to skip parsing chunks that were already parsed by 1.2.
+FASTA outputs are now written by each parse_blast.py chunk and just concatenated here.
 
 Copyright (c) 2011-2020 Columbia University and Vaccine Research Center, National
                                Institutes of Health, USA. All rights reserved.
@@ -82,7 +86,6 @@ Copyright (c) 2011-2020 Columbia University and Vaccine Research Center, Nationa
 import sys, os
 from docopt import docopt
 import airr
-from Bio import Seq
 from multiprocessing import Pool
 from collections import Counter
 
@@ -109,7 +112,11 @@ def main():
 
 	print( "curating junction and 3' end..." )
 
-	if arguments['--cluster']:
+	if arguments['--parsed']:
+		#1.2 already parsed each chunk as soon as its searches finished
+		pass
+
+	elif arguments['--cluster']:
 		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s/annotate/parse_blast.py --jmotif '%s' --nterm %s --chunk $NUM\n" % \
 					( "%03d", SCRIPT_FOLDER, arguments['--jmotif'], arguments['--nterm'] )
 		if arguments['--noFallBack']: command += " --noFallBack"
@@ -127,23 +134,6 @@ def main():
 	#ok, now collect all of the partial outputs and merge them
 	print( "collecting information...")
 
-	#open fasta outputs
-	allV_aa	     = open ("%s/%s_allV.fa"	 % (prj_tree.aa, prj_name), "w" )
-	allV_nt	     = open( "%s/%s_allV.fa"	 % (prj_tree.nt, prj_name), "w" )
-
-	allJ_aa	     = open( "%s/%s_allJ.fa"	 % (prj_tree.aa, prj_name), "w" )
-	allJ_nt	     = open( "%s/%s_allJ.fa"	 % (prj_tree.nt, prj_name), "w" )
-
-	vj_aa	     = open( "%s/%s_goodVJ.fa"	 % (prj_tree.aa, prj_name), "w" )
-	vj_nt	     = open( "%s/%s_goodVJ.fa"	 % (prj_tree.nt, prj_name), "w" )
-
-	good_cdr3_aa = open( "%s/%s_goodCDR3.fa" % (prj_tree.aa, prj_name), "w" )
-	good_cdr3_nt = open( "%s/%s_goodCDR3.fa" % (prj_tree.nt, prj_name), "w" )
-
-	all_cdr3_aa  = open( "%s/%s_allCDR3.fa"	 % (prj_tree.aa, prj_name), "w" )
-	all_cdr3_nt  = open( "%s/%s_allCDR3.fa"	 % (prj_tree.nt, prj_name), "w" )
-
-
 	#also open final rearrangements tsv
 	seq_stats = airr.create_rearrangement( "%s/%s_rearrangements.tsv"%(prj_tree.tables, prj_name), fields=['complete_vdj','vj_in_frame','stop_codon','locus','c_call','junction_length','source_file','source_id','duplicate_count','length_raw','length_trimmed','indels','status','blast_identity','consensus_count','cell_id'])
 
@@ -166,23 +156,19 @@ def main():
 
 
 	#iterate over subset rearrangement files and combine
-	#include generating fasta output as appropriate
 	for f_ind in range(1, maxFiles+1):
 
 		#merge partial blast hit tables
-		with open( "%s/%s_jgerm_tophit.txt" % (prj_tree.tables, prj_name), "a") as table:
-			with open( "%s/jtophit_%03d.txt" % (prj_tree.jgene, f_ind), "r" ) as partial:
-				table.write(partial.read())
+		with open( "%s/%s_jgerm_tophit.txt" % (prj_tree.tables, prj_name), "ab") as table:
+			append_files( [ "%s/jtophit_%03d.txt" % (prj_tree.jgene, f_ind) ], table )
 
 		if d:
-			with open( "%s/%s_dgerm_tophit.txt" % (prj_tree.tables, prj_name), "a") as table:
-				with open( "%s/dtophit_%03d.txt" % (prj_tree.jgene, f_ind), "r" ) as partial:
-					table.write(partial.read())
+			with open( "%s/%s_dgerm_tophit.txt" % (prj_tree.tables, prj_name), "ab") as table:
+				append_files( [ "%s/dtophit_%03d.txt" % (prj_tree.jgene, f_ind) ], table )
 
 		if c:
-			with open( "%s/%s_cgerm_tophit.txt" % (prj_tree.tables, prj_name), "a") as table:
-				with open( "%s/ctophit_%03d.txt" % (prj_tree.jgene, f_ind), "r" ) as partial:
-					table.write(partial.read())
+			with open( "%s/%s_cgerm_tophit.txt" % (prj_tree.tables, prj_name), "ab") as table:
+				append_files( [ "%s/ctophit_%03d.txt" % (prj_tree.jgene, f_ind) ], table )
 
 		#go through partial rearrangements files
 		for r in airr.read_rearrangement( "%s/rearrangements_%03d.tsv"%(prj_tree.internal, f_ind) ):
@@ -205,59 +191,12 @@ def main():
 												# don't have a better solution that isn't super
 												# kludgy right now
 
-			#ok, now do sequence output
-			# start by collecting metadata for fasta def line
-			def_line = ">%s" % r['sequence_id']
-			if not r['v_call'] == '':          def_line += " v_call=%s"          % r['v_call']
-			if not r['d_call'] == '':          def_line += " d_call=%s"          % r['d_call']
-			if not r['j_call'] == '':          def_line += " j_call=%s"          % r['j_call']
-			if not r['locus']  == '':          def_line += " locus=%s"           % r['locus']
-			if not r['c_call'] == '':          def_line += " c_call=%s"          % r['c_call']
-			if not r['status'] == '':          def_line += " status=%s"          % r['status']
-#			if not r['v_identity'] == '':      def_line += " v_identity=%s"      % r['v_identity']
-			if not r['junction_length'] == '': def_line += " junction_length=%s" % r['junction_length']
-			if not r['junction'] == '':        def_line += " junction=%s"        % r['junction']
-			if not r['junction_aa'] == '':     def_line += " junction_aa=%s"     % r['junction_aa']
-			if not r['duplicate_count'] == '': def_line += " duplicate_count=%s" % r['duplicate_count']
-			if not r['consensus_count'] == '': def_line += " consensus_count=%s" % r['consensus_count']
-			if not r['cell_id'] == '':         def_line += " cell_id=%s"         % r['cell_id']
-
-			#work our way up the hierarchy, putting sequences in the appropriate files
-			ungapped = re.sub( "-", "", r['sequence_alignment']) #reintroduces any frameshift errors in translation
-																 #  this has always been the behavior, but I wonder
-																 #  if I should change/update now that I am using
-																 #  proper alignments.
-
-			if not r['status'] in ['noV', 'missingNterm', "chimera"]:
-				allV_nt.write( "%s\n%s\n" % (def_line, ungapped) )
-				allV_aa.write( "%s\n%s\n" % (def_line, Seq.Seq(ungapped).translate()) )
-
-				if not r['status'] == 'noJ':
-					allJ_nt.write( "%s\n%s\n" % (def_line, ungapped) )
-					allJ_aa.write( "%s\n%s\n" % (def_line, Seq.Seq(ungapped).translate()) )
-
-					if not r['status'] == 'noCDR3':
-						all_cdr3_nt.write( "%s\n%s\n" % (def_line, r['junction']) )
-						all_cdr3_aa.write( "%s\n%s\n" % (def_line, r['junction_aa']) )
-
-						if r['status'] == "good":
-							vj_nt.write( "%s\n%s\n" % (def_line, ungapped) )
-							vj_aa.write( "%s\n%s\n" % (def_line, Seq.Seq(ungapped).translate()) )
-							good_cdr3_nt.write( "%s\n%s\n" % (def_line, r['junction']) )
-							good_cdr3_aa.write( "%s\n%s\n" % (def_line, r['junction_aa']) )
-
-
-	#close outputs
-	allV_aa.close()
-	allV_nt.close()
-	allJ_aa.close()
-	allJ_nt.close()
-	vj_aa.close()
-	vj_nt.close()
-	good_cdr3_aa.close()
-	good_cdr3_nt.close()
-	all_cdr3_aa.close()
-	all_cdr3_nt.close()
+
+	#the FASTA outputs were written a chunk at a time by parse_blast.py, so just stick them together
+	for name in FASTA_OUTPUTS:
+		for seqType, folder in [ ("nt", prj_tree.nt), ("aa", prj_tree.aa) ]:
+			with open( "%s/%s_%s.fa" % (folder, prj_name, name), "wb" ) as handle:
+				append_files( [ chunk_fasta(prj_tree.jgene, name, seqType, "%03d" % f_ind) for f_ind in range(1, maxFiles+1) ], handle )
 
 	#useful number
 	found = total - counts['noV'] - counts['noJ'] - counts['chimera']
@@ -347,11 +286,6 @@ if __name__ == '__main__':
 	locus   = handle.readline().strip()
 
 	if arguments['--jmotif'] is None:
-		if species == "NA":
-			#custom library, but default to looking for both motifs
-			sys.stderr.write("Custom gene libraries used but no J motif specified; defaulting to human heavy+light...\n")
-			arguments['--jmotif'] = HU_JHKL_MOTIF
-		else:
-			arguments['--jmotif'] = eval( SUPPORTED_SPECIES[species] + "_J" + locus + "_MOTIF" )
+		arguments['--jmotif'] = default_jmotif(species, locus)
 
 	main()
@@ -37,6 +37,7 @@ Added cell hashing and feature barcoding by CA Schramm 2019-10-16.
 Added cell_status to output and included read/UMI counts from discarded
                  duplicates by CAS 2019-12-26.
 Included nonproductive rearrangments in detection of multiplets by CAS 2020-01-03.
+Read sparse feature barcoding matrices one cell at a time.
 
 Copyright (c) 2019-2020 Vaccine Research Center, National Institutes of Health, USA.
 All rights reserved.
@@ -99,12 +100,17 @@ def main():
 	sampleList += ["unknown", "ambiguous"]
 
 	#look for feature barcoding
+	#    the sparse matrix is read one cell at a time, as needed
 	featureDict = dict()
-	if os.path.exists(f"{prj_tree.tables}/{prj_name}_features.tsv"):
+	featureKeys = []
+	if os.path.isdir(f"{prj_tree.tables}/{prj_name}_features"):
+		featureDict = FeatureMatrix(f"{prj_tree.tables}/{prj_name}_features")
+		featureKeys = featureDict.features
+	elif os.path.exists(f"{prj_tree.tables}/{prj_name}_features.tsv"):
 		with open(f"{prj_tree.tables}/{prj_name}_features.tsv", 'r') as handle:
 			reader = csv.reader(handle, delimiter="\t")
 			header = next(reader)
-			featureDict["keys"] = header[1:]
+			featureKeys = header[1:]
 			for row in reader:
 				featureDict[row[0]] = row[1:]
 
@@ -116,8 +122,8 @@ def main():
 	outheader = ["cell","status","isotype"]
 	if len(hashDict) > 0:
 		outheader += ["hash_sample"]
-	if len(featureDict) > 0:
-		outheader += featureDict["keys"]
+	if len(featureKeys) > 0:
+		outheader += featureKeys
 	outheader += ["productive_IGH","total_IGH","IGH_junctions","productive_IGK","total_IGK","IGK_junctions","productive_IGL","total_IGL","IGL_junctions"]
 	outwriter.writerow(outheader)
 
@@ -215,7 +221,7 @@ def main():
 								cells_only.write( chain )
 
 				#now log the cell
-				outwriter.writerow( [c, status, h_type] + hashDict.get(c,['unknown']*(len(hashDict)>0)) + featureDict.get(c, ['0']*len(featureDict.get("keys",[]))) +
+				outwriter.writerow( [c, status, h_type] + hashDict.get(c,['unknown']*(len(hashDict)>0)) + featureDict.get(c, ['0']*len(featureKeys)) +
 						   [ len(cell_productive[c]['IGH']), len(cell_processed[c]['IGH']), ";".join([chain['junction_aa'] for chain in cell_processed[c]['IGH']]),
 						   len(cell_productive[c]['IGK']), len(cell_processed[c]['IGK']), ";".join([chain['junction_aa'] for chain in cell_processed[c]['IGK']]),
 						   len(cell_productive[c]['IGL']), len(cell_processed[c]['IGL']), ";".join([chain['junction_aa'] for chain in cell_processed[c]['IGL']]) ] )
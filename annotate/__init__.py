@@ -1,7 +1,26 @@
 
 from .. import *
 from Bio.Blast.Applications import NcbiblastnCommandline
-import traceback
+import traceback, itertools, threading
+
+from ._barcodes import *
+from ._chunker import *
+from ._schedule import *
+from ._checkpoint import *
+from ._reads import *
+from ._packed import *
+from ._dedup import *
+from ._derep import *
+from ._cache import *
+from ._dag import *
+from ._germdb import *
+from ._germtable import *
+from ._tophits import *
+from ._kmer import *
+from ._umis import *
+from ._consensus import *
+from ._features import *
+from ._fastaout import *
 
 
 def blastProcess(threadID, filebase, db, outbase, wordSize, hits=10, constant=False):
@@ -9,6 +28,14 @@ def blastProcess(threadID, filebase, db, outbase, wordSize, hits=10, constant=Fa
 	fasta  = filebase % threadID
 	output = outbase  % threadID
 
+	#everything in this chunk may have come from the hit cache
+	if os.path.getsize(fasta) == 0:
+		open(output, 'w').close()
+		return
+
+	#custom libraries get a cached database instead of being searched with -subject
+	db = blast_database( db, blast_cmd )
+
 	print( "Starting blast of %s against %s..." % (fasta, db) )
 
 	if os.path.isfile(db + ".nhr"):
@@ -38,101 +65,77 @@ def blastProcess(threadID, filebase, db, outbase, wordSize, hits=10, constant=Fa
 
 
 
+def blastStream(records, db, wordSize, hits=10, constant=False, output=None):
+	"""
+	run blastn on (id, sequence) pairs fed to it over stdin, yielding tabular hit
+	    rows as blastn writes them to stdout, so that they can be used while the
+	    search is still running
+	`output` optionally saves a copy of the raw hits for later steps
+	raises RuntimeError once the hits have been read if blastn failed
+	"""
+
+	db    = blast_database( db, blast_cmd )
+	cline = [ blast_cmd, "-db" if os.path.isfile(db + ".nhr") else "-subject", db, "-query", "-",
+		  "-outfmt", "6 qseqid sseqid pident length mismatch gaps qstart qend sstart send evalue bitscore sstrand",
+		  "-gapopen", "5", "-gapextend", "2", "-penalty", "-1", "-reward", "1", "-evalue", "1e-3",
+		  "-max_target_seqs", str(hits), "-word_size", str(wordSize) ]
+	if constant:
+		cline += [ "-perc_identity", "100" ]
+
+	blast = subprocess.Popen( cline, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True )
+
+	#feed queries from a separate thread so blastn never blocks on a full pipe in either direction
+	def feed():
+		try:
+			for seqID, seq in records:
+				blast.stdin.write( ">%s\n%s\n" % (seqID, seq) )
+		finally:
+			blast.stdin.close()
+	feeder = threading.Thread( target=feed, daemon=True )
+	feeder.start()
+
+	copy = open(output, 'w') if output is not None else None
+	for line in blast.stdout:
+		if copy is not None:
+			copy.write( line )
+		yield line.rstrip("\n").split("\t")
+
+	feeder.join()
+	blast.wait()
+	if copy is not None:
+		copy.close()
+	if blast.returncode != 0:
+		#otherwise the hits would just look truncated
+		raise RuntimeError( "blastn against %s exited with status %d" % (db, blast.returncode) )
+
+
+def default_jmotif(species, locus):
+	"""conserved J motif to use with the germline libraries chosen in 1.1"""
+	if species == "NA":
+		#custom library, but default to looking for both motifs
+		sys.stderr.write("Custom gene libraries used but no J motif specified; defaulting to human heavy+light...\n")
+		return HU_JHKL_MOTIF
+	return eval( SUPPORTED_SPECIES[species] + "_J" + locus + "_MOTIF" )
+
+
+def skip_empty_query(command, query, output):
+	"""wrap a cluster blast command so that an empty query file (everything came from the hit cache) just leaves an empty output"""
+	return "if [ -s %s ]; then %s; else touch %s; fi" % (query, command, output)
+
+
 def get_top_hits(infile, topHitWriter=None, dict_germ_count=dict(), maxQEnd=dict(), minQStart=dict(), strand=None):
-	"""retrieve top hits from all result files"""
+	"""retrieve top hits from all result files (`infile` may be a list of files)"""
 	
 	dict_germ_aln	 =  dict()
 	dict_other_germs =  dict()
-	old_id		 =  ""
-
 
-	reader = csv.reader(open(infile, "r"), delimiter = sep)
-	for row in reader:
 
-		if len(row) != 13:
-			pass;
+	if isinstance(infile, str):
+		infile = [ infile ]
+	reader = itertools.chain.from_iterable( csv.reader(open(f, "r"), delimiter = sep) for f in infile )
+	for best_alignment, others, aline, second_match in iter_top_hits(reader, maxQEnd, minQStart, strand):
 
-		else:
-			my_alignment = MyAlignment(row)
-
-			#CAS 2020-01-02
-			if strand is not None and not my_alignment.strand == strand:
-				continue
-
-			if my_alignment.qid != old_id:
-				if old_id != "":
-					aline = best_row
-					if len(others)>0:
-						aline.append(",".join(others))
-						dict_other_germs[best_alignment.qid] = others
-
-					if topHitWriter is not None:
-						topHitWriter.writerow(aline)
-						if len(second_match)>0:
-							topHitWriter.writerow(second_match)
-
-					dict_germ_aln[best_alignment.qid] = best_alignment
-
-					if best_alignment.sid not in dict_germ_count:
-						dict_germ_count[best_alignment.sid]	= 0
-					dict_germ_count[best_alignment.sid]		+= 1
-
-						
-				#skips D genes that matched 5' J
-				if my_alignment.qend > maxQEnd.get(my_alignment.qid, 99999):
-					old_id=""
-					continue
-
-				#skips C genes that matched 3' J (not sure if necessary)
-				if my_alignment.qstart < minQStart.get(my_alignment.qid, -1):
-					old_id=""
-					continue
-
-				old_id = my_alignment.qid
-				best_alignment = my_alignment
-				best_row = row
-				others = []
-				second_match = []
-				
-			else:
-				#added 20150107 by CAS
-				'''
-				need three conditions:
-				1. hit is on same gene
-				2. hit is on same strand
-				3. hits are non-overlapping
-				'''
-				if my_alignment.sid == best_alignment.sid and my_alignment.strand == best_alignment.strand and (max(my_alignment.sstart, my_alignment.send)<min(best_alignment.sstart,best_alignment.send) or min(my_alignment.sstart, my_alignment.send)>max(best_alignment.sstart,best_alignment.send)):
-					second_match = row
-					#change boundaries of alignment on both query and hit (to get J properly)
-					if my_alignment.send < best_alignment.sstart:
-						best_alignment.sstart = my_alignment.sstart
-						if best_alignment.strand == "plus":
-							best_alignment.qstart = my_alignment.qstart
-						else:
-							best_alignment.qend = my_alignment.qend
-					else:
-						best_alignment.send = my_alignment.send
-						if best_alignment.strand == "plus":
-							best_alignment.qend = my_alignment.qend
-						else:
-							best_alignment.qstart = my_alignment.qstart
-
-				elif re.match("IG[HKL]J", my_alignment.sid) and my_alignment.score>=35 and my_alignment.qstart<best_alignment.qstart:
-					#a bit of kludge for double J matches. 
-					#Usually these are bad amplicons (or bad assemblies from single cell data)
-					#My assumption is that the one closer to the V is the more reliable one
-					best_alignment = my_alignment
-					best_row = row
-						
-				elif my_alignment.score >= best_alignment.score - 3 and my_alignment.sid.split("*")[0] != best_alignment.sid.split("*")[0] and not any( my_alignment.sid.split("*")[0] == x.split("*")[0] for x in others ):
-					others.append(my_alignment.sid)
-
-	#last line, repeat of what's in the loop
-	if old_id != "":
-		aline = best_row
 		if len(others)>0:
-			aline.append(",".join(others))
 			dict_other_germs[best_alignment.qid] = others
 
 		if topHitWriter is not None:
@@ -0,0 +1,70 @@
+"""
+
+Whitelist lookup for cell barcodes and UMIs. Whitelists are held in a hash set
+    so that exact matches are O(1) per read, and reads whose barcode is a single
+    substitution away from exactly one whitelisted barcode are corrected instead
+    of being discarded.
+
+"""
+
+import gzip, re
+from functools import partial
+
+
+class BarcodeIndex:
+	"""hash set of allowed barcodes plus an index of their single-substitution neighbors"""
+
+	ALPHABET = "ACGTN"
+
+	def __init__(self, barcodes, correct=True):
+		self.whitelist = set(barcodes)
+		self.correct   = correct
+
+		#the full neighbor table for the 10x whitelist would be ~35M keys, so it
+		#    is filled in on demand as new erroneous barcodes are encountered.
+		#    Maps neighbor -> whitelisted barcode (or None if ambiguous/uncorrectable)
+		self.neighbors = dict()
+
+	def __len__(self):
+		return len(self.whitelist)
+
+	def __contains__(self, barcode):
+		return barcode in self.whitelist
+
+	def _find_neighbor(self, barcode):
+		match = None
+		for i, base in enumerate(barcode):
+			for sub in self.ALPHABET:
+				if sub == base:
+					continue
+				candidate = barcode[ :i ] + sub + barcode[ i+1: ]
+				if candidate in self.whitelist:
+					if match is not None:
+						return None #ambiguous, more than one whitelisted neighbor
+					match = candidate
+		return match
+
+	def lookup(self, barcode):
+		"""
+		returns the whitelisted barcode matching `barcode`, correcting a single
+		    mismatch if possible, or None if it should be rejected
+		"""
+		if barcode in self.whitelist:
+			return barcode
+		if not self.correct:
+			return None
+		if barcode not in self.neighbors:
+			self.neighbors[barcode] = self._find_neighbor(barcode)
+		return self.neighbors[barcode]
+
+
+def load_whitelist(whitelist, correct=True):
+	"""load a (possibly gzipped) whitelist with one barcode per line into a BarcodeIndex"""
+
+	if re.search("gz$", whitelist):
+		_open = partial(gzip.open, mode='rt')
+	else:
+		_open = partial(open, mode='r')
+
+	with _open(whitelist) as codes:
+		return BarcodeIndex( (bc.strip().upper() for bc in codes if bc.strip() != ""), correct=correct )
@@ -0,0 +1,126 @@
+"""
+
+Content-addressed cache of germline BLAST hits, shared across runs and
+    samples. Each query sequence is keyed by a hash of its bases plus a
+    checksum of the germline libraries (and search settings) it was run
+    against, and the cache stores the hit rows BLAST reported for it, so that
+    get_top_hits() sees exactly what it would have for a fresh search.
+Queries with no hits are cached too, since "no V gene" is also an answer.
+The cache is a single SQLite file in a user-chosen directory; it should be on
+    a filesystem with working locks if several jobs write to it at once.
+
+"""
+
+import os, csv, json, heapq, sqlite3, hashlib, itertools
+from Bio import SeqIO
+
+from ._checkpoint import combine_fingerprints
+
+
+def sequence_key(sequence):
+	"""hash of a query sequence, ignoring case"""
+	return hashlib.sha1( str(sequence).upper().encode() ).hexdigest()
+
+
+def library_checksum(libraries, *settings):
+	"""
+	checksum of germline libraries (fasta files or BLAST databases) plus any
+	    search settings, given as tagged strings (eg "word_size=7")
+	"""
+	files = [ lib + ".nsq" if lib is not None and not os.path.isfile(lib) and os.path.isfile(lib + ".nsq") else lib for lib in libraries ]
+	#settings are only ever text, so a stray file with the same name can't change the key
+	digest = hashlib.sha1( combine_fingerprints(*files).encode() )
+	for setting in settings:
+		digest.update( str(setting).encode() )
+	return digest.hexdigest()
+
+
+def hit_rows(paths):
+	"""
+	merge one or more tabular BLAST outputs, each in query order (eg a BLAST
+	    output and the cached hits for the same chunk), into one stream of rows
+	"""
+	return heapq.merge( *[ csv.reader(open(p, 'r'), delimiter="\t") for p in paths ], key=lambda row: row[0] if len(row) > 0 else "" )
+
+
+def hit_groups(paths):
+	"""yield (query id, [rows]) from hit_rows(), one query at a time"""
+	for qid, group in itertools.groupby( ( row for row in hit_rows(paths) if len(row) == 13 ), key=lambda row: row[0] ):
+		yield qid, list(group)
+
+
+class QueryStream:
+	"""
+	look up (query id, value) pairs that come in query id order, eg from
+	    hit_groups(), by asking for query ids in the same order
+	only the next pair is held in memory
+	"""
+
+	def __init__(self, pairs):
+		self.pairs   = iter(pairs)
+		self.pending = next( self.pairs, None )
+
+	def get(self, qid, default=None):
+		while self.pending is not None and self.pending[0] < qid:
+			self.pending = next( self.pairs, None )
+		if self.pending is not None and self.pending[0] == qid:
+			return self.pending[1]
+		return default
+
+
+def write_hits(handle, qid, rows):
+	"""write cached hit rows back out in BLAST tabular format, under query id `qid`"""
+	for row in rows:
+		handle.write( "%s\t%s\n" % (qid, "\t".join(row)) )
+
+
+def chunk_reads(fasta, *others):
+	"""
+	yield the reads of one chunk in serial number order, whether they went to
+	    BLAST (`fasta`) or were answered some other way, eg from the cache
+	"""
+	parts = [ SeqIO.parse(f, "fasta") for f in (fasta,) + others if os.path.isfile(f) ]
+	yield from heapq.merge( *parts, key=lambda entry: int(entry.id) )
+
+
+def existing(*paths):
+	"""the subset of `paths` that exist, eg a BLAST output and its cached rows"""
+	return [ p for p in paths if os.path.isfile(p) ]
+
+
+class HitCache:
+	"""SQLite table of {(sequence hash, library checksum): {gene: [hit rows]}}"""
+
+	def __init__(self, directory):
+		os.makedirs(directory, exist_ok=True)
+		self.path = os.path.join( directory, "germline_hits.sqlite" )
+		self.db   = sqlite3.connect( self.path, timeout=600 )
+		self.db.execute( "CREATE TABLE IF NOT EXISTS hits (query TEXT, library TEXT, genes TEXT, PRIMARY KEY (query, library)) WITHOUT ROWID" )
+		self.db.commit()
+
+	def get(self, sequence, library):
+		"""cached hits for `sequence`, as {gene: [rows]}, or None if it hasn't been searched"""
+		found = self.db.execute( "SELECT genes FROM hits WHERE query=? AND library=?", (sequence_key(sequence), library) ).fetchone()
+		if found is None:
+			return None
+		return json.loads( found[0] )
+
+	def store(self, library, queries, outputs):
+		"""
+		add the results of one chunk of searches
+		`queries` yields (query id, sequence) in query id order, and `outputs`
+		    maps each gene (eg V, or J/D/C) to the BLAST output it was
+		    searched into, or to a list of outputs if its hits were split
+		    across several files; everything is read one query at a time
+		"""
+		hits   = { gene : QueryStream( hit_groups( [paths] if isinstance(paths, str) else paths ) ) for gene, paths in outputs.items() }
+		stored = 0
+		with self.db:
+			for qid, sequence in queries:
+				genes = { gene : [ row[ 1: ] for row in hits[gene].get(qid, []) ] for gene in hits }
+				self.db.execute( "INSERT OR REPLACE INTO hits VALUES (?, ?, ?)", (sequence_key(sequence), library, json.dumps(genes)) )
+				stored += 1
+		return stored
+
+	def close(self):
+		self.db.close()
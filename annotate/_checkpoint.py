@@ -0,0 +1,100 @@
+"""
+
+Stage-level checkpoints for 1.0-preprocess.py, so that an interrupted run can
+    be resumed without redoing work. Each stage keeps a directory of markers,
+    one per completed unit of work (input file, chunk, etc), recording a
+    fingerprint of the unit's inputs and the outputs it produced. Markers are
+    written by whichever process did the work (including cluster jobs), and a
+    unit only counts as done if its fingerprint still matches and all of its
+    outputs are still there.
+
+"""
+
+import os, glob, shutil, hashlib
+
+
+def file_fingerprint(path, block=1<<20):
+	"""cheap fingerprint of a file: its size plus hashes of the first and last MB"""
+	digest = hashlib.sha1()
+	size   = os.path.getsize(path)
+	digest.update( str(size).encode() )
+	with open(path, 'rb') as handle:
+		digest.update( handle.read(block) )
+		if size > block:
+			handle.seek( max(block, size-block) )
+			digest.update( handle.read(block) )
+	return digest.hexdigest()
+
+
+def chunk_fingerprint(path):
+	"""
+	fingerprint of a consensus input: a pickle, a partition directory, or a
+	    .list of partition directories (see cluster_umis.py)
+	"""
+	digest = hashlib.sha1()
+	if path.endswith(".list"):
+		with open(path, 'r') as handle:
+			partitions = [ line.strip() for line in handle if line.strip() != "" ]
+	elif os.path.isdir(path):
+		partitions = [ path ]
+	else:
+		return file_fingerprint(path)
+
+	for part in partitions:
+		digest.update( part.encode() )
+		for spill in sorted( glob.glob("%s/*" % part) ):
+			stats = os.stat(spill)
+			digest.update( ("%s\t%d\t%d" % (os.path.basename(spill), stats.st_size, stats.st_mtime_ns)).encode() )
+	return digest.hexdigest()
+
+
+def combine_fingerprints(*items):
+	"""a single fingerprint for several files and/or option strings"""
+	digest = hashlib.sha1()
+	for item in items:
+		#only strings can be paths (an int would be taken as a file descriptor)
+		if isinstance(item, str) and os.path.isfile(item):
+			digest.update( file_fingerprint(item).encode() )
+		else:
+			digest.update( str(item).encode() )
+	return digest.hexdigest()
+
+
+class Checkpoint:
+	"""markers for the completed units of one stage, kept in `directory`"""
+
+	def __init__(self, directory):
+		self.directory = directory
+		os.makedirs(self.directory, exist_ok=True)
+
+	def _marker(self, unit):
+		return os.path.join( self.directory, "%s.done" % os.path.basename(unit) )
+
+	def record(self, unit, fingerprint, outputs=[]):
+		"""mark `unit` as done; written to a temp file first so a marker is never partial"""
+		temp = self._marker(unit) + ".%d.tmp" % os.getpid()
+		with open(temp, 'w') as handle:
+			handle.write( "\t".join( [ fingerprint ] + list(outputs) ) + "\n" )
+		os.replace( temp, self._marker(unit) )
+
+	def outputs(self, unit):
+		"""the outputs recorded for `unit`"""
+		with open(self._marker(unit), 'r') as handle:
+			return handle.read().rstrip("\n").split("\t")[1:]
+
+	def done(self, unit, fingerprint):
+		"""True if `unit` was completed with the same inputs and its outputs still exist"""
+		if not os.path.exists(self._marker(unit)):
+			return False
+		with open(self._marker(unit), 'r') as handle:
+			fields = handle.read().rstrip("\n").split("\t")
+		return fields[0] == fingerprint and all( os.path.exists(f) for f in fields[1:] )
+
+	def manifest(self):
+		"""names of all recorded units"""
+		return sorted( os.path.basename(m)[:-5] for m in glob.glob( os.path.join(self.directory, "*.done") ) )
+
+	def reset(self):
+		"""forget everything recorded for this stage"""
+		shutil.rmtree(self.directory, ignore_errors=True)
+		os.makedirs(self.directory, exist_ok=True)
@@ -0,0 +1,121 @@
+"""
+
+Splitting of (possibly gzipped) FASTQ/FASTA input into chunk files for
+    find_umis. Records are copied as raw bytes, without parsing them into
+    SeqRecords, and the splitting runs in a background thread so that chunks
+    can be handed out to workers as soon as each one is written.
+FASTQ input is assumed to have 4 lines per record, as produced by Illumina
+    instruments and by vsearch.
+
+"""
+
+import gzip, itertools, threading, queue
+
+
+def _lines(files):
+	for f in files:
+		handle = gzip.open(f, 'rb') if f.endswith("gz") else open(f, 'rb')
+		with handle:
+			for line in handle:
+				yield line if line.endswith(b"\n") else line + b"\n"
+
+
+def _fasta_records(lines):
+	record = []
+	for line in lines:
+		if line.startswith(b">") and len(record) > 0:
+			yield b"".join(record)
+			record = []
+		record.append(line)
+	if len(record) > 0:
+		yield b"".join(record)
+
+
+def split_records(files, fileformat, size):
+	"""yield the contents of `files`, `size` records at a time, as bytes"""
+	if fileformat == "fastq":
+		lines = _lines(files)
+		while True:
+			chunk = b"".join( itertools.islice(lines, 4 * size) )
+			if len(chunk) == 0:
+				return
+			yield chunk
+	else:
+		records = _fasta_records( _lines(files) )
+		while True:
+			chunk = b"".join( itertools.islice(records, size) )
+			if len(chunk) == 0:
+				return
+			yield chunk
+
+
+class ChunkWriter(threading.Thread):
+	"""
+	split one or more inputs into numbered chunk files in the background
+	`streams` is a list of lists of input files; the files in each list are
+	    treated as one input, and the inputs are split in lockstep (eg R1 and
+	    R2 of paired reads) using the matching filename template (eg
+	    "chunk%04d.fastq") in `templates`; a ValueError is raised if one input
+	    runs out of records before the others
+	iterating over the writer starts it (if necessary) and yields the name of
+	    each chunk of the first input as soon as all inputs have written it
+	"""
+
+	def __init__(self, streams, templates, fileformat, size=50000):
+		threading.Thread.__init__(self, daemon=True)
+		self.streams    = streams
+		self.templates  = templates
+		self.fileformat = fileformat
+		self.size       = size
+		self.count      = 0
+		self.files      = []
+		self.error      = None
+		self.finished   = queue.Queue()
+
+	def run(self):
+		try:
+			splitters = [ split_records(files, self.fileformat, self.size) for files in self.streams ]
+			while True:
+				chunks = [ next(splitter, None) for splitter in splitters ]
+				if all( chunk is None for chunk in chunks ):
+					break
+				#paired inputs have to stay in step, record for record
+				counts = [ -1 if chunk is None else self._records(chunk) for chunk in chunks ]
+				if len(set(counts)) > 1:
+					shorter = counts.index( min(counts) )
+					raise ValueError( "%s has fewer records than %s" % (", ".join(self.streams[shorter]), ", ".join(self.streams[ counts.index(max(counts)) ])) )
+				self.count += 1
+				for template, chunk in zip(self.templates, chunks):
+					with open(template % self.count, 'wb') as handle:
+						handle.write(chunk)
+					self.files.append( template % self.count )
+				self.finished.put( self.templates[0] % self.count )
+		except Exception as err:
+			self.error = err
+		finally:
+			self.finished.put( None )
+
+	def _records(self, chunk):
+		if self.fileformat == "fastq":
+			return chunk.count(b"\n") // 4
+		return chunk.count(b"\n>") + chunk.startswith(b">")
+
+	def __iter__(self):
+		if self.ident is None:
+			self.start()
+		while True:
+			chunk = self.finished.get()
+			if chunk is None:
+				break
+			yield chunk
+		if self.error is not None:
+			raise self.error
+
+	def wait(self):
+		"""finish splitting and return the number of chunks written"""
+		if self.ident is None:
+			self.start()
+		self.join()
+		if self.error is not None:
+			raise self.error
+		return self.count
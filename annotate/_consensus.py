@@ -0,0 +1,75 @@
+"""
+
+Built-in consensus for small UMI families. Most UMIs only have a handful of
+    reads, and when those reads are all the same length a quality-weighted
+    column-wise vote gives the consensus without having to start vsearch.
+    Anything that would need a real alignment (different lengths, or a read
+    too divergent to fall in the same vsearch cluster) is left to vsearch.
+
+"""
+
+import subprocess
+import numpy
+
+from ..commonVars import vsearch
+from ._reads import Read, reads_from_string
+
+
+BASES = numpy.frombuffer(b"ACGTN", dtype=numpy.uint8)
+
+
+def quick_consensus(seqs, idThreshold=0.95, minLength=150):
+	"""
+	quality-weighted majority consensus of equal-length reads
+	returns a single consensus Read labeled the same way as vsearch -consout
+	    (centroid=<label>;seqs=N;size=N), or None if vsearch is needed
+	"""
+
+	length = len(seqs[0])
+	if length < minLength or any( len(s) != length for s in seqs ):
+		return None
+
+	#upper case (clear bit 5 of each letter)
+	calls = numpy.array( [ numpy.frombuffer(s.seq, dtype=numpy.uint8) for s in seqs ] ) & 0xDF
+
+	#fasta input has no qualities, so every read gets an equal vote
+	if all( s.qual is not None for s in seqs ):
+		weights = numpy.maximum( numpy.array( [ numpy.frombuffer(s.qual, dtype=numpy.uint8) for s in seqs ] ), 1 )
+	else:
+		weights = numpy.ones( calls.shape )
+
+	#score each possible base at each position and take the best
+	votes = numpy.array( [ ((calls == b) * weights).sum(axis=0) for b in BASES ] )
+	consensus = BASES[ votes.argmax(axis=0) ]
+
+	#a read this far from the consensus might form its own cluster in vsearch,
+	#    so punt to make sure the multi-cluster accounting stays the same
+	identity = (calls == consensus).sum(axis=1) / length
+	if identity.min() < idThreshold:
+		return None
+
+	label = "centroid=%s;seqs=%d;size=%d" % ( seqs[0].id, len(seqs), len(seqs) )
+	return Read( label, consensus.tobytes() )
+
+
+def vsearch_consensus(seqs, idThreshold, lenOpts):
+	"""
+	cluster `seqs` with vsearch and return the consensus sequences, largest
+	    cluster first. Reads go in on stdin and come back on stdout, so nothing
+	    touches the disk
+	"""
+	reads = "".join( s.fasta() for s in seqs )
+
+	cons = subprocess.run([vsearch,
+			       "-cluster_fast", "-",
+			       "-consout", "-",
+			       "-id", idThreshold,
+			       "-iddef", "3",
+			       "-sizein", "-sizeout",
+			       "-gapopen", "10I/10E", #lower gap open penalty to better account for internal indels
+			       "-gapext", "2I/2E", #don't make endgaps cheaper; encourages TSOs to align properly
+			       "-clusterout_sort", #so we can look at just the biggest
+			       "-quiet" #supress screen clutter
+			       ] + lenOpts, input=reads.encode(), stdout=subprocess.PIPE, check=True )
+
+	return reads_from_string( cons.stdout, "fasta" )
@@ -0,0 +1,76 @@
+"""
+
+A small dependency scheduler for running the per-chunk steps of the
+    annotation pipeline on a local process pool. Each task names the tasks
+    it has to wait for, and is handed to the pool as soon as they have all
+    finished, so one slow chunk only holds up its own downstream steps
+    instead of every chunk at every stage.
+No more tasks are submitted than there are workers, so that when a worker
+    frees up the next task can still be chosen: tasks further down the
+    pipeline go first (to finish chunks, rather than start new ones), then
+    tasks in the order they were added.
+
+"""
+
+import queue
+from multiprocessing import Pool
+
+
+class TaskGraph:
+	"""tasks with dependencies, run on a multiprocessing Pool"""
+
+	def __init__(self):
+		self.tasks = dict()
+		self.order = []
+
+	def add(self, name, function, args=(), kwargs=None, after=()):
+		"""add a task that runs function(*args, **kwargs) once all tasks named in `after` are done"""
+		for dep in after:
+			if dep not in self.tasks:
+				raise ValueError( "Task %s depends on unknown task %s" % (name, dep) )
+		depth = 1 + max( [ self.tasks[d]['depth'] for d in after ], default=-1 )
+		self.tasks[ name ] = dict( function=function, args=args, kwargs=kwargs or dict(), after=set(after), depth=depth )
+		self.order.append( name )
+		return name
+
+	def run(self, workers=1, report=None):
+		"""
+		run everything, calling report(name, result) (if given) as each task
+		    finishes, and return a dictionary of {name: result}
+		"""
+		waiting  = { name : set(task['after']) for name, task in self.tasks.items() }
+		rank     = { name : (-self.tasks[name]['depth'], i) for i, name in enumerate(self.order) }
+		finished = queue.Queue()
+		results  = dict()
+		running  = 0
+
+		pool = Pool( workers )
+		try:
+			while len(results) < len(self.tasks):
+				ready = sorted( [ n for n, deps in waiting.items() if len(deps) == 0 ], key=rank.get )
+				for name in ready[ :max(workers-running, 0) ]:
+					task = self.tasks[ name ]
+					del waiting[ name ]
+					pool.apply_async( task['function'], task['args'], task['kwargs'],
+							  callback=lambda result, name=name: finished.put( (name, result, None) ),
+							  error_callback=lambda err, name=name: finished.put( (name, None, err) ) )
+					running += 1
+
+				name, result, err = finished.get()
+				running -= 1
+				if err is not None:
+					raise RuntimeError( "Task %s failed: %s" % (name, err) ) from err
+				results[ name ] = result
+				for deps in waiting.values():
+					deps.discard( name )
+				if report is not None:
+					report( name, result )
+		except:
+			pool.terminate()
+			raise
+		else:
+			pool.close()
+		finally:
+			pool.join()
+
+		return results
@@ -0,0 +1,134 @@
+"""
+
+Merging of UMIs that are sequencing or PCR errors of a more abundant UMI, using
+    the directional network method (Smith et al, Genome Research 2017): UMI a
+    absorbs UMI b if they are within the allowed Hamming distance and
+    count(a) >= 2*count(b) - 1, and networks are traversed from the most
+    abundant UMI outwards.
+Finding neighbors by comparing every pair of UMIs in a cell doesn't scale,
+    so UMIs are indexed by substrings instead: if two UMIs differ at no more
+    than d positions, then after cutting both into s segments at least s-d of
+    them must be identical. Each UMI is bucketed under every combination of
+    s-d of its segments, and only UMIs sharing a bucket are compared. Using
+    s = 2(d+1) segments keeps the buckets small enough that most comparisons
+    are with real neighbors.
+
+"""
+
+import re, itertools
+from collections import defaultdict, deque
+
+
+def _segments(length, pieces):
+	bounds = [ round(i * length / pieces) for i in range(pieces+1) ]
+	return list( zip(bounds[ :-1 ], bounds[ 1: ]) )
+
+
+def within_distance(a, b, distance):
+	"""True if equal-length strings `a` and `b` differ at no more than `distance` positions"""
+	mismatches = 0
+	for x, y in zip(a, b):
+		if x != y:
+			mismatches += 1
+			if mismatches > distance:
+				return False
+	return True
+
+
+class UmiIndex:
+	"""substring index over the UMIs of one cell, for finding all UMIs within `distance` mismatches"""
+
+	def __init__(self, umis, distance=1):
+		self.distance = distance
+		self.buckets  = defaultdict( list )
+		for umi in umis:
+			for key in self._keys(umi):
+				self.buckets[ key ].append( umi )
+
+	def _keys(self, umi):
+		segments = [ umi[ start:end ] for start, end in _segments( len(umi), min(len(umi), 2*(self.distance+1)) ) ]
+		for dropped in itertools.combinations( range(len(segments)), min(self.distance, len(segments)) ):
+			yield ( len(umi), dropped, tuple( s for k, s in enumerate(segments) if k not in dropped ) )
+
+	def neighbors(self, umi, keep=None):
+		"""
+		yield each other indexed UMI within `distance` mismatches of `umi`
+		`keep` is an optional filter, checked before the (slower) distance test
+		"""
+		seen = { umi }
+		for key in self._keys(umi):
+			for other in self.buckets.get( key, [] ):
+				if other not in seen:
+					seen.add( other )
+					if (keep is None or keep(other)) and within_distance( umi, other, self.distance ):
+						yield other
+
+
+def directional_clusters(counts, distance=1):
+	"""
+	`counts` maps each UMI in one cell to its number of reads
+	returns a dictionary mapping each UMI to the UMI it should be merged into
+	    (itself, if it is the most abundant member of its network)
+	"""
+	parent = dict()
+	if distance < 1:
+		return { umi : umi for umi in counts }
+
+	index = UmiIndex( counts, distance )
+	for root in sorted( counts, key=lambda u: (-counts[u], u) ):
+		if root in parent:
+			continue
+		parent[ root ] = root
+		queue = deque( [ root ] )
+		while queue:
+			node  = queue.popleft()
+			limit = ( counts[node] + 1 ) / 2
+			for other in index.neighbors( node, lambda u: counts[u] <= limit and u not in parent ):
+				parent[ other ] = root
+				queue.append( other )
+
+	return parent
+
+
+def merge_error_umis(reps, groups, distance=1):
+	"""
+	drop the consensus sequences of UMIs that are errors of a more abundant UMI
+	    in the same cell, adding their consensus_count to the first consensus
+	    sequence of the UMI they were merged into
+	`reps` are consensus Reads from cluster_umis.py and `groups` lists
+	    (cell, umi, reads) for every UMI found, including those that were too
+	    small to get a consensus
+	returns the remaining Reads and the number of UMIs merged
+	"""
+	byCell = defaultdict( dict )
+	for cell, umi, count in groups:
+		byCell[ cell ][ umi ] = count
+
+	parent = dict()
+	for cell, counts in byCell.items():
+		for umi, root in directional_clusters( counts, distance ).items():
+			parent[ (cell, umi) ] = root
+
+	def key(read):
+		cell = re.search( ";cell=([^;]+)", read.id )
+		return ( cell.group(1) if cell else "", re.search(";umi=([^;]+)", read.id).group(1) )
+
+	#first consensus sequence of each UMI that has one
+	first = dict()
+	for r in reps:
+		first.setdefault( key(r), r )
+
+	kept   = []
+	merged = set()
+	for r in reps:
+		cell, umi = key(r)
+		root = parent.get( (cell, umi), umi )
+		if root != umi and (cell, root) in first:
+			target = first[ (cell, root) ]
+			extra  = int( re.search(";consensus_count=(\d+)", r.id).group(1) )
+			target.id = re.sub( ";consensus_count=(\d+)", lambda m: ";consensus_count=%d" % (int(m.group(1)) + extra), target.id )
+			merged.add( (cell, umi) )
+		else:
+			kept.append( r )
+
+	return kept, len(merged)
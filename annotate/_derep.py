@@ -0,0 +1,112 @@
+"""
+
+Streaming dereplication of input reads for 1.1-blast_V.py --derep. Reads are
+    keyed by a hash of their (upper case) sequence, and each unique sequence
+    keeps the id of its first occurrence, its total count and the number of
+    copies from each input file. Like vsearch -derep_fulllength -sizein,
+    reads that already carry a ";size=N" annotation count as N copies.
+Like vsearch, unique sequences come out most abundant first, with ties in
+    order of first occurrence, so read ids don't depend on the buffer size.
+If there are more unique sequences than fit in the buffer, the table is
+    written out as a run sorted by hash and a new one is started. At the end,
+    the runs are merged to add up the counts for each sequence, the totals
+    are written out again in runs sorted by abundance, and those are merged.
+    Either way, unique sequences are yielded one at a time, so they can be
+    written straight into the BLAST chunks.
+
+"""
+
+import os, re, json, heapq, hashlib, itertools
+
+
+def _abundance(entry):
+	#most copies first, then order of first occurrence
+	return ( -entry[3], entry[0] )
+
+
+class Dereplicator:
+	"""
+	collapse identical sequences, spilling to sorted runs in `workdir` once
+	    there are more than `maxUnique` in memory
+	"""
+
+	def __init__(self, workdir, maxUnique=2000000):
+		self.workdir   = workdir
+		self.maxUnique = maxUnique
+		self.table     = dict()
+		self.runs      = []
+		self.spilled   = 0
+		self.reads     = 0
+
+	def add(self, seqID, sequence, source):
+		"""add one read from input file `source`"""
+		sequence = sequence.upper().replace("U", "T")
+		size     = re.search( ";size=(\d+)", seqID )
+		copies   = int(size.group(1)) if size else 1
+		key      = hashlib.blake2b( sequence.encode(), digest_size=16 ).hexdigest()
+
+		entry = self.table.get(key)
+		if entry is None:
+			#[ order of first occurrence, id, sequence, total count, {file: count} ]
+			self.table[ key ] = [ self.reads, re.sub(";size=\d+;?", ";", seqID).rstrip(";"), sequence, copies, { source:copies } ]
+			if len(self.table) >= self.maxUnique:
+				self._spill()
+		else:
+			entry[3] += copies
+			entry[4][ source ] = entry[4].get(source, 0) + copies
+		self.reads += 1
+
+	def _spill(self, order=lambda item: item[0]):
+		#write the table out as a run, sorted by hash unless told otherwise
+		self.spilled += 1
+		run = "%s/derep_run%04d.txt" % ( self.workdir, self.spilled )
+		with open(run, 'w') as handle:
+			for key, (first, seqID, sequence, count, sources) in sorted( self.table.items(), key=order ):
+				handle.write( "%s\t%d\t%s\t%s\t%d\t%s\n" % (key, first, seqID, sequence, count, json.dumps(sources)) )
+		self.runs.append( run )
+		self.table = dict()
+
+	def _read_run(self, run):
+		with open(run, 'r') as handle:
+			for line in handle:
+				key, order, seqID, sequence, count, sources = line.rstrip("\n").split("\t")
+				yield key, [ int(order), seqID, sequence, int(count), json.loads(sources) ]
+
+	def __iter__(self):
+		"""
+		yield (id, sequence, total count, {file: count}) for each unique sequence,
+		    most abundant first (ties in order of first occurrence)
+		"""
+		if len(self.runs) == 0:
+			for first, seqID, sequence, count, sources in sorted( self.table.values(), key=_abundance ):
+				yield seqID, sequence, count, sources
+			return
+
+		if len(self.table) > 0:
+			self._spill()
+
+		#add up the counts for each sequence across the hash-sorted runs...
+		byHash, self.runs = self.runs, []
+		merged = heapq.merge( *[ self._read_run(r) for r in byHash ], key=lambda x: x[0] )
+		for key, group in itertools.groupby( merged, key=lambda x: x[0] ):
+			entries = [ e for k, e in group ]
+			first   = min( entries, key=lambda e: e[0] )
+			sources = dict()
+			for e in entries:
+				for f, n in e[4].items():
+					sources[ f ] = sources.get(f, 0) + n
+			self.table[ key ] = [ first[0], first[1], first[2], sum( e[3] for e in entries ), sources ]
+			if len(self.table) >= self.maxUnique:
+				self._spill( order=lambda item: _abundance(item[1]) )
+		if len(self.table) > 0:
+			self._spill( order=lambda item: _abundance(item[1]) )
+		for r in byHash:
+			os.remove(r)
+
+		#...then put them in order of abundance
+		for key, (first, seqID, sequence, count, sources) in heapq.merge( *[ self._read_run(r) for r in self.runs ], key=lambda x: _abundance(x[1]) ):
+			yield seqID, sequence, count, sources
+
+		for r in self.runs:
+			os.remove(r)
+		self.runs = []
@@ -0,0 +1,69 @@
+"""
+
+The nucleotide and amino acid FASTA files that 1.3-finalize_assignments.py
+    puts in output/sequences (allV, allJ, goodVJ, allCDR3 and goodCDR3).
+    Each parse_blast.py worker writes its own chunk of every file, translating
+    each sequence just once, so 1.3 only has to stick the chunks together.
+The chunks are written from the rearrangements table as read back by airr,
+    the same way 1.3 used to read it, so the def lines don't change.
+
+"""
+
+import re, shutil
+from Bio import Seq
+
+
+FASTA_OUTPUTS   = [ "allV", "allJ", "goodVJ", "allCDR3", "goodCDR3" ]
+
+DEF_LINE_FIELDS = [ 'v_call', 'd_call', 'j_call', 'locus', 'c_call', 'status', 'junction_length', 'junction',
+		    'junction_aa', 'duplicate_count', 'consensus_count', 'cell_id' ]
+
+
+def chunk_fasta(folder, name, seqType, chunk):
+	"""path to one chunk (eg "001") of a FASTA output (`seqType` is "nt" or "aa")"""
+	return "%s/%s_%s_%s.fasta" % (folder, name, seqType, chunk)
+
+
+def write_chunk_fastas(rearrangements, folder, chunk):
+	"""write every FASTA output for one chunk of rearrangements (as read by airr)"""
+	handles = { (name, seqType) : open( chunk_fasta(folder, name, seqType, chunk), "w" ) for name in FASTA_OUTPUTS for seqType in [ "nt", "aa" ] }
+
+	for r in rearrangements:
+
+		def_line = ">" + r['sequence_id'] + "".join( " %s=%s" % (field, r[field]) for field in DEF_LINE_FIELDS if not r[field] == '' )
+
+		#work our way up the hierarchy, putting sequences in the appropriate files
+		if r['status'] in [ 'noV', 'missingNterm', 'chimera' ]:
+			continue
+
+		ungapped = re.sub( "-", "", r['sequence_alignment'] ) #reintroduces any frameshift errors in translation
+		nt = "%s\n%s\n" % ( def_line, ungapped )
+		aa = "%s\n%s\n" % ( def_line, Seq.Seq(ungapped).translate() )
+		handles[ ("allV", "nt") ].write( nt )
+		handles[ ("allV", "aa") ].write( aa )
+
+		if r['status'] == 'noJ':
+			continue
+		handles[ ("allJ", "nt") ].write( nt )
+		handles[ ("allJ", "aa") ].write( aa )
+
+		if r['status'] == 'noCDR3':
+			continue
+		handles[ ("allCDR3", "nt") ].write( "%s\n%s\n" % (def_line, r['junction']) )
+		handles[ ("allCDR3", "aa") ].write( "%s\n%s\n" % (def_line, r['junction_aa']) )
+
+		if r['status'] == "good":
+			handles[ ("goodVJ", "nt") ].write( nt )
+			handles[ ("goodVJ", "aa") ].write( aa )
+			handles[ ("goodCDR3", "nt") ].write( "%s\n%s\n" % (def_line, r['junction']) )
+			handles[ ("goodCDR3", "aa") ].write( "%s\n%s\n" % (def_line, r['junction_aa']) )
+
+	for handle in handles.values():
+		handle.close()
+
+
+def append_files(paths, output, bufferSize=1<<20):
+	"""copy the contents of each of `paths` onto the end of the binary file handle `output`"""
+	for p in paths:
+		with open(p, "rb") as handle:
+			shutil.copyfileobj( handle, output, bufferSize )
@@ -0,0 +1,166 @@
+"""
+
+Matching of feature barcoding and cell hashing oligos in consensus sequences.
+    The oligo list is compiled once into an Aho-Corasick automaton, so each
+    sequence is resolved in a single pass no matter how many oligos are in
+    the panel. Single-substitution variants of each oligo can optionally be
+    added to the automaton to tolerate one sequencing error.
+Per-cell feature counts can also be saved as a sparse matrix (MatrixMarket
+    triplets plus barcode and feature lists, as in 10x output), which is
+    written one cell at a time and read back one cell at a time.
+
+"""
+
+import os
+from collections import defaultdict, deque
+
+
+class FeatureMatcher:
+	"""Aho-Corasick automaton over a set of oligos, each mapped to a label"""
+
+	ALPHABET = "ACGTN"
+
+	def __init__(self, oligos, mismatches=0):
+		#pattern -> (label, number of mismatches)
+		patterns = { oligo.upper() : (label, 0) for oligo, label in oligos.items() }
+
+		if mismatches > 0:
+			variants = defaultdict( set )
+			for oligo in patterns:
+				for i, base in enumerate(oligo):
+					for sub in self.ALPHABET:
+						if sub != base:
+							variants[ oligo[ :i ] + sub + oligo[ i+1: ] ].add( patterns[oligo][0] )
+			for var, labels in variants.items():
+				#exact oligos take precedence, and skip variants that could be either of two features
+				if var not in patterns and len(labels) == 1:
+					patterns[ var ] = ( labels.pop(), 1 )
+
+		#build the trie
+		self.goto = [ dict() ]
+		self.out  = [ list() ]
+		for pattern, hit in patterns.items():
+			state = 0
+			for c in pattern:
+				if c not in self.goto[state]:
+					self.goto.append( dict() )
+					self.out.append( list() )
+					self.goto[state][c] = len(self.goto) - 1
+				state = self.goto[state][c]
+			self.out[state].append( hit )
+
+		#add failure links, breadth first
+		self.fail = [ 0 ] * len(self.goto)
+		queue = deque( self.goto[0].values() )
+		while queue:
+			state = queue.popleft()
+			for c, child in self.goto[state].items():
+				queue.append(child)
+				f = self.fail[state]
+				while f and c not in self.goto[f]:
+					f = self.fail[f]
+				self.fail[child] = self.goto[f].get(c, 0)
+				self.out[child] += self.out[ self.fail[child] ]
+
+	def match(self, sequence):
+		"""
+		returns the label of the first oligo found in `sequence`, preferring an
+		    exact match to one with a mismatch, or None if there is none
+		"""
+		state = 0
+		best  = None
+		for c in sequence.upper():
+			while state and c not in self.goto[state]:
+				state = self.fail[state]
+			state = self.goto[state].get(c, 0)
+			for label, mm in self.out[state]:
+				if mm == 0:
+					return label
+				elif best is None:
+					best = label
+		return best
+
+
+def write_feature_matrix(directory, features, counts):
+	"""
+	write per-cell feature counts to `directory` as matrix.mtx (features x cells,
+	    stored one cell at a time), barcodes.tsv and features.tsv
+	`features` gives the feature names (in row order) and `counts` yields
+	    (cell, {feature: count}) tuples, which are written out as they come
+	"""
+	os.makedirs(directory, exist_ok=True)
+
+	row = { f : i+1 for i, f in enumerate(features) }
+	with open( "%s/features.tsv" % directory, 'w' ) as handle:
+		for f in features:
+			handle.write( "%s\n" % f )
+
+	numCells = 0
+	entries  = 0
+	with open( "%s/matrix.mtx" % directory, 'w' ) as mtx, open( "%s/barcodes.tsv" % directory, 'w' ) as barcodes:
+		mtx.write( "%%MatrixMarket matrix coordinate integer general\n" )
+		#the dimensions aren't known until the end, so leave room to go back for them
+		sizeLine = mtx.tell()
+		mtx.write( " " * 60 + "\n" )
+
+		for cell, cellCounts in counts:
+			numCells += 1
+			barcodes.write( "%s\n" % cell )
+			for f in sorted( cellCounts, key=lambda x: row[x] ):
+				if cellCounts[f] > 0:
+					mtx.write( "%d %d %d\n" % (row[f], numCells, cellCounts[f]) )
+					entries += 1
+
+		mtx.seek( sizeLine )
+		mtx.write( "%d %d %d" % (len(features), numCells, entries) )
+
+
+class FeatureMatrix:
+	"""
+	per-cell access to a matrix saved by write_feature_matrix; only the file
+	    offset of each cell is kept in memory, and its counts are read on request
+	"""
+
+	def __init__(self, directory):
+		with open( "%s/features.tsv" % directory, 'r' ) as handle:
+			self.features = [ line.rstrip("\n") for line in handle ]
+		with open( "%s/barcodes.tsv" % directory, 'r' ) as handle:
+			self.columns = { line.rstrip("\n") : i+1 for i, line in enumerate(handle) }
+
+		#entries are stored in column order, so remember where each column starts
+		self.offsets = dict()
+		self.handle  = open( "%s/matrix.mtx" % directory, 'rb' )
+		position = 0
+		header   = True
+		for line in self.handle:
+			if line.startswith(b"%"):
+				pass
+			elif header:
+				header = False #dimensions line
+			else:
+				col = int(line.split()[1])
+				if col not in self.offsets:
+					self.offsets[col] = position
+			position += len(line)
+
+	def __len__(self):
+		return len(self.columns)
+
+	def __contains__(self, cell):
+		return cell in self.columns
+
+	def get(self, cell, default=None):
+		"""returns the counts for `cell` as a list of strings in feature order"""
+		col = self.columns.get(cell)
+		if col is None:
+			return default
+
+		counts = [ "0" ] * len(self.features)
+		if col in self.offsets:
+			self.handle.seek( self.offsets[col] )
+			for line in self.handle:
+				r, c, value = line.split()
+				if int(c) != col:
+					break
+				counts[ int(r)-1 ] = value.decode()
+		return counts
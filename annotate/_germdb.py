@@ -0,0 +1,73 @@
+"""
+
+BLAST databases for custom germline libraries. Without a database, blastn
+    has to be run with -subject, which rebuilds its lookup structures for
+    every query chunk and is much slower. The first time a library without
+    a database is used, one is built with makeblastdb into a cache directory
+    keyed by a checksum of the library file, and every later search against
+    the same library (from any project) reuses it.
+A lock file makes sure that parallel workers or cluster jobs don't build the
+    same database twice, and a marker written after a successful build makes
+    sure nobody picks up a half-written one.
+
+"""
+
+import os, shutil, hashlib, fcntl, subprocess
+
+
+#override with the SONAR_BLASTDB_CACHE environment variable
+DB_CACHE = os.path.join( os.path.expanduser("~"), ".cache", "SONAR", "blastdb" )
+
+
+def _checksum(path, block=1<<20):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as handle:
+		for data in iter( lambda: handle.read(block), b"" ):
+			digest.update( data )
+	return digest.hexdigest()
+
+
+def find_makeblastdb(blastn):
+	"""makeblastdb from the same install as `blastn`, or else from the PATH"""
+	sibling = os.path.join( os.path.dirname(blastn), os.path.basename(blastn).replace("blastn", "makeblastdb") )
+	if sibling != blastn and os.path.isfile(sibling):
+		return sibling
+	return shutil.which("makeblastdb")
+
+
+def blast_database(library, blastn, cacheDir=None):
+	"""
+	name to pass to blastn -db for germline `library`: the library itself if
+	    it already has a database next to it, otherwise a cached copy built
+	    on first use
+	returns `library` unchanged (for -subject mode) if no database can be built
+	"""
+	if library is None or os.path.isfile(library + ".nhr") or not os.path.isfile(library):
+		return library
+
+	if cacheDir is None:
+		cacheDir = os.environ.get( "SONAR_BLASTDB_CACHE", DB_CACHE )
+	folder = os.path.join( cacheDir, _checksum(library) )
+	db     = os.path.join( folder, os.path.basename(library) )
+	if os.path.isfile( db + ".done" ):
+		return db
+
+	makeblastdb = find_makeblastdb(blastn)
+	if makeblastdb is None:
+		print( "Can't find makeblastdb; searching %s with -subject instead..." % library )
+		return library
+
+	os.makedirs( folder, exist_ok=True )
+	with open( os.path.join(folder, "lock"), 'w' ) as lock:
+		fcntl.flock( lock, fcntl.LOCK_EX )
+		try:
+			#someone else may have built it while we were waiting
+			if not os.path.isfile( db + ".done" ):
+				print( "Building BLAST database for %s in %s..." % (library, folder) )
+				shutil.copyfile( library, db )
+				subprocess.run( [ makeblastdb, "-in", db, "-dbtype", "nucl", "-out", db ], check=True, stdout=subprocess.DEVNULL )
+				open( db + ".done", 'w' ).close()
+		finally:
+			fcntl.flock( lock, fcntl.LOCK_UN )
+
+	return db
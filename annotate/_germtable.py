@@ -0,0 +1,106 @@
+"""
+
+Per-gene features of a V or J germline library that parse_blast.py needs for
+    every read: the position of the conserved cysteine codon where CDR3
+    starts (V genes) or of the J motif (WGXG/FGXG) where it ends (J genes),
+    the locus, and the length of the gene. They only depend on the library,
+    so instead of searching the germline sequence for each read, they are
+    worked out once and saved in a small table in the project's work folder
+    (or in the user's BLAST database cache), never next to the library.
+The table records a checksum of the library and the motif it was built with,
+    and is rebuilt if either has changed.
+
+"""
+
+import os, re
+from Bio import SeqIO
+
+from ._germdb import DB_CACHE, _checksum
+
+
+LOCUS_PATTERNS = { "V" : [ ("IGH", "(HV|VH|heavy)"), ("IGL", "(LV|VL|lambda)"), ("IGK", "(KV|VK|kappa)") ],
+		   "J" : [ ("IGH", "(HJ|JH|heavy)"), ("IGL", "(LJ|Jl|lambda)"), ("IGK", "(KJ|JK|kappa)") ] }
+
+
+class GeneFeatures:
+	"""locus, length and CDR3 anchor (cysteine or J motif position, -1 if not found) of one germline gene"""
+
+	__slots__ = ( 'locus', 'length', 'anchor' )
+
+	def __init__(self, locus, length, anchor):
+		self.locus  = locus
+		self.length = length
+		self.anchor = anchor
+
+
+def gene_locus(name, segment):
+	"""IGH, IGK or IGL, based on the name of a V or J gene, or an empty string if it isn't clear"""
+	for locus, pattern in LOCUS_PATTERNS[ segment ]:
+		if re.search( pattern, name, re.I ):
+			return locus
+	return ""
+
+
+def cysteine_position(name, sequence):
+	"""start of the last in-frame cysteine codon in a V gene, or -1"""
+	cys_pat = "TG[T|C|N]" #N is for a couple of shorter V's, like VH4-31
+	if re.match("IGLV2-(11|23)", name):
+		cys_pat = "TGCTGC" #special case
+	if re.match("IGHV1-C", name):
+		cys_pat = "TATGC"
+
+	#last one **IN FRAME** is the cysteine we want! (matters for light chains)
+	for cys in reversed( list( re.finditer(cys_pat, sequence, flags=re.I) ) ):
+		if cys.start() % 3 == 0:
+			return cys.start()
+	return -1
+
+
+def motif_position(sequence, motif):
+	"""start of the first match to the J motif in a J gene, or -1"""
+	found = re.search( motif, sequence, flags=re.I )
+	return -1 if found is None else found.start()
+
+
+def _table_path(library, segment, folder):
+	if folder is None:
+		folder = os.path.join( os.environ.get("SONAR_BLASTDB_CACHE", DB_CACHE), _checksum(library) )
+		os.makedirs( folder, exist_ok=True )
+		return os.path.join( folder, os.path.basename(library) + ".features" )
+	return os.path.join( folder, "germline_%s.features" % segment )
+
+
+def germline_features(library, segment, motif="", folder=None):
+	"""
+	{gene name: GeneFeatures} for a V (`segment`="V") or J (`segment`="J",
+	    with the J `motif` to look for) germline library
+	the table is saved in `folder` (eg the project's work/internal), or in
+	    the user's BLAST database cache if no folder is given
+	"""
+	header = "#%s\t%s\t%s\n" % ( _checksum(library), segment, motif )
+	path   = _table_path(library, segment, folder)
+
+	if os.path.isfile(path):
+		with open(path, 'r') as handle:
+			if handle.readline() == header:
+				features = dict()
+				for line in handle:
+					name, locus, length, anchor = line.rstrip("\n").split("\t")
+					features[ name ] = GeneFeatures( locus, int(length), int(anchor) )
+				return features
+
+	features = dict()
+	for gene in SeqIO.parse(library, "fasta"):
+		sequence = str(gene.seq)
+		anchor   = cysteine_position(gene.id, sequence) if segment == "V" else motif_position(sequence, motif)
+		features[ gene.id ] = GeneFeatures( gene_locus(gene.id, segment), len(sequence), anchor )
+
+	#write to a temporary file first, since several chunks may be doing this at once
+	temp = "%s.%d" % ( path, os.getpid() )
+	with open(temp, 'w') as handle:
+		handle.write( header )
+		for name, f in features.items():
+			handle.write( "%s\t%s\t%d\t%d\n" % (name, f.locus, f.length, f.anchor) )
+	os.replace( temp, path )
+
+	return features
@@ -0,0 +1,299 @@
+"""
+
+A k-mer seed engine for V and J gene assignment, as a faster alternative to
+    BLAST against the small germline libraries. The library is indexed once,
+    and for each read:
+        - every k-mer of the read (and its reverse complement) votes for the
+              germline genes and diagonals it occurs on
+        - the genes with the most seeds near their best diagonal are aligned
+              to the read, using the same scores as blastn in SONAR (reward
+              1, penalty -1, gap open 5, extend 2): ungapped if the seeds all
+              fall on one diagonal, across a single gap if they fall on two,
+              and with a banded local alignment if there are more
+        - each alignment is written out as the 13 tabular fields that
+              get_top_hits() expects from BLAST
+Reads that don't give a clear answer (too few seeds, seeds on both strands,
+    or a weak alignment) are left for BLAST.
+Bit scores and e-values use the published Karlin-Altschul parameters for
+    those scores, without BLAST's edge corrections, so they are close to but
+    not exactly what BLAST reports.
+
+"""
+
+import os, math
+import numpy
+from collections import defaultdict
+
+from ._reads import parse_reads, COMPLEMENT
+
+
+MATCH, MISMATCH, GAP_OPEN, GAP_EXTEND = 1, -1, 5, 2
+KARLIN_LAMBDA, KARLIN_K = 1.28, 0.46
+NEG = -(1 << 30)
+
+#calls weaker than this (in bits) are left for BLAST
+KMER_V_BITS, KMER_J_BITS = 100.0, 30.0
+
+ENCODE = numpy.full( 256, 4, dtype=numpy.int64 )
+for i, b in enumerate(b"ACGT"):
+	ENCODE[ b ] = ENCODE[ b+32 ] = i
+
+
+def kmer_codes(seq, k):
+	"""integer code for each k-mer of `seq` (bytes), and whether it is free of non-ACGT bases"""
+	codes = ENCODE[ numpy.frombuffer(seq, dtype=numpy.uint8) ]
+	n = len(codes) - k + 1
+	if n <= 0:
+		return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=bool)
+	bad   = numpy.concatenate( ( [0], numpy.cumsum(codes == 4) ) )
+	valid = bad[ k: ] == bad[ :n ]
+	codes = numpy.where( codes == 4, 0, codes )
+	value = numpy.zeros( n, dtype=numpy.int64 )
+	for i in range(k):
+		value = (value << 2) | codes[ i:i+n ]
+	return value, valid
+
+
+def ungapped(read, gene, diagonal):
+	"""best-scoring segment on one diagonal (gene position - read position)"""
+	start = max( 0, -diagonal )
+	end   = min( len(read), len(gene) - diagonal )
+	if end <= start:
+		return None
+	a = numpy.frombuffer( read, dtype=numpy.uint8 )[ start:end ]
+	b = numpy.frombuffer( gene, dtype=numpy.uint8 )[ start+diagonal:end+diagonal ]
+	same   = a == b
+	cumul  = numpy.concatenate( ( [0], numpy.cumsum( numpy.where(same, MATCH, MISMATCH) ) ) )
+	lowest = numpy.minimum.accumulate( cumul )
+	last   = int( numpy.argmax( cumul - lowest ) )
+	first  = int( numpy.argmin( cumul[ :last+1 ] ) )
+	if cumul[last] <= cumul[first]:
+		return None
+	matches = int( numpy.count_nonzero( same[ first:last ] ) )
+	return dict( score=int(cumul[last] - cumul[first]), qstart=start+first, qend=start+last, sstart=start+first+diagonal,
+		     send=start+last+diagonal, length=last-first, matches=matches, mismatches=last-first-matches, gaps=0 )
+
+
+def diagonal_scores(read, gene, diagonal):
+	"""score of each read position against the gene along one diagonal, with a barrier off the ends of the gene"""
+	j     = numpy.arange( len(read) ) + diagonal
+	valid = (j >= 0) & (j < len(gene))
+	r = numpy.frombuffer( read, dtype=numpy.uint8 )
+	g = numpy.frombuffer( gene, dtype=numpy.uint8 )
+	return numpy.where( valid, numpy.where( g[ numpy.clip(j, 0, len(g)-1) ] == r, MATCH, MISMATCH ), NEG )
+
+
+def joined(read, gene, first, second):
+	"""
+	best local alignment that follows diagonal `first` and then, after a
+	    single gap, diagonal `second`
+	the whole band doesn't have to be filled in, since the best place for the
+	    gap is just the best sum of a segment ending on one diagonal and one
+	    starting on the other
+	"""
+	gap   = abs( second - first )
+	shift = max( 0, first - second )	#read bases skipped by an insertion in the read
+	a, b  = diagonal_scores( read, gene, first ), diagonal_scores( read, gene, second )
+	cumA  = numpy.concatenate( ( [0], numpy.cumsum(a) ) )
+	cumB  = numpy.concatenate( ( [0], numpy.cumsum(b) ) )
+	ending   = cumA - numpy.minimum.accumulate( cumA )			#best segment on `first` ending at each position
+	starting = numpy.maximum.accumulate( cumB[ ::-1 ] )[ ::-1 ] - cumB	#best segment on `second` starting at each position
+
+	total = ending[ :len(cumA)-shift ] + starting[ shift: ] - GAP_OPEN - GAP_EXTEND * gap
+	p = int( numpy.argmax(total) )
+	if total[p] <= 0:
+		return None
+	q = p + shift
+	start = int( numpy.argmin( cumA[ :p+1 ] ) )
+	end   = q + int( numpy.argmax( cumB[ q: ] ) )
+	aligned = (p - start) + (end - q)
+	matches = int( numpy.count_nonzero( a[ start:p ] == MATCH ) + numpy.count_nonzero( b[ q:end ] == MATCH ) )
+	return dict( score=int(total[p]), qstart=start, qend=end, sstart=start+first, send=end+second, length=aligned+gap,
+		     matches=matches, mismatches=aligned-matches, gaps=gap )
+
+
+def banded(read, gene, low, high):
+	"""local alignment with affine gaps, restricted to diagonals `low` to `high`"""
+	n, width = len(read), high - low + 1
+	r = numpy.frombuffer( read, dtype=numpy.uint8 )
+	g = numpy.frombuffer( gene, dtype=numpy.uint8 )
+	band = numpy.arange( width )
+
+	H      = numpy.zeros( (n, width), dtype=numpy.int64 )
+	source = numpy.zeros( (n, width), dtype=numpy.int8 )	#0: start, 1: diagonal, 2: gap in gene
+	fromF  = numpy.zeros( (n, width), dtype=bool )		#cell was reached by a gap in the read
+	Fstart = numpy.zeros( (n, width), dtype=numpy.int64 )	#band position the read gap was opened from
+	Eopen  = numpy.zeros( (n, width), dtype=bool )
+
+	Hprev = numpy.zeros( width, dtype=numpy.int64 )
+	Eprev = numpy.full( width, NEG, dtype=numpy.int64 )
+	for i in range(n):
+		j     = i + low + band
+		valid = (j >= 0) & (j < len(g))
+		score = numpy.where( valid, numpy.where( g[ numpy.clip(j, 0, len(g)-1) ] == r[i], MATCH, MISMATCH ), NEG )
+
+		diag  = Hprev + score
+		#gap in the gene: from the cell above, which is one band position to the right
+		openE = numpy.append( Hprev[ 1: ], NEG ) - GAP_OPEN - GAP_EXTEND
+		extE  = numpy.append( Eprev[ 1: ], NEG ) - GAP_EXTEND
+		E     = numpy.where( valid, numpy.maximum(openE, extE), NEG )
+		Eopen[i] = openE >= extE
+
+		H0 = numpy.maximum( 0, numpy.maximum(diag, E) )
+		source[i] = numpy.where( H0 == 0, 0, numpy.where( diag >= E, 1, 2 ) )
+
+		#gap in the read: opening from H0 is enough, since re-opening a gap
+		#    never beats extending one
+		values  = H0 + GAP_EXTEND * band
+		running = numpy.maximum.accumulate( values )
+		argbest = numpy.maximum.accumulate( numpy.where( values == running, band, 0 ) )
+		F = numpy.where( valid, numpy.append( NEG, running[ :-1 ] ) - GAP_OPEN - GAP_EXTEND * band, NEG )
+		fromF[i]  = F > H0
+		Fstart[i] = numpy.append( 0, argbest[ :-1 ] )
+
+		H[i]  = numpy.maximum( H0, F )
+		Hprev = H[i]
+		Eprev = E
+
+	i, b = numpy.unravel_index( int(numpy.argmax(H)), H.shape )
+	best = int( H[i, b] )
+	if best <= 0:
+		return None
+	end = ( i + 1, i + low + b + 1 )
+
+	matches, mismatches, gaps, length = 0, 0, 0, 0
+	state = "H"
+	while True:
+		if state == "H" and fromF[i, b]:
+			k = Fstart[i, b]
+			gaps, length = gaps + b - k, length + b - k
+			b, state = k, "H0"
+			continue
+		if state in ("H", "H0") and source[i, b] == 1:
+			length += 1
+			if r[i] == g[i + low + b]:
+				matches += 1
+			else:
+				mismatches += 1
+			if i == 0 or H[i-1, b] == 0:
+				break
+			i, state = i - 1, "H"
+			continue
+		#gap in the gene
+		gaps, length = gaps + 1, length + 1
+		opened = Eopen[i, b]
+		i, b   = i - 1, b + 1
+		state  = "H" if opened else "E"
+
+	return dict( score=best, qstart=int(i), qend=int(end[0]), sstart=int(i + low + b), send=int(end[1]),
+		     length=length, matches=matches, mismatches=mismatches, gaps=gaps )
+
+
+class KmerIndex:
+	"""in-memory k-mer index of a germline library"""
+
+	def __init__(self, library, k=11, maxIndel=6):
+		self.k, self.maxIndel = k, maxIndel
+		self.names, self.seqs = [], []
+		for gene in parse_reads(library, "fasta"):
+			self.names.append( gene.id )
+			self.seqs.append( bytes(gene.seq).upper() )
+		self.total = sum( len(s) for s in self.seqs )
+
+		self.index = defaultdict( list )
+		for g, seq in enumerate(self.seqs):
+			codes, valid = kmer_codes( seq, k )
+			for pos in numpy.flatnonzero(valid).tolist():
+				self.index[ int(codes[pos]) ].append( (g, pos) )
+
+	def candidates(self, seq):
+		"""
+		(seed count, gene, strand, diagonals) for every gene the read has seeds
+		    on, best first; seeds count if they are within `maxIndel`
+		    diagonals of the gene's most popular one
+		"""
+		votes = defaultdict( lambda: defaultdict(int) )
+		for strand, s in ( ("plus", seq), ("minus", seq.translate(COMPLEMENT)[ ::-1 ]) ):
+			codes, valid = kmer_codes( s, self.k )
+			for pos in numpy.flatnonzero(valid).tolist():
+				for g, gpos in self.index.get( int(codes[pos]), () ):
+					votes[ (g, strand) ][ gpos - pos ] += 1
+
+		found = []
+		for (g, strand), diagonals in votes.items():
+			main = max( diagonals, key=lambda d: (diagonals[d], -abs(d)) )
+			near = [ d for d in diagonals if abs(d - main) <= self.maxIndel and (d == main or diagonals[d] > 1) ]
+			found.append( ( sum(diagonals[d] for d in near), g, strand, sorted(near) ) )
+		return sorted( found, key=lambda c: (-c[0], c[1]) )
+
+	def align(self, seq, g, strand, diagonals):
+		s, gene = ( seq if strand == "plus" else seq.translate(COMPLEMENT)[ ::-1 ] ), self.seqs[g]
+		if len(diagonals) == 1:
+			return ungapped( s, gene, diagonals[0] )
+		if len(diagonals) == 2:
+			d1, d2 = diagonals
+			options = [ ungapped(s, gene, d1), ungapped(s, gene, d2), joined(s, gene, d1, d2), joined(s, gene, d2, d1) ]
+			return max( [ o for o in options if o is not None ], key=lambda o: o['score'], default=None )
+		return banded( s, gene, diagonals[0] - 2, diagonals[-1] + 2 )
+
+	def assign(self, qid, seq, hits=10, minSeeds=3, minBits=30.0, window=0.8):
+		"""
+		BLAST-style tabular rows (lists of strings) for read `seq` (bytes), best
+		    first, or None if the read should go to BLAST instead
+		"""
+		seq = seq.upper()
+		found = self.candidates(seq)
+		if len(found) == 0 or found[0][0] < minSeeds:
+			return None
+
+		#seeds on both strands: let BLAST sort it out
+		top = found[0][0]
+		if any( c[2] != found[0][2] and c[0] >= top / 2 for c in found ):
+			return None
+
+		rows = []
+		for support, g, strand, diagonals in found[ :hits ]:
+			if support < top * window:
+				break
+			aln = self.align( seq, g, strand, diagonals )
+			if aln is None:
+				continue
+			bits = ( KARLIN_LAMBDA * aln['score'] - math.log(KARLIN_K) ) / math.log(2)
+			if strand == "plus":
+				qstart, qend, sstart, send = aln['qstart'] + 1, aln['qend'], aln['sstart'] + 1, aln['send']
+			else:
+				#report query coordinates on the read as given, and the subject backwards, as BLAST does
+				qstart, qend, sstart, send = len(seq) - aln['qend'] + 1, len(seq) - aln['qstart'], aln['send'], aln['sstart'] + 1
+			evalue = KARLIN_K * len(seq) * self.total * math.exp( -KARLIN_LAMBDA * aln['score'] )
+			rows.append( ( bits, [ qid, self.names[g], "%.3f" % (100.0 * aln['matches'] / aln['length']), str(aln['length']),
+					       str(aln['mismatches']), str(aln['gaps']), str(qstart), str(qend), str(sstart), str(send),
+					       "%.2e" % evalue, "%.1f" % bits, strand ] ) )
+
+		if len(rows) == 0:
+			return None
+		rows.sort( key=lambda r: -r[0] )
+		if rows[0][0] < minBits:
+			return None
+		return [ row for bits, row in rows ]
+
+
+def split_chunk(index, fasta, resolved, hitFile, **settings):
+	"""
+	assign the reads in `fasta` with `index`, moving the ones it is sure of to
+	    `resolved` (and their rows to `hitFile`) and leaving the rest in
+	    `fasta` for BLAST
+	returns the number of reads resolved
+	"""
+	found = 0
+	with open(fasta + ".tmp", 'w') as blast, open(resolved, 'w') as done, open(hitFile, 'w') as hits:
+		for read in parse_reads(fasta, "fasta"):
+			rows = index.assign( read.id, bytes(read.seq), **settings )
+			if rows is None:
+				blast.write( read.fasta() )
+			else:
+				found += 1
+				done.write( read.fasta() )
+				for row in rows:
+					hits.write( "\t".join(row) + "\n" )
+	os.replace( fasta + ".tmp", fasta )
+	return found
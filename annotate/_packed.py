@@ -0,0 +1,172 @@
+"""
+
+Packed on-disk store for the UMI and cell families that 1.0-preprocess.py
+    passes to the consensus jobs. Instead of pickling a Read (or SeqRecord)
+    per sequence, all of the reads in a file are stored in a few contiguous
+    arrays:
+        - nucleotides at 2 bits each, plus a 1-bit mask marking N (or any
+              other non-ACGT character)
+        - PHRED scores as one uint8 per base (omitted for fasta input)
+        - read boundaries and family boundaries as offset arrays
+        - read ids, cell barcodes and UMIs as byte blobs with offsets
+The file is memory-mapped when it is opened, so nothing is read in until a
+    family is asked for, and then only that family is unpacked into Reads.
+
+"""
+
+import json
+import numpy
+from collections import defaultdict
+
+from ._reads import Read
+
+
+MAGIC = b"SONARPK1"
+
+#A=0, C=1, G=2, T/U=3; anything else is stored as A and masked as N
+CODES = numpy.zeros( 256, dtype=numpy.uint8 )
+NMASK = numpy.ones( 256, dtype=numpy.uint8 )
+for i, b in enumerate(b"ACGT"):
+	for c in ( b, b+32 ):
+		CODES[ c ] = i
+		NMASK[ c ] = 0
+CODES[ ord("U") ] = CODES[ ord("u") ] = 3
+NMASK[ ord("U") ] = NMASK[ ord("u") ] = 0
+
+#each packed byte -> its 4 bases
+UNPACK = numpy.frombuffer(b"ACGT", dtype=numpy.uint8)[ ( numpy.arange(256)[ :, None ] >> numpy.array([6, 4, 2, 0]) ) & 3 ]
+
+
+def _offsets(lengths):
+	offsets = numpy.zeros( len(lengths)+1, dtype=numpy.int64 )
+	offsets[ 1: ] = numpy.cumsum( numpy.array(lengths, dtype=numpy.int64) )
+	return offsets
+
+
+def _blob(strings):
+	data = [ s.encode() for s in strings ]
+	return numpy.frombuffer( b"".join(data), dtype=numpy.uint8 ), _offsets( [ len(d) for d in data ] )
+
+
+def write_families(path, families):
+	"""
+	pack `families` (dictionaries with 'cell', 'umi', 'count' and 'seqs', as
+	    produced by find_umis_in_file) into a single file at `path`
+	"""
+	families = list(families)
+	reads    = [ r for fam in families for r in fam['seqs'] ]
+
+	arrays = dict()
+	bases  = numpy.frombuffer( b"".join( r.seq for r in reads ), dtype=numpy.uint8 )
+	codes  = numpy.zeros( (len(bases)+3) // 4 * 4, dtype=numpy.uint8 )
+	codes[ :len(bases) ] = CODES[ bases ]
+	codes  = codes.reshape(-1, 4)
+	arrays['packed'] = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+	arrays['nmask']  = numpy.packbits( NMASK[ bases ] )
+
+	if all( r.qual is not None for r in reads ):
+		arrays['qual'] = numpy.frombuffer( b"".join( r.qual for r in reads ), dtype=numpy.uint8 )
+
+	arrays['reads']    = _offsets( [ len(r) for r in reads ] )
+	arrays['families'] = _offsets( [ len(fam['seqs']) for fam in families ] )
+	arrays['counts']   = numpy.array( [ fam['count'] for fam in families ], dtype=numpy.int64 )
+
+	arrays['ids'],   arrays['ids_offsets']   = _blob( r.id for r in reads )
+	arrays['cells'], arrays['cells_offsets'] = _blob( fam['cell'] for fam in families )
+	arrays['umis'],  arrays['umis_offsets']  = _blob( fam['umi'] for fam in families )
+
+	#header lists the dtype, offset and size of each array; each array starts
+	#    on an 8-byte boundary so that it can be viewed in place
+	header, position = dict(), 0
+	for name, array in arrays.items():
+		header[ name ] = [ array.dtype.str, position, array.nbytes ]
+		position += (array.nbytes + 7) // 8 * 8
+	headerBytes = json.dumps(header).encode()
+	headerBytes += b" " * ( -(len(MAGIC) + 8 + len(headerBytes)) % 8 )
+
+	with open(path, 'wb') as handle:
+		handle.write( MAGIC )
+		handle.write( len(headerBytes).to_bytes(8, "little") )
+		handle.write( headerBytes )
+		for name, array in arrays.items():
+			handle.write( array.tobytes() )
+			handle.write( b"\0" * ( -array.nbytes % 8 ) )
+
+
+class PackedFamilies:
+	"""read-only, memory-mapped access to a file written by write_families"""
+
+	def __init__(self, path):
+		self.path = path
+		buffer = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+		if bytes(buffer[ :len(MAGIC) ]) != MAGIC:
+			raise ValueError( "%s is not a packed family file" % path )
+		size   = int.from_bytes( bytes(buffer[ len(MAGIC):len(MAGIC)+8 ]), "little" )
+		start  = len(MAGIC) + 8 + size
+		header = json.loads( bytes(buffer[ len(MAGIC)+8:start ]) )
+
+		self.arrays = dict()
+		for name, (dtype, offset, nbytes) in header.items():
+			self.arrays[ name ] = buffer[ start+offset : start+offset+nbytes ].view(dtype)
+
+	def __len__(self):
+		return len(self.arrays['counts'])
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self.family(i)
+
+	def _string(self, blob, i):
+		offsets = self.arrays[ blob + "_offsets" ]
+		return bytes( self.arrays[blob][ offsets[i]:offsets[i+1] ] ).decode()
+
+	def key(self, i):
+		"""(cell, umi) of family `i`"""
+		return self._string("cells", i), self._string("umis", i)
+
+	def count(self, i):
+		return int( self.arrays['counts'][i] )
+
+	def sizes(self):
+		"""(read count, total length) of each family, keyed by (cell, umi), without unpacking any reads"""
+		reads, families = self.arrays['reads'], self.arrays['families']
+		return { self.key(i) : ( self.count(i), int( reads[ families[i+1] ] - reads[ families[i] ] ) ) for i in range(len(self)) }
+
+	def family(self, i):
+		"""unpack family `i` into a dictionary of Reads, in the format used by find_umis_in_file"""
+		first, last = self.arrays['families'][i], self.arrays['families'][i+1]
+		offsets     = self.arrays['reads'][ first:last+1 ]
+		start, end  = int(offsets[0]), int(offsets[-1])
+
+		#unpack all of the family's bases at once; the Reads are then just windows on them
+		b0      = start // 4
+		letters = UNPACK[ self.arrays['packed'][ b0:(end+3)//4 ] ].ravel()[ start-4*b0 : end-4*b0 ]
+		m0      = start // 8
+		masked  = numpy.unpackbits( self.arrays['nmask'][ m0:(end+7)//8 ] )[ start-8*m0 : end-8*m0 ]
+		letters[ masked.astype(bool) ] = ord("N")
+		seq  = letters.tobytes()
+		qual = bytes( self.arrays['qual'][ start:end ] ) if 'qual' in self.arrays else None
+
+		cell, umi = self.key(i)
+		seqs = [ Read( self._string("ids", r), seq, qual, int(offsets[r-first])-start, int(offsets[r-first+1])-start ) for r in range(first, last) ]
+		return { 'cell':cell, 'umi':umi, 'count':self.count(i), 'seqs':seqs }
+
+
+def merge_packed(paths):
+	"""
+	yield the families from several packed files, merging any family (by cell
+	    and umi) that is split across files; only the index of each file is
+	    read up front, and each merged family is unpacked as it is yielded
+	"""
+	index = defaultdict( list )
+	for store in [ PackedFamilies(p) for p in paths ]:
+		for i in range(len(store)):
+			index[ store.key(i) ].append( (store, i) )
+
+	for key, parts in index.items():
+		family = parts[0][0].family( parts[0][1] )
+		for store, i in parts[ 1: ]:
+			other = store.family(i)
+			family['count'] += other['count']
+			family['seqs']  += other['seqs']
+		yield family
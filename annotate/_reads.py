@@ -0,0 +1,134 @@
+"""
+
+A compact read record for the UMI pipeline in 1.0-preprocess.py. Biopython
+    SeqRecords carry a Seq object, several dictionaries and lists, and the
+    quality scores as a list of Python ints (at least 8 bytes per base), which
+    adds up quickly when millions of reads are held in memory or pickled
+    between stages. A Read keeps just the id, the bases as bytes and the PHRED
+    scores as bytes (one byte per base, offset already removed).
+Slicing a Read does not copy anything: the new Read shares the original
+    buffers and only remembers which window of them it covers. Only the
+    visible window is written out when a Read is pickled.
+
+"""
+
+import io
+
+
+COMPLEMENT = bytes.maketrans( b"ACGTUMRWSYKVHDBNacgtumrwsykvhdbn", b"TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn" )
+PHRED      = bytes( max(i-33, 0) for i in range(256) )
+
+
+class Read:
+	"""id, bases and (optionally) quality scores of one sequence"""
+
+	__slots__ = ( 'id', '_seq', '_qual', '_start', '_end' )
+
+	def __init__(self, id, seq, qual=None, start=0, end=None):
+		self.id     = id
+		self._seq   = seq
+		self._qual  = qual
+		self._start = start
+		self._end   = len(seq) if end is None else end
+
+	def __len__(self):
+		return self._end - self._start
+
+	def __getitem__(self, key):
+		if not isinstance(key, slice) or key.step not in (None, 1):
+			raise TypeError( "Reads can only be sliced with a step of 1" )
+		start, end, step = key.indices( len(self) )
+		return Read( self.id, self._seq, self._qual, self._start + start, self._start + max(start, end) )
+
+	def __str__(self):
+		return self.bases()
+
+	def __repr__(self):
+		return "Read(%r, %r)" % ( self.id, self.bases() )
+
+	def __reduce__(self):
+		#only save the visible window
+		return ( Read, ( self.id, bytes(self.seq), None if self._qual is None else bytes(self.qual) ) )
+
+	@property
+	def seq(self):
+		"""the bases, as a memoryview of the underlying buffer"""
+		return memoryview(self._seq)[ self._start:self._end ]
+
+	@property
+	def qual(self):
+		"""the PHRED scores, as a memoryview of the underlying buffer, or None for fasta input"""
+		if self._qual is None:
+			return None
+		return memoryview(self._qual)[ self._start:self._end ]
+
+	def bases(self, start=0, end=None):
+		"""the bases from `start` to `end` as a string"""
+		start, end, step = slice(start, end).indices( len(self) )
+		return self._seq[ self._start+start : self._start+max(start, end) ].decode()
+
+	def rc_bases(self, start=0, end=None):
+		"""
+		bases `start` to `end` of the reverse complement, as a string, without
+		    reverse complementing the rest of the read
+		"""
+		start, end, step = slice(start, end).indices( len(self) )
+		return self._seq[ self._end-max(start, end) : self._end-start ].translate(COMPLEMENT)[ ::-1 ].decode()
+
+	def rc_qual(self, start=0, end=None):
+		"""PHRED scores matching rc_bases(), or None for fasta input"""
+		if self._qual is None:
+			return None
+		start, end, step = slice(start, end).indices( len(self) )
+		return self._qual[ self._end-max(start, end) : self._end-start ][ ::-1 ]
+
+	def reverse_complement(self):
+		"""a new Read with the reverse complement of the visible window"""
+		return Read( self.id, bytes(self.seq).translate(COMPLEMENT)[ ::-1 ],
+			     None if self._qual is None else bytes(self.qual)[ ::-1 ] )
+
+	def fasta(self):
+		return ">%s\n%s\n" % ( self.id, self.bases() )
+
+
+def read_records(handle, fileformat):
+	"""
+	yield Reads from a binary file handle
+	FASTQ input is assumed to have 4 lines per record
+	"""
+	if fileformat == "fastq":
+		for header in handle:
+			seq  = next(handle).rstrip()
+			next(handle)
+			qual = next(handle).rstrip().translate(PHRED)
+			yield Read( header[ 1: ].split(None, 1)[0].decode(), seq, qual )
+	else:
+		header, lines = None, []
+		for line in handle:
+			if line.startswith(b">"):
+				if header is not None:
+					yield Read( header, b"".join(lines) )
+				header, lines = line[ 1: ].split(None, 1)[0].decode(), []
+			else:
+				lines.append( line.rstrip() )
+		if header is not None:
+			yield Read( header, b"".join(lines) )
+
+
+def parse_reads(path, fileformat):
+	"""yield Reads from the file at `path`"""
+	with open(path, 'rb') as handle:
+		yield from read_records( handle, fileformat )
+
+
+def reads_from_string(text, fileformat="fasta"):
+	"""parse Reads out of a string or bytes, eg the output of a subprocess"""
+	if isinstance(text, str):
+		text = text.encode()
+	return list( read_records( io.BytesIO(text), fileformat ) )
+
+
+def write_reads(reads, handle):
+	"""write Reads to a text handle as fasta"""
+	for r in reads:
+		handle.write( r.fasta() )
@@ -0,0 +1,64 @@
+"""
+
+Load balancing for the consensus jobs in 1.0-preprocess.py. Clustering time
+    grows much faster than linearly with family size, so instead of cutting
+    the families into fixed-size chunks, each family (or hash partition of
+    families) gets an estimated cost and they are bin-packed into chunks of
+    roughly equal total cost, longest-processing-time first.
+Also cost estimates for ordering the J/D/C searches in 1.2-blast_J.py.
+
+"""
+
+import os, heapq, math
+
+
+def family_cost(reads, length):
+	"""
+	rough cost of generating consensus for one family; vsearch compares every
+	    read against the centroids found so far, so cost goes up with the
+	    square of family size
+	"""
+	return max(reads, 1) ** 2 * max(length, 1)
+
+
+def lpt_schedule(costs, bins):
+	"""
+	longest-processing-time-first bin packing: each item, from most to least
+	    expensive, goes into whichever bin currently has the lowest total
+	`costs` maps item -> estimated cost
+	returns a list of (total cost, [items]) for each non-empty bin
+	"""
+	heap = [ (0, b, []) for b in range(bins) ]
+	for item in sorted(costs, key=lambda x: costs[x], reverse=True):
+		total, b, items = heapq.heappop(heap)
+		items.append(item)
+		heapq.heappush(heap, (total + costs[item], b, items))
+
+	return [ (total, items) for total, b, items in heap if len(items) > 0 ]
+
+
+def search_cost(query, library):
+	"""
+	rough cost of a blast search: the size of the query file times the size
+	    of the germline library (or its BLAST database, if there is no fasta)
+	"""
+	if not os.path.isfile(library) and os.path.isfile(library + ".nsq"):
+		library += ".nsq"
+	size = lambda f: os.path.getsize(f) if os.path.isfile(f) else 0
+	return max( size(query), 1 ) * max( size(library), 1 )
+
+
+def memory_estimate(nbytes, minimum=8):
+	"""GB to request for a job holding `nbytes` of pickled reads, rounded up to a power of 2"""
+	return max( minimum, 1 << math.ceil( 4 * nbytes / 2**30 ).bit_length() )
+
+
+def order_chunks(chunks, memory):
+	"""
+	sort chunks (and their memory estimates) so that the biggest memory
+	    requests come first and, within each, the most expensive chunks; this
+	    keeps each memory tier contiguous for array job submission and lets
+	    local pools start on the slowest chunks first
+	"""
+	order = sorted( range(len(chunks)), key=lambda i: (memory[i], chunks[i][0]), reverse=True )
+	return [ chunks[i] for i in order ], [ memory[i] for i in order ]
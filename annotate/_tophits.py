@@ -0,0 +1,206 @@
+"""
+
+Picking the top germline hit for each query from tabular BLAST output.
+top_hit() walks through the rows for one query, as SONAR always has.
+select_top_hits() gives the same answers for a whole stream of rows, but
+    reads them a block of queries at a time into a numpy structured array
+    (HIT_DTYPE) and works out the usual case, a best hit plus any other
+    genes scoring within 3 bits of it, for every query in the block at once.
+    Queries where a second hit on the best gene or a second J gene could
+    change the answer are still handed to top_hit().
+
+"""
+
+import re, itertools
+import numpy
+
+from .. import MyAlignment
+
+
+HIT_DTYPE = numpy.dtype( [ ("query", numpy.int32), ("gene", numpy.int32), ("family", numpy.int32), ("strand", numpy.int8),
+			   ("qstart", numpy.int32), ("qend", numpy.int32), ("sstart", numpy.int32), ("send", numpy.int32),
+			   ("score", numpy.float64) ] )
+
+
+def top_hit(rows, maxQEnd=99999, minQStart=-1, strand=None):
+	"""
+	pick the top hit from the tabular blast output rows for a single query,
+	    returning (best alignment, other germline ids, top hit row, second
+	    match row), or None if none of its hits pass the filters
+	"""
+
+	best_alignment = None
+
+	for row in rows:
+
+		my_alignment = MyAlignment(row)
+
+		#CAS 2020-01-02
+		if strand is not None and not my_alignment.strand == strand:
+			continue
+
+		if best_alignment is None:
+
+			#skips D genes that matched 5' J
+			if my_alignment.qend > maxQEnd:
+				continue
+
+			#skips C genes that matched 3' J (not sure if necessary)
+			if my_alignment.qstart < minQStart:
+				continue
+
+			best_alignment = my_alignment
+			best_row = row
+			others = []
+			second_match = []
+
+		else:
+			#added 20150107 by CAS
+			'''
+			need three conditions:
+			1. hit is on same gene
+			2. hit is on same strand
+			3. hits are non-overlapping
+			'''
+			if my_alignment.sid == best_alignment.sid and my_alignment.strand == best_alignment.strand and (max(my_alignment.sstart, my_alignment.send)<min(best_alignment.sstart,best_alignment.send) or min(my_alignment.sstart, my_alignment.send)>max(best_alignment.sstart,best_alignment.send)):
+				second_match = row
+				#change boundaries of alignment on both query and hit (to get J properly)
+				if my_alignment.send < best_alignment.sstart:
+					best_alignment.sstart = my_alignment.sstart
+					if best_alignment.strand == "plus":
+						best_alignment.qstart = my_alignment.qstart
+					else:
+						best_alignment.qend = my_alignment.qend
+				else:
+					best_alignment.send = my_alignment.send
+					if best_alignment.strand == "plus":
+						best_alignment.qend = my_alignment.qend
+					else:
+						best_alignment.qstart = my_alignment.qstart
+
+			elif re.match("IG[HKL]J", my_alignment.sid) and my_alignment.score>=35 and my_alignment.qstart<best_alignment.qstart:
+				#a bit of kludge for double J matches. 
+				#Usually these are bad amplicons (or bad assemblies from single cell data)
+				#My assumption is that the one closer to the V is the more reliable one
+				best_alignment = my_alignment
+				best_row = row
+					
+			elif my_alignment.score >= best_alignment.score - 3 and my_alignment.sid.split("*")[0] != best_alignment.sid.split("*")[0] and not any( my_alignment.sid.split("*")[0] == x.split("*")[0] for x in others ):
+				others.append(my_alignment.sid)
+
+	if best_alignment is None:
+		return None
+	if len(others)>0:
+		best_row.append(",".join(others))
+	return best_alignment, others, best_row, second_match
+
+
+def iter_top_hits(rows, maxQEnd=dict(), minQStart=dict(), strand=None):
+	"""
+	pick the top hit for each query from tabular blast output rows, yielding
+	    (best alignment, other germline ids, top hit row, second match row)
+	    for each query as soon as all of its rows have been seen
+	"""
+	for qid, group in itertools.groupby( ( row for row in rows if len(row) == 13 ), key=lambda row: row[0].strip() ):
+		hit = top_hit( group, maxQEnd.get(qid, 99999), minQStart.get(qid, -1), strand )
+		if hit is not None:
+			yield hit
+
+
+def hit_table(rows):
+	"""
+	parse tabular blast rows, with the rows for each query next to each other,
+	    into a HIT_DTYPE array, returning it along with the query ids and gene
+	    names that its `query` and `gene` columns point to
+	`family` and `strand` are codes that are only good for comparing rows to
+	    each other
+	"""
+	table = numpy.empty( len(rows), dtype=HIT_DTYPE )
+
+	qids     = numpy.array( [ row[0].strip() for row in rows ] )
+	newQuery = numpy.ones( len(rows), dtype=bool )
+	newQuery[1:] = qids[1:] != qids[:-1]
+	table['query'] = numpy.cumsum(newQuery) - 1
+
+	genes, families, strands = dict(), dict(), dict()
+	table['gene']   = [ genes.setdefault( row[1].strip(), len(genes) ) for row in rows ]
+	geneFamily      = numpy.array( [ families.setdefault( g.split("*")[0], len(families) ) for g in genes ], dtype=numpy.int32 )
+	table['family'] = geneFamily[ table['gene'] ]
+	table['strand'] = [ strands.setdefault( row[12], len(strands) ) for row in rows ]
+
+	for column, field in [ (6, "qstart"), (7, "qend"), (8, "sstart"), (9, "send") ]:
+		table[field] = [ int(row[column]) for row in rows ]
+	table['score'] = [ float(row[11]) for row in rows ]
+
+	return table, list( qids[newQuery] ), list(genes)
+
+
+def _block_top_hits(rows, maxQEnd, minQStart):
+	#top_hit() for every query in `rows`, in order
+	table, queries, genes = hit_table(rows)
+	bounds = numpy.searchsorted( table['query'], numpy.arange(len(queries) + 1) )
+
+	#the first row to pass the position filters is the best hit, unless something below takes over
+	passed = numpy.ones( len(table), dtype=bool )
+	if len(maxQEnd) > 0:
+		passed &= table['qend'] <= numpy.array( [ maxQEnd.get(qid, 99999) for qid in queries ] )[ table['query'] ]
+	if len(minQStart) > 0:
+		passed &= table['qstart'] >= numpy.array( [ minQStart.get(qid, -1) for qid in queries ] )[ table['query'] ]
+	candidates = numpy.flatnonzero(passed)
+	found, first = numpy.unique( table['query'][candidates], return_index=True )
+	best = numpy.full( len(queries), -1 )
+	best[found] = candidates[first]
+
+	rowBest = best[ table['query'] ]
+	after   = ( rowBest >= 0 ) & ( numpy.arange(len(table)) > rowBest )
+	b       = table[ numpy.maximum(rowBest, 0) ]
+
+	#a second, non-overlapping hit on the best gene gets merged into it, and a
+	#    J gene closer to the V takes over as the best hit; either one depends
+	#    on the order of the rows, so those queries go through top_hit()
+	secondMatch = after & ( table['gene'] == b['gene'] ) & ( table['strand'] == b['strand'] ) & \
+		      ( ( numpy.maximum(table['sstart'], table['send']) < numpy.minimum(b['sstart'], b['send']) ) |
+			( numpy.minimum(table['sstart'], table['send']) > numpy.maximum(b['sstart'], b['send']) ) )
+	isJ         = numpy.array( [ re.match("IG[HKL]J", g) is not None for g in genes ], dtype=bool )
+	doubleJ     = after & isJ[ table['gene'] ] & ( table['score'] >= 35 ) & ( table['qstart'] < b['qstart'] )
+	slow        = numpy.zeros( len(queries), dtype=bool )
+	slow[ table['query'][ secondMatch | doubleJ ] ] = True
+
+	#everyone else: the first hit from each other gene family within 3 bits of the best one
+	close = numpy.flatnonzero( after & ~slow[ table['query'] ] & ( table['score'] >= b['score'] - 3 ) & ( table['family'] != b['family'] ) )
+	key   = table['query'][close].astype(numpy.int64) * ( table['family'].max(initial=0) + 1 ) + table['family'][close]
+	key, first = numpy.unique( key, return_index=True )
+	others = [ [] for qid in queries ]
+	for i in numpy.sort( close[first] ):
+		others[ table['query'][i] ].append( genes[ table['gene'][i] ] )
+
+	for g, qid in enumerate(queries):
+		if best[g] < 0:
+			continue
+		if slow[g]:
+			yield top_hit( rows[ bounds[g] : bounds[g+1] ], maxQEnd.get(qid, 99999), minQStart.get(qid, -1) )
+			continue
+		best_row = rows[ best[g] ]
+		if len(others[g]) > 0:
+			best_row.append( ",".join(others[g]) )
+		yield MyAlignment(best_row), others[g], best_row, []
+
+
+def select_top_hits(rows, maxQEnd=dict(), minQStart=dict(), strand=None, block=20000):
+	"""
+	same as iter_top_hits() for rows in query order, but picks the top hits
+	    about `block` rows at a time with numpy
+	"""
+	rows    = ( row for row in rows if len(row) == 13 and ( strand is None or row[12] == strand ) )
+	pending = []
+	for batch in iter( lambda: list( itertools.islice(rows, block) ), [] ):
+		pending.extend(batch)
+		#the last query may carry on into the next batch
+		last, cut = pending[-1][0].strip(), len(pending)
+		while cut > 0 and pending[cut-1][0].strip() == last:
+			cut -= 1
+		if cut > 0:
+			yield from _block_top_hits( pending[:cut], maxQEnd, minQStart )
+			pending = pending[cut:]
+	if len(pending) > 0:
+		yield from _block_top_hits( pending, maxQEnd, minQStart )
@@ -0,0 +1,277 @@
+"""
+
+Cell barcode/UMI extraction shared by find_umis.py and the in-process workers
+    used by 1.0-preprocess.py. Workers are set up once per process with
+    init_umi_worker(), so whitelists and patterns are only parsed once instead
+    of once per chunk.
+UMI groups can be written out already partitioned by a hash of (cell, umi),
+    so that each consensus job only needs to read in its own partition(s).
+    Partitions are saved in the packed format from _packed.py, so the size of
+    each group can be read back for load balancing without unpacking any
+    sequences.
+
+"""
+
+import os, re, sys, datetime, glob, pickle, zlib
+from collections import defaultdict
+
+from ._barcodes import load_whitelist
+from ._reads import parse_reads
+from ._packed import write_families, PackedFamilies, merge_packed
+from ._schedule import family_cost
+from ._checkpoint import Checkpoint, file_fingerprint
+
+
+IUPAC = { "A":"A", "C":"C", "G":"G", "T":"[UT]", "U":"[UT]", "M":"[AC]", "R":"[AG]", "W":"[AT]", "S":"[CG]", "Y":"[CT]", "K":"[GT]", "V":"[ACG]", "H":"[ACT]", "D":"[AGT]", "B":"[CGT]", "N":"[ACGTU]" }
+
+
+def _interval(option):
+	if option is None:
+		return 0, 0
+	return tuple( int(x) for x in option.split(",") )
+
+
+def umi_settings(options, fileformat, pe=False, revcomp=False):
+	"""
+	convert docopt-style options (as used by 1.0-preprocess.py and find_umis.py)
+	    into the settings used by find_umis_in_file, loading whitelists and
+	    converting IUPAC patterns to regular expressions
+	"""
+
+	settings = { 'format'  : fileformat,
+		     'cell'    : _interval(options['--cell']),
+		     'umi'     : _interval(options['--umi']),
+		     'umi2'    : _interval(options['--r2umi']),
+		     'minQ'    : int(options['--minQ']),
+		     'pe'      : pe,
+		     'revcomp' : revcomp }
+
+	for kind in ['cell', 'umi', 'umi2']:
+		settings[kind+'WhiteList'] = None
+		settings[kind+'Pattern']   = None
+		if options['--%sWhiteList'%kind] is not None:
+			settings[kind+'WhiteList'] = load_whitelist( options['--%sWhiteList'%kind], correct=not options.get('--noCorrect', False) )
+		elif options['--%sPattern'%kind] is not None:
+			settings[kind+'Pattern'] = re.compile( re.sub("\w", lambda x: IUPAC[x.group().upper()], options['--%sPattern'%kind]) )
+
+	return settings
+
+
+def _check_barcode(barcode, quals, whitelist, pattern, minQ, stats, fixed):
+	#returns the (possibly corrected) barcode, or None if the read should be discarded
+	if quals is not None and any( x < minQ for x in quals ):
+		stats['low_qual'] += 1
+		return None
+	elif whitelist is not None:
+		corrected = whitelist.lookup(barcode)
+		if corrected is None:
+			stats['bad_umi'] += 1
+		elif corrected != barcode:
+			stats[fixed] += 1
+		return corrected
+	elif pattern is not None and not pattern.match(barcode):
+		stats['bad_umi'] += 1
+		return None
+	return barcode
+
+
+def find_umis_in_file(fasta, settings):
+	"""
+	group the reads in `fasta` by (cell barcode, UMI)
+	returns a dictionary of UMI groups and a dictionary of counts for logging
+	"""
+
+	cb_start, cb_end     = settings['cell']
+	umi_start, umi_end   = settings['umi']
+	umi2_start, umi2_end = settings['umi2']
+
+	umi_dict = {}
+	stats    = { 'count':0, 'bad_umi':0, 'low_qual':0, 'fixed_cb':0, 'fixed_umi':0 }
+
+	print("%s: Starting to look for UMIs in %s" % (datetime.datetime.now(), fasta) )
+
+	if settings['pe']:
+		r2Parser = parse_reads( os.path.join(os.path.dirname(fasta), "r2" + os.path.basename(fasta)), settings['format'] )
+
+	#reads are kept as compact Read records (see _reads.py); slicing them
+	#    doesn't copy, and the barcodes on the reverse strand are read off
+	#    without reverse complementing the whole read
+	for seq in parse_reads( fasta, settings['format'] ):
+		stats['count'] += 1
+
+		#check for derep-ed ness
+		reads = 1
+
+		cell_barcode = seq.bases( cb_start, cb_end )
+		fwd_id       = seq.bases( umi_start, umi_end )
+		rev_id       = seq.rc_bases( umi2_start, umi2_end )
+		qual         = seq.qual
+
+		#check whitelists/patterns
+		if cell_barcode != "":
+			cell_barcode = _check_barcode( cell_barcode, qual[cb_start:cb_end] if qual is not None else None,
+						       settings['cellWhiteList'], settings['cellPattern'], settings['minQ'], stats, 'fixed_cb' )
+			if cell_barcode is None:
+				continue
+
+		if fwd_id != "":
+			fwd_id = _check_barcode( fwd_id, qual[umi_start:umi_end] if qual is not None else None,
+						 settings['umiWhiteList'], settings['umiPattern'], settings['minQ'], stats, 'fixed_umi' )
+			if fwd_id is None:
+				continue
+
+		if rev_id != "":
+			rev_id = _check_barcode( rev_id, seq.rc_qual(umi2_start, umi2_end),
+						 settings['umi2WhiteList'], settings['umi2Pattern'], settings['minQ'], stats, 'fixed_umi' )
+			if rev_id is None:
+				continue
+
+		#combine UMIs and trim them from sequence
+		molecule_id = fwd_id + rev_id
+		seq = seq[ max(cb_end, umi_end): ]
+		if umi2_end > 0:
+			seq = seq[ : -umi2_end]
+		if settings['pe']:
+			tempseq = next(r2Parser)
+			if re.sub("/1$","",seq.id) == re.sub("/2$","", tempseq.id):
+				seq = tempseq
+			else:
+				sys.exit( f"Error: sequence id mismatch between R1 and R2 in {fasta}: {seq.id} vs {tempseq.id}" )
+		elif settings['revcomp']:
+			seq = seq.reverse_complement()
+
+		if cell_barcode != "":
+			seq.id += ";cell=%s"%cell_barcode
+		if molecule_id	!= "":
+			seq.id += ";umi=%s"%molecule_id
+		else:
+			#no umi, but store cell barcode as the umi in the data structure to prevent errors
+			molecule_id = cell_barcode
+
+		if (cell_barcode, molecule_id) not in umi_dict:
+			umi_dict[ (cell_barcode, molecule_id) ] = { 'cell':cell_barcode, 'umi':molecule_id, 'count':reads, 'seqs':[seq] }
+		else:
+			umi_dict[ (cell_barcode, molecule_id) ]['count'] += reads
+			umi_dict[ (cell_barcode, molecule_id) ]['seqs'].append(seq)
+
+	if settings['pe']:
+		r2Parser.close()
+
+	print( "%s: Finished %s: %d sequences in %d UMIs; Corrected %d cell barcodes and %d UMIs with a single mismatch; Discarded %d reads with low quality UMIs and %d additional reads with illegal UMIs." % (datetime.datetime.now(), fasta, stats['count'], len(umi_dict), stats['fixed_cb'], stats['fixed_umi'], stats['low_qual'], stats['bad_umi']) )
+
+	return umi_dict, stats
+
+
+def merge_umi_groups(umi_dict, chunk_dict):
+	"""add the UMI groups found in one chunk to the running total"""
+	for key in chunk_dict:
+		if key not in umi_dict:
+			umi_dict[ key ] = chunk_dict[ key ]
+		else:
+			umi_dict[ key ]['count'] += chunk_dict[ key ]['count']
+			umi_dict[ key ]['seqs']  += chunk_dict[ key ]['seqs']
+	return umi_dict
+
+
+def umi_partition(cell, umi, partitions):
+	"""stable (across processes) 1-based partition number for a (cell, umi) key"""
+	return zlib.crc32( ("%s\t%s" % (cell, umi)).encode() ) % partitions + 1
+
+
+def spill_umi_groups(umi_dict, stem, partitions, tag):
+	"""
+	split the UMI groups found in one chunk by hash of (cell, umi) and write
+	    them to the spill file for `tag` in each partition directory, so that
+	    no single process ever has to hold all of the UMIs from a run
+	each chunk gets its own spill files, so a chunk can be redone (eg after an
+	    interrupted run) just by running it again
+	"""
+	byPartition = defaultdict( dict )
+	for key in umi_dict:
+		byPartition[ umi_partition(key[0], key[1], partitions) ][ key ] = umi_dict[ key ]
+
+	for part in byPartition:
+		write_families( "%s_%04d/%s.packed" % (stem, part, tag), byPartition[part].values() )
+
+
+def partition_stats(stem, partitions):
+	"""
+	estimated consensus cost and size on disk of each partition, from the group
+	    sizes in the spill files (see spill_umi_groups)
+	returns two dictionaries keyed by partition number
+	"""
+	costs   = dict()
+	nbytes  = dict()
+	for part in range(1, partitions+1):
+		sizes = defaultdict( lambda: [0, 0] )
+		spills = glob.glob( "%s_%04d/*.packed" % (stem, part) )
+		for spill in spills:
+			for key, (count, length) in PackedFamilies(spill).sizes().items():
+				sizes[key][0] += count
+				sizes[key][1] += length
+		if len(sizes) == 0:
+			continue
+		costs[part]  = sum( family_cost(count, length/count) for count, length in sizes.values() )
+		nbytes[part] = sum( os.path.getsize(f) for f in spills )
+	return costs, nbytes
+
+
+def load_umi_groups(path):
+	"""
+	load the UMI groups to be clustered from a packed file of groups (see
+	    _packed.py), a pickle of groups, a partition directory of spill files
+	    (see spill_umi_groups), or a .list file naming several partition
+	    directories (which are read in one at a time)
+	"""
+	if path.endswith(".list"):
+		return _iterate_partitions(path)
+	elif path.endswith(".packed"):
+		return iter( PackedFamilies(path) )
+	elif os.path.isdir(path):
+		return merge_packed( sorted( glob.glob("%s/*.packed" % path) ) )
+
+	with open(path, 'rb') as pickle_in:
+		return pickle.load(pickle_in)
+
+
+def _iterate_partitions(manifest):
+	with open(manifest, 'r') as handle:
+		partitions = [ line.strip() for line in handle if line.strip() != "" ]
+	for part in partitions:
+		yield from load_umi_groups(part)
+
+
+def finish_umi_chunk(fasta, umi_dict, stem, partitions, checkpoint=None):
+	"""
+	spill the UMI groups found in chunk `fasta` to the partitions and, if a
+	    checkpoint directory is given, mark the chunk as done
+	"""
+	tag = os.path.splitext( os.path.basename(fasta) )[0]
+	spill_umi_groups( umi_dict, stem, partitions, tag )
+	if checkpoint is not None:
+		Checkpoint(checkpoint).record( tag, file_fingerprint(fasta) )
+
+
+#in-process worker mode for multiprocessing.Pool
+_worker_settings = None
+
+def init_umi_worker(options, fileformat, pe=False, revcomp=False, stem=None, partitions=0, checkpoint=None):
+	"""Pool initializer: load whitelists and patterns once per worker process"""
+	global _worker_settings
+	_worker_settings = umi_settings(options, fileformat, pe=pe, revcomp=revcomp)
+	_worker_settings['stem']       = stem
+	_worker_settings['partitions'] = partitions
+	_worker_settings['checkpoint'] = checkpoint
+
+
+def umi_worker(fasta):
+	"""
+	find UMIs in one chunk; if the worker was set up with partitions, spill the
+	    groups to disk and only hand the chunk name and counts back to the parent
+	"""
+	umi_dict, stats = find_umis_in_file(fasta, _worker_settings)
+	if _worker_settings['stem'] is None:
+		return umi_dict, stats
+
+	finish_umi_chunk( fasta, umi_dict, _worker_settings['stem'], _worker_settings['partitions'], _worker_settings['checkpoint'] )
+	return fasta, stats
@@ -5,21 +5,42 @@ cluster_umis.py
 
 This is a helper script to split up UMI consensus generation.
 
-Usage: cluster_umis.py PICKLE MINSIZE DIR [ --isCell --isFeature ]
+Usage: cluster_umis.py PICKLE MINSIZE DIR [ --isCell --isFeature --splitCollisions --fastConsensus N --checkpoint DIR ]
 
 Options:
-    PICKLE          Pickled umi dictionary produced by 1.0-preprocess.py
+    PICKLE          Packed (or pickled) umi groups produced by 1.0-preprocess.py,
+                        a partition directory of spill files from find_umis.py,
+                        or a .list file naming several partition directories
     MINSIZE         Minimum reads/umi or umis/cell
-    DIR             Directory in which to carry out clustering
+    DIR             Working directory for the run (consensus generation is streamed
+                        through vsearch, so no per-UMI files are written here)
     --isCell        Flag to indicate generation of cell metaconsenus (instead of
 	                    individual UMI consensus) [default: False]
     --isFeature     Flag to adjust clustering for short feature barcoding oligos
 	                    instead of V(D)Js [default: False]
+    --splitCollisions   Flag to keep every cluster with at least MINSIZE reads when the
+                            reads of a single UMI form more than one cluster, on the
+                            assumption that they are different molecules that happen to
+                            share a UMI. By default, only the largest cluster is kept.
+                            (Not used for cell metaconsensus.) [default: False]
+    --fastConsensus N   UMIs with at most this many reads of equal length get a
+                            quality-weighted consensus computed directly instead of
+                            being sent to vsearch. The consensus can differ from
+                            vsearch's where reads disagree. Use 0 to always run vsearch.
+                            (Not used for cell metaconsensus.) [default: 0]
+    --checkpoint DIR    Directory in which to record that this chunk has been finished,
+                            so that 1.0-preprocess.py --resume can skip it.
 
 Split out from 1.0-preprocess.py by Chaim A Schramm on 2019-06-18.
 Added option for feature barcodes by CA Schramm 2019-10-08.
 Tweaked clustering thresholds by CAS 2020-02-04.
 Changed minUMIs to a per metaconsenus (instead of per cell) threshold by CAS 2020-02-12.
+Stream reads to vsearch over a pipe instead of writing a directory per cell and a file per UMI.
+Added optional built-in consensus for small UMI families (--fastConsensus, off by default).
+Added checkpointing.
+Switched from SeqRecords to the lighter-weight Read records from _reads.py.
+Read families from packed, memory-mapped files.
+Added `--splitCollisions`.
 
 Copyright (c) 2019-2020 Vaccine Research Center, National Institutes of Health, USA.
     All rights reserved.
@@ -30,7 +51,6 @@ import sys, os, re, pickle
 from docopt import docopt
 import datetime
 from collections import defaultdict
-from Bio import SeqIO
 
 try:
     from SONAR.annotate import *
@@ -42,17 +62,36 @@ except ImportError:
 
 def main():
 
-	with open(arguments['PICKLE'], 'rb') as pickle_in:
- 		umi_iter = pickle.load(pickle_in)
+	#fingerprint the input before starting, for the checkpoint
+	if arguments['--checkpoint'] is not None:
+		fingerprint = chunk_fingerprint( arguments['PICKLE'] )
+
+	umi_iter = load_umi_groups( arguments['PICKLE'] )
+
+	idThreshold = "0.95"
+	if arguments['--isCell']:
+		idThreshold = "0.99"
+
+	lenOpts   = [ "-mincols", '150' ] #VDJ alignment overlap
+	minLength = 150
+	if arguments['--isFeature']:
+		lenOpts   = [ "-minseqlength", '10' ] #in case of naked feature barcodes
+		minLength = 10
+
+	fastSize = 0 if arguments['--isCell'] else arguments['--fastConsensus']
 
 	results = {}
 	small	= 0
 	multi	= 0
+	collisions = 0
+	groups  = []
 
 	print( f"{datetime.datetime.now()}: Generating consensus sequences from {arguments['PICKLE']}..." )
 
 	for umi in umi_iter:
 
+		groups.append( (umi['cell'], umi['umi'], umi['count']) )
+
 		#check thresholds
 		#for UMIs (isCell==False) use count, in case I eventually implement dereplication
 		#for metaconsenus (isCell==True), use len(seqs), because care about the number of UMIs, not the total reads
@@ -64,10 +103,8 @@ def main():
 			#save time on singletons (if they weren't excluded by the read threshold)
 			if arguments['--isCell']:
 				umi['seqs'][0].id = "%s.1 cell_id=%s duplicate_count=1 consensus_count=%s"%( umi['cell'], umi['cell'], umi['count'] )
-				umi['seqs'][0].description = ""
 			else:
 				umi['seqs'][0].id += ";seqs=1;size=%d;consensus_count=%d" % (umi['count'],umi['count'])
-				umi['seqs'][0].description = ""
 
 			if (umi['cell']) not in results:
 				results[ umi['cell'] ] = { 'cell':umi['cell'], 'umi':umi['cell'], 'count':1, 'seqs':umi['seqs'].copy() }
@@ -77,68 +114,63 @@ def main():
 
 		else:
 
-			subdir = arguments['DIR']
-			#iddef  = "3"
-			if not arguments['--isCell']:
-				subdir += "/%s" % umi['cell']
-				#iddef = "2"
-
-			#cluster and rapid align with vsearch
-			os.makedirs(subdir, exist_ok=True)
-			with open("%s/%s.fa" % (subdir, umi['umi']), "w") as handle:
-				SeqIO.write(umi['seqs'], handle, "fasta")
-
-			idThreshold = "0.95"
-			if arguments['--isCell']:
-				idThreshold = "0.99"
-
-			lenOpts = [ "-mincols", '150' ] #VDJ alignment overlap
-			if arguments['--isFeature']:
-				lenOpts = [ "-minseqlength", '10' ] #in case of naked feature barcodes
-
-			subprocess.call([vsearch,
-					 "-cluster_fast", "%s/%s.fa" % (subdir, umi['umi']),
-					 "-consout", "%s/%s_cons.fa" % (subdir, umi['umi']),
-					 "-id", idThreshold,
-					 "-iddef", "3",
-					 "-sizein", "-sizeout",
-					 "-gapopen", "10I/10E", #lower gap open penalty to better account for internal indels
-					 "-gapext", "2I/2E", #don't make endgaps cheaper; encourages TSOs to align properly
-					 "-clusterout_sort", #so we can look at just the biggest
-					 "-quiet" #supress screen clutter
-					 ] + lenOpts )
-
-			with open("%s/%s_cons.fa" % (subdir, umi['umi']), 'r') as cons_file:
-				seq_number = 0
-				for cons in SeqIO.parse(cons_file, "fasta"):
-					seq_number += 1
-					if not arguments['--isCell'] and seq_number > 1:
-						#how to handle more than one cluster per umi?
-						#  -depends on presence/absence of cell barcodes, I guess. user param?
-						#use it to do error checking???
-						multi += 1
-						break
-
-					num_reads = re.search(";seqs=(\d+);size=(\d+)",cons.id)
-					if num_reads:
-						if int(num_reads.group(2)) < arguments['MINSIZE']:
-							small += 1
-							continue
-
-						if arguments['--isCell']:
-							cons.id	 = "%s.%d cell_id=%s duplicate_count=%s consensus_count=%s"%( umi['cell'], seq_number, umi['cell'], num_reads.group(1), num_reads.group(2) )
-						else:
-							cons.id += ";consensus_count=%s" % num_reads.group(2) #save size annotation for further clustering/dereplication
-
-						cons.description = ""
-						if (umi['cell']) not in results:
-							results[ umi['cell'] ] = { 'cell':umi['cell'], 'umi':umi['cell'], 'count':int(num_reads.group(2)), 'seqs':[cons] }
-						else:
-							results[ umi['cell'] ]['count'] += int(num_reads.group(2))
-							results[ umi['cell'] ]['seqs'].append(cons)
-
-	with open(re.sub("cons_in","cons_out",arguments["PICKLE"]), 'wb') as pickle_out:
-		pickle.dump( {'results':results, 'small':small, 'multi':multi}, pickle_out )
+			#small families of equal length reads don't need an alignment
+			consensus = None
+			if len(umi['seqs']) <= fastSize:
+				quick = quick_consensus( umi['seqs'], float(idThreshold), minLength )
+				if quick is not None:
+					consensus = [ quick ]
+
+			#otherwise cluster and rapid align with vsearch, streaming reads in and
+			#    consensus sequences out over pipes instead of writing per-UMI files
+			if consensus is None:
+				consensus = vsearch_consensus( umi['seqs'], idThreshold, lenOpts )
+
+			seq_number = 0
+			for cons in consensus:
+				seq_number += 1
+				if not arguments['--isCell'] and seq_number > 1 and not arguments['--splitCollisions']:
+					#how to handle more than one cluster per umi?
+					#  -depends on presence/absence of cell barcodes, I guess. user param?
+					#use it to do error checking???
+					multi += 1
+					break
+
+				num_reads = re.search(";seqs=(\d+);size=(\d+)",cons.id)
+				if num_reads:
+					if int(num_reads.group(2)) < arguments['MINSIZE']:
+						if not arguments['--isCell'] and seq_number > 1:
+							#clusters are sorted by size, so this and anything after it are
+							#    just stray reads, not another molecule
+							multi += 1
+							break
+						small += 1
+						continue
+
+					if arguments['--isCell']:
+						cons.id	 = "%s.%d cell_id=%s duplicate_count=%s consensus_count=%s"%( umi['cell'], seq_number, umi['cell'], num_reads.group(1), num_reads.group(2) )
+					else:
+						cons.id += ";consensus_count=%s" % num_reads.group(2) #save size annotation for further clustering/dereplication
+						if seq_number > 1:
+							#another big cluster: most likely a second molecule that got the same UMI
+							cons.id += ";collision=%d" % seq_number
+							if seq_number == 2:
+								collisions += 1
+
+					if (umi['cell']) not in results:
+						results[ umi['cell'] ] = { 'cell':umi['cell'], 'umi':umi['cell'], 'count':int(num_reads.group(2)), 'seqs':[cons] }
+					else:
+						results[ umi['cell'] ]['count'] += int(num_reads.group(2))
+						results[ umi['cell'] ]['seqs'].append(cons)
+
+	outFile = re.sub( "cons_in", "cons_out", re.sub("\\.(pickle|packed|list)$", "", arguments["PICKLE"].rstrip("/")) ) + ".pickle"
+	#write to a temp file first so that an interrupted job never leaves a partial output
+	with open(outFile+".tmp", 'wb') as pickle_out:
+		pickle.dump( {'results':results, 'small':small, 'multi':multi, 'collisions':collisions, 'groups':groups}, pickle_out )
+	os.replace(outFile+".tmp", outFile)
+
+	if arguments['--checkpoint'] is not None:
+		Checkpoint( arguments['--checkpoint'] ).record( arguments['PICKLE'], fingerprint, [outFile] )
 
 	print( f"{datetime.datetime.now()}: Finished processing {arguments['PICKLE']}" )
 
@@ -148,6 +180,7 @@ if __name__ == '__main__':
 	arguments = docopt(__doc__)
 
 	arguments['MINSIZE'] = int( arguments['MINSIZE'] )
+	arguments['--fastConsensus'] = int( arguments['--fastConsensus'] )
 
 	prj_tree = ProjectFolders( os.getcwd() )
 	prj_name = fullpath2last_folder(prj_tree.home)
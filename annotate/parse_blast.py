@@ -21,6 +21,14 @@ Added locus consistency checks by CAS 2020-01-02.
 Added `complete_vdj` flag by CAS 2020-07-16.
 Tried to fix `complete_vdj` determination a bit (but it still needs more work) by
     CA Schramm 2021-0707.
+Read cached hits and add new results to the germline hit cache.
+Read V and J calls made by the k-mer index engine.
+Walk the reads and all of the hit files together in query order, instead of
+    loading every top hit into memory first.
+Look up germline cysteine/J motif positions, loci and lengths in a precomputed
+    feature table instead of searching for them for every read.
+Pick V and J top hits a block of reads at a time with select_top_hits().
+Write this chunk's nucleotide and amino acid FASTA outputs for 1.3.
 
 Copyright (c) 2019-2021 Vaccine Research Center, National Institutes of Health, USA.
 All rights reserved.
@@ -40,17 +48,15 @@ except ImportError:
 	from SONAR.annotate import *
 
 
-def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_read,jgaps,read_sequence):
+def find_cdr3_borders(vgene,vlength,vend,jgene,jstart,j_start_on_read,jgaps,read_sequence):
 
 	'''
-	v_id = name of assigned V gene (eg IGHV1-2*02)
-	vgene = germline sequence of assigned V gene
+	vgene = germline features (GeneFeatures) of assigned V gene
 	vlength = length of QUERY sequence taken up by match
 		(might be different from blast-reported length 
 		and/or vend-vstart+1 because of in-dels)
-	vstart = position on germline V gene where match begins (hopefully = 1)
 	vend = position on germline V gene where match ends
-	jgene = germline sequence of assigned J gene
+	jgene = germline features (GeneFeatures) of assigned J gene
 	jstart = position on germline J gene where match begins
 	j_start_on_read = position on query (v-cut version, not full 454 read) 
 		where match with germline J begins
@@ -58,22 +64,10 @@ def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_rea
 	read_sequence = V(D)J-trimmed sequence of the 454 read
 	'''
 
-	vMatches = []
-	cys_pat = "TG[T|C|N]" #N is for a couple of shorter V's, like VH4-31
-	if re.match("IGLV2-(11|23)", v_id):
-		cys_pat = "TGCTGC" #special case
-	if re.match("IGHV1-C",v_id):
-		cys_pat = "TATGC"
-	for m in re.finditer(cys_pat,vgene,flags=re.I):
-		vMatches.append(m)
-
-	#last one **IN FRAME** is the cysteine we want! (matters for light chains)
+	#position of the in-frame cysteine on the germline V was found when the feature table was built
 	cdr3_start=-1
-	vMatches.reverse()
-	for cys in vMatches:
-		if cys.start() % 3 == 0:
-			cdr3_start = vlength - (vend - cys.start())
-			break
+	if vgene.anchor >= 0:
+		cdr3_start = vlength - (vend - vgene.anchor)
 		
 	# If BLAST has truncated the V gene alignment prior to reaching the conserved cysteine, but still found the J gene,
 	#	 that likely indicates a large in-del, which must be accounted for, or the start position of CDR 3 will be wrong.
@@ -87,13 +81,11 @@ def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_rea
 		else:
 			cdr3_start = -1
 
-	jMatch = re.search(arguments['--jmotif'],jgene,flags=re.I)
-	WF_motif = -1 #pass back to main program to check for out-of-frame junctions
+	WF_motif = jgene.anchor #pass back to main program to check for out-of-frame junctions
 
-	try:
-		cdr3_end = vlength + j_start_on_read + (jMatch.start() - jstart) +3
-		WF_motif = jMatch.start()
-	except:
+	if WF_motif >= 0:
+		cdr3_end = vlength + j_start_on_read + (WF_motif - jstart) +3
+	else:
 		cdr3_end = -1 #if we didn't find the motif, we'll count it as a bad cdr3 without crashing
 
 	if jgaps > 0:
@@ -109,6 +101,30 @@ def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_rea
 
 	return cdr3_start, cdr3_end, WF_motif
 
+
+def write_top_hit(found, topHitWriter=None):
+	#(best alignment, other germline ids) from a top hit, writing out its rows
+	if found is None:
+		return None, []
+	best_alignment, others, aline, second_match = found
+	if topHitWriter is not None:
+		topHitWriter.writerow(aline)
+		if len(second_match)>0:
+			topHitWriter.writerow(second_match)
+	return best_alignment, others
+
+
+def next_top_hit(hits, qid, topHitWriter=None, **filters):
+	#top hit for `qid` from a QueryStream of blast hits, as (best alignment, other germline ids)
+	#    queries have to be asked for in order, since only the current one is held in memory
+	return write_top_hit( top_hit( hits.get(qid, []), **filters ), topHitWriter )
+
+
+def selected_top_hits(paths, **filters):
+	#QueryStream of the top hits select_top_hits() picks from tabular blast outputs, for filters that don't depend on other genes
+	return QueryStream( ( found[0].qid, found ) for found in select_top_hits( hit_rows(paths), **filters ) )
+
+
 def main():
 
 	print( "Processing chunk %s..." % arguments['--chunk'])
@@ -121,9 +137,6 @@ def main():
 
 	writer = csv.writer(open("%s/jtophit_%s.txt" %(prj_tree.jgene, arguments['--chunk']), "w"), delimiter = sep, dialect='unix', quoting=csv.QUOTE_NONE)
 	writer.writerow(PARSED_BLAST_HEADER)
-	dict_jcounts = dict()
-	dict_ccounts = dict()
-	dict_dcounts = dict()
 		
 	c = False
 	if os.path.isfile("%s/%s_C_%s.txt" % (prj_tree.jgene, prj_name, arguments['--chunk'])):
@@ -140,18 +153,30 @@ def main():
 
 	seq_stats = airr.create_rearrangement( "%s/rearrangements_%s.tsv"%(prj_tree.internal, arguments['--chunk']), fields=['complete_vdj','vj_in_frame','stop_codon','locus','c_call','junction_length','source_file','source_id','duplicate_count','length_raw','length_trimmed','indels','status','blast_identity','consensus_count','cell_id'])
 
-	dict_vgerm_aln, dict_other_vgerms, dict_vcounts = get_top_hits("%s/%s_%s.txt"%(prj_tree.vgene, prj_name, arguments['--chunk']) )
-	dict_jgerm_aln, dict_other_jgerms, dict_jcounts = get_top_hits("%s/%s_%s.txt"%(prj_tree.jgene, prj_name, arguments['--chunk']), topHitWriter=writer, dict_germ_count=dict_jcounts, strand="plus" )
-
+	#blast output for each gene, plus any hits 1.1 and 1.2 found in the cache
+	blastOutputs = { gene : "%s/%s%s_%s.txt"%(prj_tree.jgene, prj_name, suffix, arguments['--chunk']) for gene, suffix in [ ("J", ""), ("D", "_D"), ("C", "_C") ] }
+	cachedHits   = { gene : existing( "%s/cached%s_%s.txt"%(prj_tree.jgene, suffix, arguments['--chunk']) ) for gene, suffix in [ ("J", ""), ("D", "_D"), ("C", "_C") ] }
+	#and J calls from the k-mer index, if it was used (those reads weren't blasted)
+	kmerJ        = existing( "%s/kmer_%s.txt"%(prj_tree.jgene, arguments['--chunk']) )
+
+	#every file is in query order, like the reads, so they can all be walked
+	#    through together one read at a time
+	#    V and J top hits are picked in blocks, but D and C need the J hit of each read first
+	vHits = selected_top_hits( [ "%s/%s_%s.txt"%(prj_tree.vgene, prj_name, arguments['--chunk']) ] + existing("%s/cached_%s.txt"%(prj_tree.vgene, arguments['--chunk']), "%s/kmer_%s.txt"%(prj_tree.vgene, arguments['--chunk'])) )
+	jHits = selected_top_hits( [ blastOutputs['J'] ] + cachedHits['J'] + kmerJ, strand="plus" )
 	if c:
-		minCStartPos = dict( [ (x, dict_jgerm_aln[x].qend) for x in dict_jgerm_aln.keys() ] )
-		dict_cgerm_aln, dict_other_cgerms, dict_ccounts = get_top_hits("%s/%s_C_%s.txt"%(prj_tree.jgene, prj_name, arguments['--chunk']), topHitWriter=cWriter, dict_germ_count=dict_ccounts, minQStart=minCStartPos, strand="plus" )
-
+		cHits = QueryStream( hit_groups( [ blastOutputs['C'] ] + cachedHits['C'] ) )
 	if d:
-		maxDEndPos = dict( [ (x, dict_jgerm_aln[x].qstart) for x in dict_jgerm_aln.keys() ] )
-		dict_dgerm_aln, dict_other_dgerms, dict_dcounts = get_top_hits("%s/%s_D_%s.txt"%(prj_tree.jgene, prj_name, arguments['--chunk']), topHitWriter=dWriter, dict_germ_count=dict_dcounts, maxQEnd=maxDEndPos, strand="plus" )
+		dHits = QueryStream( hit_groups( [ blastOutputs['D'] ] + cachedHits['D'] ) )
 
-	for entry in SeqIO.parse( "%s/%s_%s.fasta" % (prj_tree.vgene, prj_name, arguments['--chunk']), "fasta"):
+	#add the new J/D/C results to the cache
+	if hitCache is not None:
+		searched = { gene : blastOutputs[gene] for gene, run in [ ("J", True), ("D", d), ("C", c) ] if run }
+		searched['J'] = [ blastOutputs['J'] ] + kmerJ
+		hitCache.store( jLibrary, ( (e.id, str(e.seq)) for e in SeqIO.parse("%s/%s_%s.fasta" % (prj_tree.jgene, prj_name, arguments['--chunk']), "fasta") ), searched )
+		hitCache.close()
+
+	for entry in chunk_reads( "%s/%s_%s.fasta" % (prj_tree.vgene, prj_name, arguments['--chunk']), "%s/cached_%s.fasta" % (prj_tree.vgene, arguments['--chunk']), "%s/kmer_%s.fasta" % (prj_tree.vgene, arguments['--chunk']) ):
 		total += 1
 
 		raw_stats = next(raw)
@@ -177,29 +202,34 @@ def main():
 			rearrangement['consensus_count'] = raw_stats[5]
 		if not raw_stats[6] == "NA":
 			rearrangement['cell_id'] = raw_stats[6]
+
+		#look up every gene for every read, so that all of the top hits get written out
+		myV, otherV = write_top_hit( vHits.get(entry.id) )
+		myJ, otherJ = write_top_hit( jHits.get(entry.id), writer )
+		myC, otherC = None, []
+		if c:
+			#skip C genes that matched 3' J
+			myC, otherC = next_top_hit( cHits, entry.id, cWriter, minQStart=myJ.qend if myJ is not None else -1, strand="plus" )
+		myD, otherD = None, []
+		if d:
+			#skip D genes that matched 5' J
+			myD, otherD = next_top_hit( dHits, entry.id, dWriter, maxQEnd=myJ.qstart if myJ is not None else 99999, strand="plus" )
 				
-		if not entry.id in dict_vgerm_aln:
+		if myV is None:
 			noV+=1
 			rearrangement['status'] = 'noV'
 			seq_stats.write(rearrangement)
-		elif not entry.id in dict_jgerm_aln:
+		elif myJ is None:
 			noJ+=1
-			myV = dict_vgerm_aln[entry.id]
 			entry.seq = entry.seq[ myV.qstart - 1 : myV.qend ]
 			if (myV.strand == 'minus'):
 				entry.seq = entry.seq.reverse_complement()
 				rearrangement['rev_comp']       = "T"
 			else:
 				rearrangement['rev_comp']       = "F"
-			myVgenes = ",".join( [myV.sid] + dict_other_vgerms.get(entry.id,[]) )
+			myVgenes = ",".join( [myV.sid] + otherV )
 			
-			vlocus = ""
-			if re.search( "(HV|VH|heavy)", myV.sid, re.I ):
-				vlocus = "IGH"
-			elif re.search( "(LV|VL|lambda)", myV.sid, re.I ):
-				vlocus = "IGL"
-			elif re.search( "(KV|VK|kappa)", myV.sid, re.I ):
-				vlocus = "IGK"
+			vlocus = dict_v_features[myV.sid].locus
 
 			rearrangement['v_call'] = myVgenes
 			rearrangement['locus']  = vlocus
@@ -211,8 +241,6 @@ def main():
 		else:
 				
 			found += 1
-			myV = dict_vgerm_aln[entry.id]
-			myJ = dict_jgerm_aln[entry.id]
 			added5 = 0
 			added3 = 0
 			productive = "T"
@@ -220,23 +248,20 @@ def main():
 			stop = "F"
 			cdr3 = True
 			
-			vlocus = ""
-			if re.search( "(HV|VH|heavy)", myV.sid, re.I ):
-				vlocus = "IGH"
-			elif re.search( "(LV|VL|lambda)", myV.sid, re.I ):
-				vlocus = "IGL"
-			elif re.search( "(KV|VK|kappa)", myV.sid, re.I ):
-				vlocus = "IGK"
+			vlocus = dict_v_features[myV.sid].locus
+
+			myJfeatures = dict_j_features[myJ.sid]
+			jLength     = myJfeatures.length
 
 			#get actual V(D)J sequence
 			v_len = myV.qend - (myV.qstart-1) #need to use qstart and qend instead of alignment to account for gaps
 
 			#try to recover 3' of J
-			if myJ.send < len(dict_j[myJ.sid].seq) and \
-				 ( (myV.strand == "plus" and myV.qstart + v_len + myJ.qend + (len(dict_j[myJ.sid].seq)-myJ.send) <= len(entry.seq)) or \
-					(myV.strand == "minus" and myV.qend - (v_len + myJ.qend + (len(dict_j[myJ.sid].seq)-myJ.send)) >= 0) ):
-					vdj_len = v_len + myJ.qend + (len(dict_j[myJ.sid].seq) - myJ.send)
-					added3 = len(dict_j[myJ.sid].seq) - myJ.send
+			if myJ.send < jLength and \
+				 ( (myV.strand == "plus" and myV.qstart + v_len + myJ.qend + (jLength-myJ.send) <= len(entry.seq)) or \
+					(myV.strand == "minus" and myV.qend - (v_len + myJ.qend + (jLength-myJ.send)) >= 0) ):
+					vdj_len = v_len + myJ.qend + (jLength - myJ.send)
+					added3 = jLength - myJ.send
 			else:
 				vdj_len = v_len + myJ.qend
 
@@ -280,11 +305,11 @@ def main():
 					entry.seq = entry.seq[ myV.qend - vdj_len : myV.qend ].reverse_complement()
 
 			#check for complete VDJ
-			if min(myV.sstart, myV.send)+added5 == 1 and max(myJ.sstart, myJ.send)+added3 >= len(dict_j[myJ.sid].seq)-1: #-1 because the last nucleotide is part of the constant region
+			if min(myV.sstart, myV.send)+added5 == 1 and max(myJ.sstart, myJ.send)+added3 >= jLength-1: #-1 because the last nucleotide is part of the constant region
 				rearrangement['complete_vdj'] = True
 
 			#get CDR3 boundaries
-			cdr3_start,cdr3_end,WF_motif = find_cdr3_borders(myV.sid,str(dict_v[myV.sid].seq), v_len, min(myV.sstart, myV.send), max(myV.sstart, myV.send), str(dict_j[myJ.sid].seq), myJ.sstart, myJ.qstart, myJ.gaps, str(entry.seq[ added5 : ])) #min and max statments take care of switching possible minus strand hit
+			cdr3_start,cdr3_end,WF_motif = find_cdr3_borders(dict_v_features[myV.sid], v_len, max(myV.sstart, myV.send), myJfeatures, myJ.sstart, myJ.qstart, myJ.gaps, str(entry.seq[ added5 : ])) #max statement takes care of switching possible minus strand hit
 			cdr3_seq = entry.seq[ added5+cdr3_start : added5+cdr3_end ]
 
 			#push the sequence into frame for translation, if need be
@@ -332,19 +357,18 @@ def main():
 				status = "missingNterm"
 
 			#add germline assignments to fasta description and write to disk
-			myVgenes = ",".join( [myV.sid] + dict_other_vgerms.get(entry.id,[]) )
-			myJgenes = ",".join( [myJ.sid] + dict_other_jgerms.get(entry.id,[]) )
+			myVgenes = ",".join( [myV.sid] + otherV )
+			myJgenes = ",".join( [myJ.sid] + otherJ )
 				
 			myDgenes = ""
-			if d:
-				if entry.id in dict_dgerm_aln:
-					if not vlocus in ["IGK", "IGL"]:
-						#supress spurious D gene hits if it's a light chain
-						myDgenes = ",".join( [dict_dgerm_aln[entry.id].sid] + dict_other_dgerms.get(entry.id,[]) )
+			if myD is not None:
+				if not vlocus in ["IGK", "IGL"]:
+					#supress spurious D gene hits if it's a light chain
+					myDgenes = ",".join( [myD.sid] + otherD )
 
 			myCgenes = ""
-			if c and entry.id in dict_cgerm_aln:
-				myCgenes = ",".join( [dict_cgerm_aln[entry.id].sid] + dict_other_cgerms.get(entry.id,[]) )
+			if myC is not None:
+				myCgenes = ",".join( [myC.sid] + otherC )
 			elif not arguments['--noFallBack']:
 				if re.match("C[CT]", const_seq):
 					myCgenes = "IGHG" #could also be IgE, but I'm assuming that's rare
@@ -359,13 +383,7 @@ def main():
 				elif re.match("GGT", const_seq):
 					myCgenes = "IGLC"
 
-			jlocus = ""
-			if re.search( "(HJ|JH|heavy)", myJ.sid, re.I ):
-				jlocus = "IGH"
-			elif re.search( "(LJ|Jl|lambda)", myJ.sid, re.I ):
-				jlocus = "IGL"
-			elif re.search( "(KJ|JK|kappa)", myJ.sid, re.I ):
-				jlocus = "IGK"
+			jlocus = myJfeatures.locus
 
 			if not vlocus == jlocus:
 				#this really shouldn't happen unless one or both gene assignments are
@@ -410,6 +428,9 @@ def main():
 
 	seq_stats.close()
 
+	#and this chunk's share of the FASTA outputs, for 1.3 to stick together
+	write_chunk_fastas( airr.read_rearrangement("%s/rearrangements_%s.tsv"%(prj_tree.internal, arguments['--chunk'])), prj_tree.jgene, arguments['--chunk'] )
+
 
 if __name__ == '__main__':
 	
@@ -426,6 +447,19 @@ if __name__ == '__main__':
 	jlib    = handle.readline().strip()
 
 	dict_v = load_fastas(vlib)
-	dict_j = load_fastas(jlib)
+
+	#cysteine and J motif positions, loci and lengths of the germline genes,
+	#    so they don't have to be looked up for every read
+	dict_v_features = germline_features(vlib, "V", folder=prj_tree.internal)
+	dict_j_features = germline_features(jlib, "J", arguments['--jmotif'], folder=prj_tree.internal)
+
+	#germline hit cache, if one was set up by 1.1
+	hitCache, jLibrary = None, None
+	if os.path.isfile( "%s/hit_cache.txt" % prj_tree.internal ):
+		with open( "%s/hit_cache.txt" % prj_tree.internal ) as handle:
+			cacheDir = handle.readline().strip()
+			vLibrary = handle.readline().strip()
+			jLibrary = handle.readline().strip()
+		hitCache = HitCache( cacheDir )
 
 	main()
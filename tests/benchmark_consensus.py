@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+benchmark_consensus.py
+
+Compares the built-in small-family consensus used by cluster_umis.py with the
+    vsearch path, on simulated UMI families with sequencing errors. Reports how
+    often the fast path was taken, how often its consensus agreed with vsearch,
+    and the time spent in each.
+
+Usage: benchmark_consensus.py [ --families 2000 --maxSize 5 --length 450 --errorRate 0.005 --seed 1 ]
+
+Options:
+    --families 2000     Number of UMI families to simulate. [default: 2000]
+    --maxSize 5         Largest family size to simulate (smallest is 2). [default: 5]
+    --length 450        Read length. [default: 450]
+    --errorRate 0.005   Per-base substitution rate. [default: 0.005]
+    --seed 1            Random seed. [default: 1]
+
+"""
+
+import sys, random, time
+from docopt import docopt
+
+try:
+	from SONAR.annotate import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("SONAR/tests")
+	sys.path.append(find_SONAR[0])
+	from SONAR.annotate import *
+
+
+def simulateFamily(num, size, length, errorRate):
+	template = "".join( random.choice("ACGT") for i in range(length) )
+	reads = []
+	for r in range(size):
+		bases, quals = [], []
+		for b in template:
+			if random.random() < errorRate:
+				bases.append( random.choice( [x for x in "ACGT" if x != b] ) )
+				quals.append( random.randint(2, 20) )
+			else:
+				bases.append( b )
+				quals.append( random.randint(30, 40) )
+		reads.append( Read( "read%d_%d;cell=AAAA;umi=UMI%d"%(num,r,num), "".join(bases).encode(), bytes(quals) ) )
+	return template, reads
+
+
+def main():
+
+	random.seed(arguments['--seed'])
+	families = [ simulateFamily( n, random.randint(2, arguments['--maxSize']), arguments['--length'], arguments['--errorRate'] ) for n in range(arguments['--families']) ]
+
+	quickTime, quickUsed, agree, truth = 0, 0, 0, 0
+	vsearchTime = 0
+	for template, reads in families:
+		start = time.perf_counter()
+		quick = quick_consensus(reads, 0.95, 150)
+		quickTime += time.perf_counter() - start
+
+		start = time.perf_counter()
+		slow = vsearch_consensus(reads, "0.95", [ "-mincols", '150' ])
+		vsearchTime += time.perf_counter() - start
+
+		if quick is not None:
+			quickUsed += 1
+			if str(quick) == str(slow[0]):
+				agree += 1
+			if str(quick) == template:
+				truth += 1
+
+	print( "Families: %d (%d handled by the fast path)" % (len(families), quickUsed) )
+	print( "Fast path consensus identical to vsearch: %d (%.1f%%)" % (agree, 100*agree/max(quickUsed,1)) )
+	print( "Fast path consensus identical to template: %d (%.1f%%)" % (truth, 100*truth/max(quickUsed,1)) )
+	print( "Time: fast path %.2fs, vsearch %.2fs (%.1fx)" % (quickTime, vsearchTime, vsearchTime/max(quickTime,1e-9)) )
+
+
+if __name__ == '__main__':
+
+	arguments = docopt(__doc__)
+
+	arguments['--families']  = int( arguments['--families'] )
+	arguments['--maxSize']   = int( arguments['--maxSize'] )
+	arguments['--length']    = int( arguments['--length'] )
+	arguments['--errorRate'] = float( arguments['--errorRate'] )
+	arguments['--seed']      = int( arguments['--seed'] )
+
+	main()
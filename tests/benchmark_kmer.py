@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+benchmark_kmer.py
+
+Compares V gene assignments from the k-mer index engine (1.1-blast_V.py
+    --engine kmer) with BLAST, on reads from tests/subsample_r1.fq.gz. Reports
+    how many reads the index made a call on (the rest go to BLAST), how often
+    its top V gene agreed with BLAST's, and the time taken by BLAST alone
+    versus the index plus BLAST for the fallback reads.
+
+Usage: benchmark_kmer.py [ --reads 2000 --lib path/to/library.fa --fastq tests/subsample_r1.fq.gz ]
+
+Options:
+    --reads 2000        Number of reads to assign. [default: 2000]
+    --lib LIB           V gene library to search. Defaults to the human heavy,
+                            kappa and lambda library.
+    --fastq FILE        Reads to assign. Defaults to tests/subsample_r1.fq.gz.
+
+"""
+
+import sys, os, gzip, time, tempfile
+from docopt import docopt
+
+try:
+	from SONAR.annotate import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("SONAR/tests")
+	sys.path.append(find_SONAR[0])
+	from SONAR.annotate import *
+
+
+def runBlast(folder, name, reads):
+	#blast a set of reads against the V library and return the top hits, and the time it took
+	with open("%s/%s_1.fasta" % (folder, name), "w") as handle:
+		write_reads(reads, handle)
+	start = time.perf_counter()
+	blastProcess( 1, "%s/%s_%%d.fasta" % (folder, name), arguments['--lib'], "%s/%s_%%d.txt" % (folder, name), V_BLAST_WORD_SIZE )
+	elapsed = time.perf_counter() - start
+	tophits = get_top_hits( "%s/%s_1.txt" % (folder, name), dict_germ_count=dict() )[0] if len(reads) > 0 else dict()
+	return tophits, elapsed
+
+
+def main():
+
+	with gzip.open(arguments['--fastq'], "rb") as handle:
+		reads = [ r for r, n in zip( read_records(handle, "fastq"), range(arguments['--reads']) ) ]
+
+	with tempfile.TemporaryDirectory() as folder:
+
+		#make sure database setup isn't part of the timing
+		blast_database( arguments['--lib'], blast_cmd )
+		blastHits, blastTime = runBlast( folder, "all", reads )
+
+		start = time.perf_counter()
+		index = KmerIndex( arguments['--lib'], k=11 )
+		indexTime = time.perf_counter() - start
+
+		start = time.perf_counter()
+		calls, fallback = dict(), []
+		for r in reads:
+			rows = index.assign( r.id, bytes(r.seq), hits=10, minBits=KMER_V_BITS )
+			if rows is None:
+				fallback.append( r )
+			else:
+				calls[ r.id ] = rows
+		kmerTime = time.perf_counter() - start
+
+		with open("%s/kmer.txt" % folder, "w") as handle:
+			for qid, rows in calls.items():
+				for row in rows:
+					handle.write( "\t".join(row) + "\n" )
+		kmerHits = get_top_hits( "%s/kmer.txt" % folder, dict_germ_count=dict() )[0] if len(calls) > 0 else dict()
+		fallbackHits, fallbackTime = runBlast( folder, "fallback", fallback )
+
+	allele, gene, blastOnly = 0, 0, 0
+	for qid, hit in kmerHits.items():
+		if qid not in blastHits:
+			blastOnly += 1
+		elif hit.sid == blastHits[qid].sid:
+			allele += 1
+			gene   += 1
+		elif hit.sid.split("*")[0] == blastHits[qid].sid.split("*")[0]:
+			gene   += 1
+
+	print( "Reads: %d (%d with a BLAST V hit)" % (len(reads), len(blastHits)) )
+	print( "Called by the k-mer index: %d (%.1f%%); sent to BLAST: %d" % (len(kmerHits), 100*len(kmerHits)/max(len(reads),1), len(fallback)) )
+	print( "Top V identical to BLAST: %d (%.1f%%); same gene: %d (%.1f%%); no BLAST hit: %d" % (allele, 100*allele/max(len(kmerHits),1), gene, 100*gene/max(len(kmerHits),1), blastOnly) )
+	print( "Time: BLAST %.2fs; index build %.2fs, k-mer calls %.2fs, fallback BLAST %.2fs (%.1fx)" % (blastTime, indexTime, kmerTime, fallbackTime, blastTime/max(indexTime+kmerTime+fallbackTime,1e-9)) )
+
+
+if __name__ == '__main__':
+
+	arguments = docopt(__doc__)
+
+	arguments['--reads'] = int( arguments['--reads'] )
+	if arguments['--lib'] is None:
+		arguments['--lib'] = HU_VHKL_DB
+	if arguments['--fastq'] is None:
+		arguments['--fastq'] = os.path.join( os.path.dirname(os.path.abspath(__file__)), "subsample_r1.fq.gz" )
+
+	main()
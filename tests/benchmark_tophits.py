@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+benchmark_tophits.py
+
+Times top hit selection from a synthetic table of V gene BLAST hits, using
+    iter_top_hits() (one MyAlignment per row) and select_top_hits() (blocks
+    of queries parsed into a numpy array), and checks that both pick the
+    same hits. Also reports the memory taken by one MyAlignment per row
+    versus the same rows as HIT_DTYPE.
+
+Usage: benchmark_tophits.py [ --queries 50000 --hits 10 --seed 1 ]
+
+Options:
+    --queries 50000     Number of queries in the hit table. [default: 50000]
+    --hits 10           Hits per query, as from 1.1-blast_V.py. [default: 10]
+    --seed 1            Seed for the random hit table. [default: 1]
+
+"""
+
+import sys, copy, time, random, tracemalloc
+from docopt import docopt
+
+try:
+	from SONAR.annotate import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("SONAR/tests")
+	sys.path.append(find_SONAR[0])
+	from SONAR.annotate import *
+
+
+def hit_table_rows(queries, hits, seed):
+	#random V hits with decreasing scores, and the odd second hit on the same gene
+	rng   = random.Random(seed)
+	genes = [ "IGHV%d-%d*%02d" % (f, g, a) for f in range(1, 8) for g in range(1, 12) for a in range(1, 4) ]
+	rows  = []
+	for q in range(queries):
+		score  = rng.uniform(150, 500)
+		strand = rng.choice( ["plus", "minus"] )
+		for h in range(hits):
+			length = rng.randint(200, 300)
+			qstart = rng.randint(1, 20)
+			sstart = rng.randint(1, 10)
+			send   = sstart + length if strand == "plus" else max(1, sstart - length)
+			rows.append( [ "%08d" % q, rng.choice(genes), "%.2f" % rng.uniform(80, 100), str(length), str(rng.randint(0, 30)), "0",
+				       str(qstart), str(qstart + length), str(sstart), str(send), "1e-50", "%.1f" % score, strand ] )
+			score -= rng.choice( [0, 0.5, 1, 2, 5, 10] )
+	return rows
+
+
+def main():
+
+	rows = hit_table_rows( arguments['--queries'], arguments['--hits'], arguments['--seed'] )
+
+	copies = copy.deepcopy(rows)
+	start  = time.perf_counter()
+	old    = [ (hit[0].sid, hit[1], hit[2]) for hit in iter_top_hits(copies) ]
+	oldTime = time.perf_counter() - start
+
+	copies = copy.deepcopy(rows)
+	start  = time.perf_counter()
+	new    = [ (hit[0].sid, hit[1], hit[2]) for hit in select_top_hits(copies) ]
+	newTime = time.perf_counter() - start
+
+	sample = rows[ : 10 * arguments['--hits'] * 100 ]
+	tracemalloc.start()
+	alignments = [ MyAlignment(row) for row in sample ]
+	objectBytes = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	#the objects only had to stay alive while they were measured
+	del alignments
+	tableBytes = len(sample) * HIT_DTYPE.itemsize
+
+	print( "Hits: %d for %d queries" % (len(rows), arguments['--queries']) )
+	print( "Same top hits: %s" % (old == new) )
+	print( "iter_top_hits: %.2fs; select_top_hits: %.2fs (%.1fx)" % (oldTime, newTime, oldTime/max(newTime, 1e-9)) )
+	print( "Memory per hit: %.0f bytes as MyAlignment, %d bytes as HIT_DTYPE" % (objectBytes/len(sample), tableBytes/len(sample)) )
+
+
+if __name__ == '__main__':
+
+	arguments = docopt(__doc__)
+
+	for option in [ '--queries', '--hits', '--seed' ]:
+		arguments[option] = int( arguments[option] )
+
+	main()
@@ -4,6 +4,7 @@
 def cleanup():
 	shutil.rmtree( "output", ignore_errors=True )
 	shutil.rmtree( "work", ignore_errors=True)
+	shutil.rmtree( "resume_test", ignore_errors=True)
 	try:
 		os.remove("f0_merged.fq")
 		os.remove("derepAllRawSeqs.uc")
@@ -56,6 +57,18 @@ for command in [ [f"{SONARDIR}/SONAR/annotate/1.0-preprocess.py", "--input", "su
 		sys.exit( f"Received error \"{e.strip()}\" running {command[0].split('/')[-1]}" )
 
 
+#test that UMI processing can be resumed from its checkpoints (in a separate project,
+#    so it doesn't touch the main test): run it to completion, then again with --resume
+os.makedirs("resume_test", exist_ok=True)
+umiCommand = [f"{SONARDIR}/SONAR/annotate/1.0-preprocess.py", "--input", "../subsample_r1.fq.gz", "--cell", "0,16", "--umi", "16,26", "--threads", "2"]
+for command in [ umiCommand, umiCommand + ["--resume"] ]:
+	s=subprocess.Popen( command, cwd="resume_test", universal_newlines=True, stderr=subprocess.PIPE  )
+	o,e = s.communicate()
+	if s.returncode != 0:
+		cleanup()
+		sys.exit( f"Received error \"{e.strip()}\" running {' '.join(command[1:])}" )
+
+
 #validate rearrangements output
 #at the moment, it seems like IgPhyML output varies a bit even with a specified seed, so skip that test for now.
 import hashlib